@@ -0,0 +1,166 @@
+"""Tombstone-then-purge account deletion.
+
+Deleting a user with `db.session.delete(user)` makes the ORM load all of
+their messages, likes and follows inside the request and delete them in one
+long transaction. Instead, `tombstone_user()` just marks the account
+deleted (hiding it everywhere) and the `purge_user` job removes the rows in
+small batches afterwards, committing and pausing between batches so live
+traffic can get at the same tables.
+
+Progress for each purge is kept in `AccountDeletion`, so a purge that was
+interrupted can be resumed with `flask purge-deleted-users`. Each batch
+works out what is left from the tables themselves, so resuming never
+skips or repeats rows. The counters are committed to the main database
+right after the shard commit for the rows they count. A crash between
+those two commits leaves that batch deleted but uncounted.
+"""
+
+from datetime import datetime
+import time
+
+from flask import current_app
+
+from cache import cache, message_tag
+from jobs import job
+from models import (db, User, Message, ArchivedMessage, Follows, Likes,
+                    MessageTag, Mention, Notification, AccountDeletion)
+import shards
+
+BATCH_SIZE = 500
+PAUSE_SECONDS = 0.05
+
+
+def tombstone_user(user):
+    """Hide `user` immediately and record a pending purge."""
+
+    user.deleted_at = datetime.utcnow()
+    db.session.add(AccountDeletion(user_id=user.id))
+    db.session.commit()
+
+
+def _delete_in_batches(query, column, batch_size, pause):
+    """Delete rows matched by `query`, `batch_size` at a time, keyed on
+    `column`. Yields the `column` values of each batch deleted.
+    """
+
+    while True:
+        ids = [row[0] for row in query.with_entities(column).limit(batch_size)]
+        if not ids:
+            return
+
+        query.filter(column.in_(ids)).delete(synchronize_session=False)
+        yield ids
+
+        if pause:
+            time.sleep(pause)
+
+
+def purge_user(user_id, batch_size=BATCH_SIZE, pause=PAUSE_SECONDS):
+    """Delete a tombstoned user's rows in bounded batches, then the user."""
+
+    progress = AccountDeletion.query.get(user_id)
+    if progress is None or progress.finished_at is not None:
+        return progress
+
+    progress.status = 'running'
+    db.session.commit()
+
+    # messages and likes are on the user's shard (the main database when
+    # unsharded); everything else is in the main database
+    shard_session = shards.session_for_user(user_id)
+    own_likes = shard_session.query(Likes).filter(Likes.user_id == user_id)
+
+    mentions_of_user = Mention.query.filter(Mention.user_id == user_id)
+    own_notifications = Notification.query.filter(
+        Notification.recipient_id == user_id)
+
+    for query, column in ((mentions_of_user, Mention.message_id),
+                          (own_notifications, Notification.id)):
+        for _ in _delete_in_batches(query, column, batch_size, pause):
+            db.session.commit()
+
+    for msg_ids in _delete_in_batches(own_likes, Likes.message_id,
+                                      batch_size, pause):
+        progress.likes_deleted += len(msg_ids)
+        shards.commit(shard_session)
+        # the liked messages' pages show a like count
+        cache.invalidate(*[message_tag(msg_id) for msg_id in msg_ids])
+
+    for model in (Message, ArchivedMessage):
+        own_messages = shard_session.query(model).filter(
+            model.user_id == user_id)
+
+        while True:
+            msg_ids = [row[0] for row in
+                       own_messages.with_entities(model.id).limit(batch_size)]
+            if not msg_ids:
+                break
+
+            # tag and mention rows have no foreign key to cascade from, and
+            # other users' likes can be on any shard, so they go first
+            (MessageTag.query
+             .filter(MessageTag.message_id.in_(msg_ids))
+             .delete(synchronize_session=False))
+            (Mention.query
+             .filter(Mention.message_id.in_(msg_ids))
+             .delete(synchronize_session=False))
+            if model is Message:
+                # archived messages have no likes. The shards commit their
+                # deletes as they go, so count them (and commit the tag and
+                # mention deletes) straight after
+                progress.likes_deleted += sum(shards.scatter(
+                    lambda session: session.query(Likes)
+                    .filter(Likes.message_id.in_(msg_ids))
+                    .delete(synchronize_session=False), commit=True))
+                db.session.commit()
+            (own_messages
+             .filter(model.id.in_(msg_ids))
+             .delete(synchronize_session=False))
+
+            progress.messages_deleted += len(msg_ids)
+            shards.commit(shard_session)
+            cache.invalidate(*[message_tag(msg_id) for msg_id in msg_ids])
+
+            if pause:
+                time.sleep(pause)
+
+    following = Follows.query.filter(Follows.user_following_id == user_id)
+    followers = Follows.query.filter(Follows.user_being_followed_id == user_id)
+
+    for ids in _delete_in_batches(following, Follows.user_being_followed_id,
+                                  batch_size, pause):
+        progress.follows_deleted += len(ids)
+        db.session.commit()
+
+    for ids in _delete_in_batches(followers, Follows.user_following_id,
+                                  batch_size, pause):
+        progress.follows_deleted += len(ids)
+        db.session.commit()
+
+    User.query.filter(User.id == user_id).delete(synchronize_session=False)
+    progress.status = 'finished'
+    progress.finished_at = datetime.utcnow()
+    db.session.commit()
+
+    return progress
+
+
+def purge_pending(**kwargs):
+    """Purge every account whose deletion hasn't finished."""
+
+    pending = [row.user_id for row in
+               AccountDeletion.query.filter(
+                   AccountDeletion.finished_at.is_(None))]
+
+    return [purge_user(user_id, **kwargs) for user_id in pending]
+
+
+@job('purge_user')
+def purge_user_job(user_id):
+    """Job handler: purge `user_id` using the app's batch settings."""
+
+    purge_user(
+        user_id,
+        batch_size=current_app.config.get('ACCOUNT_PURGE_BATCH_SIZE',
+                                          BATCH_SIZE),
+        pause=current_app.config.get('ACCOUNT_PURGE_PAUSE', PAUSE_SECONDS))
@@ -0,0 +1,213 @@
+"""Admission control for expensive routes.
+
+Under a spike, expensive requests all queue behind each other on the
+same worker threads. Home timelines, the full user list, bcrypt for
+logins and signups, and account deletion all wait together, and every
+request's latency climbs with them, cheap ones included.
+
+Each expensive route belongs to a class with its own gate (configured in
+ADMISSION_CLASSES). A gate admits `limit` requests at once and lets up to
+`queue` more wait at most `wait` seconds for a slot. Anything beyond that
+is shed straight away with a 503 and a Retry-After header, so it costs
+nothing. Routes that aren't classified never wait.
+
+Some routes have a cheaper fallback than a 503. When the 'timeline' gate is
+full, the home page shows the user's last rendered timeline if there is
+one (see `degraded()`). That copy is saved at most once every
+ADMISSION_STALE_REFRESH seconds per user and process (see `StaleCopies`),
+not on every view.
+
+Gates are per process, so limits are per worker process. Each gate's
+limit, current load, queue depth and counters are at /admin/admission.
+"""
+
+from collections import OrderedDict
+from threading import Condition, Lock
+import time
+
+from flask import current_app, g, request, Response
+
+RETRY_AFTER = 2
+STALE_REFRESH = 60
+
+# endpoint -> (class, methods it applies to; None for all)
+ROUTES = {
+    'warbler.homepage': ('timeline', None),
+    'warbler.list_users': ('listing', None),
+    'warbler.login': ('password', {'POST'}),
+    'warbler.signup': ('password', {'POST'}),
+    'warbler.profile': ('password', {'POST'}),
+    'warbler.delete_user': ('delete', {'POST'}),
+    'warbler.messages_bulk_add': ('bulk', None),
+    'warbler.users_export': ('bulk', None),
+}
+
+# endpoints that serve a degraded response instead of being shed
+DEGRADABLE = {'warbler.homepage'}
+
+
+class Gate:
+    """At most `limit` holders, with a bounded, time-limited wait queue."""
+
+    def __init__(self, name, limit, queue=0, wait=0.0):
+        self.name = name
+        self.limit = limit
+        self.queue = queue
+        self.wait = wait
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.queued = 0
+        self.shed = 0
+        self._cond = Condition()
+
+    def acquire(self):
+        """Take a slot, waiting if allowed. False if the request is shed."""
+
+        with self._cond:
+            if self.active < self.limit and not self.waiting:
+                self.active += 1
+                self.admitted += 1
+                return True
+
+            if self.waiting >= self.queue:
+                self.shed += 1
+                return False
+
+            self.waiting += 1
+            self.queued += 1
+            deadline = time.monotonic() + self.wait
+            try:
+                while self.active >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.shed += 1
+                        return False
+                    self._cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+
+            self.active += 1
+            self.admitted += 1
+            return True
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {'limit': self.limit, 'queue': self.queue,
+                    'wait': self.wait, 'active': self.active,
+                    'waiting': self.waiting, 'admitted': self.admitted,
+                    'queued': self.queued, 'shed': self.shed}
+
+
+def classify(req):
+    """The admission class of `req`, or None if it's cheap."""
+
+    route_class, methods = ROUTES.get(req.endpoint, (None, None))
+    if methods is not None and req.method not in methods:
+        return None
+    if req.endpoint == 'warbler.list_users' and req.args.get('q'):
+        # a search returns a handful of rows; the full list is the
+        # expensive one
+        return None
+    return route_class
+
+
+def busy_response():
+    """A fast 503 telling the client when to come back."""
+
+    retry_after = current_app.config.get('ADMISSION_RETRY_AFTER', RETRY_AFTER)
+    return Response("Warbler is busy right now. Please try again shortly.\n",
+                    status=503, mimetype='text/plain',
+                    headers={'Retry-After': str(retry_after)})
+
+
+def degraded():
+    """Was this request let in without a slot, to serve a cheap fallback?
+
+    Routes in DEGRADABLE check this and return `busy_response()` if they
+    have nothing cheap to show.
+    """
+
+    return g.get('admission_degraded', False)
+
+
+class StaleCopies:
+    """When this process last saved each fallback copy, for the most
+    recently saved `max_entries` of them.
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._saved = OrderedDict()
+        self._lock = Lock()
+
+    def due(self, key, now=None):
+        """Should the copy under `key` be saved again? If so, it's recorded
+        as saved now.
+        """
+
+        interval = current_app.config.get('ADMISSION_STALE_REFRESH',
+                                          STALE_REFRESH)
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            saved_at = self._saved.get(key)
+            if saved_at is not None and now - saved_at < interval:
+                return False
+            self._saved[key] = now
+            self._saved.move_to_end(key)
+            while len(self._saved) > self.max_entries:
+                self._saved.popitem(last=False)
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._saved.clear()
+
+
+stale_copies = StaleCopies()
+
+
+class AdmissionControl:
+    """Wires the gates in ADMISSION_CLASSES into an app's requests."""
+
+    def init_app(self, app):
+        app.extensions['admission'] = {
+            name: Gate(name, **settings)
+            for name, settings in app.config.get(
+                'ADMISSION_CLASSES', {}).items()}
+        # registered before the blueprint, so it runs before the user is
+        # loaded and a shed request does no work at all
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+
+    def gates(self):
+        return current_app.extensions['admission']
+
+    def stats(self):
+        return {name: gate.stats() for name, gate in self.gates().items()}
+
+    def _before_request(self):
+        gate = self.gates().get(classify(request))
+        if gate is None:
+            return None
+
+        if gate.acquire():
+            g.admission_gate = gate
+            return None
+        if request.endpoint in DEGRADABLE:
+            g.admission_degraded = True
+            return None
+        return busy_response()
+
+    def _teardown_request(self, exc):
+        gate = g.pop('admission_gate', None)
+        if gate is not None:
+            gate.release()
+
+
+admission = AdmissionControl()
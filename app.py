@@ -1,42 +1,92 @@
 import os
 import pdb
 
-from flask import Flask, render_template, request, flash, redirect, session, g
-from flask_debugtoolbar import DebugToolbarExtension
+from flask import Flask, Blueprint, render_template, request, flash, redirect, session, g, jsonify
+from flask import Response, stream_with_context, abort, send_file, current_app
+from flask_migrate import Migrate
 from sqlalchemy.exc import IntegrityError
 
+from cache import cache, user_tag, messages_tag, likes_tag, message_tag
+from config import get_config
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message, Likes
+from models import db, connect_db, User, Message, ArchivedMessage, Likes
+from follow_graph import follow_graph
+from timeline_cache import recent_messages
+from account_deletion import tombstone_user
+from admission import admission, busy_response, degraded, stale_copies
+from availability import taken_names, conflicts, is_available
+from counts import user_counts
+from jobs import enqueue
+import archive
+import live
+import notifications
+import read_models
+import shards
+import tagging
+import thumbnails
 
 CURR_USER_KEY = "curr_user"
 
-app = Flask(__name__)
+bp = Blueprint('warbler', __name__)
+migrate = Migrate()
 
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgresql:///warbler'))
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-toolbar = DebugToolbarExtension(app)
+def create_app(config=None):
+    """Build the Warbler app.
 
-connect_db(app)
+    `config` is an environment name from config.CONFIGS ('development',
+    'testing', 'production'), a config object, or None to use the
+    WARBLER_CONFIG environment variable (default 'development').
+    """
+
+    app = Flask(__name__)
+    app.config.from_object(get_config(config))
+
+    if app.debug:
+        # only pulled in for local development; it's heavy to import
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    # hooks that only the serving app installs; scripts that just need
+    # the database (see seed.py) don't import them
+    from profiler import profiler
+    from slow_queries import slow_queries
+    from template_cache import template_cache
+
+    connect_db(app)
+    migrate.init_app(app, db)
+    cache.init_app(app)
+    profiler.init_app(app)
+    admission.init_app(app)
+    slow_queries.init_app(app)
+    shards.init_app(app)
+
+    # templates (including macros imported without context) check follows
+    # against the in-memory index instead of loading `User.following`
+    app.jinja_env.globals['follow_graph'] = follow_graph
+    app.jinja_env.globals['thumbnail_url'] = thumbnails.thumbnail_url
+    app.jinja_env.globals['user_counts'] = user_counts
+    template_cache.init_app(app)
+
+    app.register_blueprint(bp)
+
+    from commands import register_commands
+    register_commands(app)
+
+    return app
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
+@bp.before_app_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = User.active().filter_by(id=session[CURR_USER_KEY]).first()
+        follow_graph.ensure_loaded()
 
     else:
         g.user = None
@@ -55,7 +105,7 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
-@app.route('/signup', methods=["GET", "POST"])
+@bp.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
 
@@ -70,6 +120,13 @@ def signup():
     form = UserAddForm()
 
     if form.validate_on_submit():
+        # turn conflicts away before paying for the password hash
+        errors = conflicts(form.username.data, form.email.data)
+        if errors:
+            for error in errors:
+                flash(error, 'danger')
+            return render_template('users/signup.html', form=form)
+
         try:
             user = User.signup(
                 username=form.username.data,
@@ -77,12 +134,18 @@ def signup():
                 email=form.email.data,
                 image_url=form.image_url.data or User.image_url.default.arg,
             )
+            # flush for the column defaults; the job commits with the user
+            db.session.flush()
+            enqueue('generate_thumbnails', priority=-1,
+                    image_url=user.image_url,
+                    header_image_url=user.header_image_url)
             db.session.commit()
 
         except IntegrityError:
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        taken_names.add(user.username, user.email)
         do_login(user)
 
         return redirect("/")
@@ -91,7 +154,27 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@bp.route('/api/username-available')
+def username_available():
+    """Are the 'username' and/or 'email' params free to use?
+
+    For live validation of the signup and profile forms; the logged-in
+    user's own names count as free. Returns e.g.
+    {"available": {"username": true}}.
+    """
+
+    names = {kind: request.args[kind] for kind in ('username', 'email')
+             if request.args.get(kind)}
+    if not names:
+        return jsonify(error="Expected a username or email."), 400
+
+    except_user_id = g.user.id if g.user else None
+    return jsonify(available={
+        kind: is_available(kind, name, except_user_id)
+        for kind, name in names.items()})
+
+
+@bp.route('/login', methods=["GET", "POST"])
 def login():
     """Handle user login."""
 
@@ -111,7 +194,7 @@ def login():
     return render_template('users/login.html', form=form)
 
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     """Handle logout of user."""
 
@@ -124,7 +207,7 @@ def logout():
 ##############################################################################
 # General user routes:
 
-@app.route('/users')
+@bp.route('/users')
 def list_users():
     """Page with listing of users.
 
@@ -134,32 +217,35 @@ def list_users():
     search = request.args.get('q')
 
     if not search:
-        users = User.query.all()
+        users = User.active().all()
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users = User.active().filter(User.username.like(f"%{search}%")).all()
 
     return render_template('users/index.html', users=users)
 
 
-@app.route('/users/<int:user_id>')
+@bp.route('/users/<int:user_id>')
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    user = User.active().filter_by(id=user_id).first_or_404()
 
     # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
+    # user.messages won't be in order by default. The rendered list is the
+    # same for every viewer, so it's cached until the user posts, deletes
+    # or edits their profile.
+    messages_html = cache.get_or_set(
+        f"profile-messages:{user_id}",
+        lambda: render_template(
+            'users/messages.html', user=user,
+            messages=read_models.user_messages(user_id, limit=100)),
+        tags=[messages_tag(user_id), user_tag(user_id)])
     
-    return render_template('users/show.html', user=user, messages=messages)
+    return render_template('users/show.html', user=user,
+                           messages_html=messages_html)
 
 
-@app.route('/users/<int:user_id>/following')
+@bp.route('/users/<int:user_id>/following')
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -167,11 +253,12 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = User.active().filter_by(id=user_id).first_or_404()
+    return render_template('users/following.html', user=user,
+                           users=read_models.following_cards(user_id))
 
 
-@app.route('/users/<int:user_id>/followers')
+@bp.route('/users/<int:user_id>/followers')
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -179,10 +266,11 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = User.active().filter_by(id=user_id).first_or_404()
+    return render_template('users/followers.html', user=user,
+                           users=read_models.follower_cards(user_id))
 
-@app.route('/users/<int:user_id>/likes')
+@bp.route('/users/<int:user_id>/likes')
 def users_likes(user_id):
     """Show list of liked messages of this user."""
     
@@ -190,13 +278,47 @@ def users_likes(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    
-    messages = user.likes
-    
-    return render_template('users/likes.html', user=user, messages=messages)
+    user = User.active().filter_by(id=user_id).first_or_404()
 
-@app.route('/users/follow/<int:follow_id>', methods=['POST'])
+    messages, next_before = read_models.liked_messages(
+        user_id, before=request.args.get('before'))
+
+    return render_template('users/likes.html', user=user, messages=messages,
+                           next_before=next_before)
+
+@bp.route('/users/<int:user_id>/export')
+def users_export(user_id):
+    """Download this user's messages, likes and follows.
+
+    Takes a 'format' param of jsonl (default) or csv. The response is
+    streamed, and gzip-compressed if the client accepts it.
+    """
+
+    if not g.user or g.user.id != user_id:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    import export
+
+    fmt = request.args.get('format', 'jsonl')
+    if fmt not in export.FORMATS:
+        abort(400)
+
+    compress = 'gzip' in request.headers.get('Accept-Encoding', '')
+    body = export.export_user(user_id, fmt, compress=compress)
+
+    headers = {
+        'Content-Disposition':
+            f'attachment; filename="warbler-{user_id}.{fmt}"',
+    }
+    if compress:
+        headers['Content-Encoding'] = 'gzip'
+
+    return Response(stream_with_context(body),
+                    mimetype=export.FORMATS[fmt], headers=headers)
+
+
+@bp.route('/users/follow/<int:follow_id>', methods=['POST'])
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
@@ -204,14 +326,18 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
+    followed_user = User.active().filter_by(id=follow_id).first_or_404()
     g.user.following.append(followed_user)
+    notifications.notify('follow', g.user.id, recipient_id=followed_user.id)
     db.session.commit()
+    follow_graph.add(g.user.id, followed_user.id)
+    follow_graph.publish()
+    notifications.schedule_delivery()
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
+@bp.route('/users/stop-following/<int:follow_id>', methods=['POST'])
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
@@ -222,11 +348,13 @@ def stop_following(follow_id):
     followed_user = User.query.get(follow_id)
     g.user.following.remove(followed_user)
     db.session.commit()
+    follow_graph.remove(g.user.id, followed_user.id)
+    follow_graph.publish()
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/profile', methods=["GET", "POST"])
+@bp.route('/users/profile', methods=["GET", "POST"])
 def profile():
     """Update profile for current user."""
 
@@ -236,6 +364,13 @@ def profile():
     
     form = UserEditForm()
     if form.validate_on_submit():
+        errors = conflicts(form.username.data, form.email.data,
+                           except_user_id=g.user.id)
+        if errors:
+            for error in errors:
+                flash(error, 'danger')
+            return render_template('/users/edit.html', form=form)
+
         user = User.authenticate(g.user.username,
                                  form.password.data)
         
@@ -247,7 +382,19 @@ def profile():
             user.bio = form.bio.data
             
             db.session.add(user)
-            db.session.commit()
+            try:
+                # enqueue flushes the user, so a conflict can show up here
+                enqueue('generate_thumbnails', priority=-1,
+                        image_url=user.image_url,
+                        header_image_url=user.header_image_url)
+                db.session.commit()
+            except IntegrityError:
+                # taken by someone else since the check above
+                db.session.rollback()
+                flash("Username or email already taken", 'danger')
+                return render_template('/users/edit.html', form=form)
+            taken_names.add(user.username, user.email)
+            cache.invalidate(user_tag(user.id))
             
             flash("Profile successfully updated.", "success")
             return redirect(f"/users/{g.user.id}")
@@ -258,7 +405,23 @@ def profile():
             
             
 
-@app.route('/users/delete', methods=["POST"])
+@bp.route('/notifications')
+def notifications_show():
+    """Show the current user's notifications and mark them read."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    items = notifications.recent(g.user.id)
+    html = render_template('users/notifications.html', notifications=items)
+    if g.user.unread_notifications:
+        notifications.mark_all_read(g.user)
+
+    return html
+
+
+@bp.route('/users/delete', methods=["POST"])
 def delete_user():
     """Delete user."""
 
@@ -268,12 +431,30 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
-    db.session.commit()
+    # hide the account now; its rows are deleted in batches in the background
+    user_id = g.user.id
+    # committed together with the tombstone
+    enqueue('purge_user', user_id=user_id)
+    tombstone_user(g.user)
+    follow_graph.remove_user(user_id)
+    follow_graph.publish()
+    recent_messages.forget(user_id)
+    cache.invalidate(user_tag(user_id), messages_tag(user_id),
+                     likes_tag(user_id))
 
     return redirect("/signup")
 
-@app.route('/users/add_like/<int:msg_id>', methods=["POST"])
+def _unlikeable_reason(msg_id):
+    """Why `msg_id` can't be liked, or None if it can."""
+
+    if archive.is_hot(msg_id):
+        return None
+    if archive.find_message(msg_id) is not None:
+        return "Archived messages can't be liked."
+    return "Message not found."
+
+
+@bp.route('/users/add_like/<int:msg_id>', methods=["POST"])
 def like_msg(msg_id):
     """Like a message."""
     
@@ -281,16 +462,29 @@ def like_msg(msg_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
     
+    unlikeable = _unlikeable_reason(msg_id)
+    if unlikeable:
+        flash(unlikeable, 'danger')
+        return redirect("/")
+
+    shard_session = shards.session_for_user(g.user.id)
     try:
         new_like = Likes(user_id=g.user.id, message_id=msg_id)
-        db.session.add(new_like)
-        db.session.commit()
+        shard_session.add(new_like)
+        notifications.notify('like', g.user.id, message_id=msg_id)
+        shards.commit(shard_session)
     except IntegrityError:
-        flash("Message already liked.", 'danger')
+        shards.rollback(shard_session)
+        # archived or deleted since the check above, or already liked
+        flash(_unlikeable_reason(msg_id) or "Message already liked.",
+              'danger')
+    else:
+        cache.invalidate(likes_tag(g.user.id), message_tag(msg_id))
+        notifications.schedule_delivery()
     
     return redirect("/")
 
-@app.route('/users/remove_like/<int:msg_id>', methods=["POST"])
+@bp.route('/users/remove_like/<int:msg_id>', methods=["POST"])
 def unlike_msg(msg_id):
     """Remove like from a message."""
     
@@ -298,10 +492,12 @@ def unlike_msg(msg_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
     
+    shard_session = shards.session_for_user(g.user.id)
     try:
-        like = Likes.query.filter( (Likes.user_id == g.user.id) & (Likes.message_id == msg_id) ).first()
-        db.session.delete(like)
-        db.session.commit()
+        like = shard_session.query(Likes).filter( (Likes.user_id == g.user.id) & (Likes.message_id == msg_id) ).first()
+        shard_session.delete(like)
+        shards.commit(shard_session)
+        cache.invalidate(likes_tag(g.user.id), message_tag(msg_id))
     except IntegrityError:
         flash("You cannot unlike a message that hasn't been already liked.", 'danger')
     
@@ -311,7 +507,7 @@ def unlike_msg(msg_id):
 ##############################################################################
 # Messages routes:
 
-@app.route('/messages/new', methods=["GET", "POST"])
+@bp.route('/messages/new', methods=["GET", "POST"])
 def messages_add():
     """Add a message:
 
@@ -325,24 +521,123 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
-        db.session.commit()
+        shard_session = shards.session_for_user(g.user.id)
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        shard_session.add(msg)
+        shard_session.flush()
+        mentions = tagging.index_messages([msg])
+        for user_id, message_id in mentions:
+            notifications.notify('mention', g.user.id, recipient_id=user_id,
+                                 message_id=message_id)
+        shards.commit(shard_session)
+        recent_messages.push(g.user.id, msg.id)
+        cache.invalidate(messages_tag(g.user.id))
+        shards.attach_users([msg])
+        live.publish_message(
+            msg, render_template('messages/live-item.html', msg=msg))
+        if mentions:
+            notifications.schedule_delivery()
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
-@app.route('/messages/<int:message_id>', methods=["GET"])
+@bp.route('/api/messages/bulk', methods=["POST"])
+def messages_bulk_add():
+    """Add many messages for the current user from a JSON body.
+
+    Expects {"messages": [{"text": ..., "timestamp": ...}, ...]}, where
+    timestamp is optional. Returns how many were inserted and the index and
+    reason for each message that was rejected.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    payload = request.get_json(silent=True) or {}
+    rows = payload.get('messages')
+
+    if not isinstance(rows, list):
+        return jsonify(error="Expected a list of messages."), 400
+
+    if len(rows) > current_app.config['BULK_MESSAGES_MAX']:
+        return jsonify(error="Too many messages in one request."), 413
+
+    import bulk_messages
+
+    inserted, errors = bulk_messages.ingest(rows, user_id=g.user.id)
+
+    return jsonify(
+        inserted=inserted,
+        errors=[{"index": index, "error": reason} for index, reason in errors],
+    ), 201
+
+
+def _message_meta(message_id):
+    """The author of a message and whether it's archived.
+
+    Aborts with a 404 for unknown ids rather than returning something to
+    cache, so walking through ids that don't exist doesn't fill the cache.
+    """
+
+    msg = archive.find_message(message_id)
+    if msg is None:
+        abort(404)
+    return {'author_id': msg.user_id,
+            'archived': isinstance(msg, ArchivedMessage)}
+
+
+def _render_message(message_id):
+    """The part of a message's page that's the same for every viewer."""
+
+    msg = archive.find_message(message_id)
+    if msg is None or msg.user.deleted_at is not None:
+        return None
+
+    like_count = sum(shards.scatter(
+        lambda session: session.query(db.func.count(Likes.user_id))
+        .filter(Likes.message_id == message_id).scalar()))
+    return render_template('messages/show-message.html', message=msg,
+                           like_count=like_count)
+
+
+@bp.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
-    """Show a message."""
+    """Show a message.
+
+    The message itself is rendered once and cached until it's deleted,
+    liked or unliked, or its author edits their profile. Only the viewer's
+    own buttons are rendered per request.
+    """
+
+    # a message's author never changes, so this only needs dropping when
+    # the message goes (or is archived)
+    meta = cache.get_or_set(f"message-meta:{message_id}",
+                            lambda: _message_meta(message_id),
+                            tags=[message_tag(message_id)])
+    author_id = meta['author_id']
 
-    msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg)
+    message_html = cache.get_or_set(
+        f"message-page:{message_id}", lambda: _render_message(message_id),
+        tags=[message_tag(message_id), user_tag(author_id)])
+    if message_html is None:
+        abort(404)
+
+    liked = False
+    if g.user:
+        shard_session = shards.session_for_user(g.user.id)
+        liked = shard_session.query(
+            shard_session.query(Likes)
+            .filter_by(user_id=g.user.id, message_id=message_id)
+            .exists()).scalar()
+
+    return render_template('messages/show.html', message_id=message_id,
+                           author_id=author_id, message_html=message_html,
+                           liked=liked, archived=meta['archived'])
 
 
-@app.route('/messages/<int:message_id>/delete', methods=["POST"])
+@bp.route('/messages/<int:message_id>/delete', methods=["POST"])
 def messages_destroy(message_id):
     """Delete a message."""
 
@@ -350,18 +645,196 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get(message_id)
-    db.session.delete(msg)
-    db.session.commit()
+    msg = archive.find_message(message_id)
+    author_id = msg.user_id
+    # likes of the message go with it; they can be on any shard
+    liker_ids = [row[0] for rows in shards.scatter(
+                     lambda session: session.query(Likes.user_id)
+                     .filter(Likes.message_id == message_id).all())
+                 for row in rows]
+    shards.scatter(lambda session: session.query(Likes)
+                   .filter(Likes.message_id == message_id)
+                   .delete(synchronize_session=False), commit=True)
+    tagging.unindex_messages([message_id])
+    shard_session = shards.session_for_user(author_id)
+    for model in (Message, ArchivedMessage):
+        shard_session.query(model).filter(model.id == message_id).delete(
+            synchronize_session='evaluate')
+    shards.commit(shard_session)
+    recent_messages.remove(author_id, message_id)
+    cache.invalidate(messages_tag(author_id), message_tag(message_id),
+                     *[likes_tag(liker_id) for liker_id in liker_ids])
 
     return redirect(f"/users/{g.user.id}")
 
 
+@bp.route('/tags/<tag>')
+def tag_show(tag):
+    """Show messages tagged #tag, newest first.
+
+    Pages with a 'before' param: the id of the last message on the
+    previous page.
+    """
+
+    before = request.args.get('before', type=int)
+    messages, next_before = tagging.tag_timeline(tag, before=before)
+
+    return render_template('messages/timeline.html', title=f"#{tag.lower()}",
+                           messages=messages, next_before=next_before)
+
+
+@bp.route('/mentions')
+def mentions_show():
+    """Show messages that @mention the current user, newest first."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    before = request.args.get('before', type=int)
+    messages, next_before = tagging.mentions_timeline(g.user.id,
+                                                      before=before)
+
+    return render_template('messages/timeline.html',
+                           title=f"Mentions of @{g.user.username}",
+                           messages=messages, next_before=next_before)
+
+
+@bp.route('/stream/timeline')
+def stream_timeline():
+    """Server-sent events: a list item for each new message by someone
+    the current user follows.
+    """
+
+    if not g.user:
+        abort(401)
+
+    frames = live.stream(follow_graph.following_ids(g.user.id),
+                         seconds=current_app.config['LIVE_STREAM_SECONDS'])
+
+    return Response(frames, mimetype='text/event-stream',
+                    headers={'X-Accel-Buffering': 'no'})
+
+
+##############################################################################
+# Thumbnails
+
+
+@bp.route('/thumbs/<digest>.jpg')
+def thumbnail_blob(digest):
+    """Serve a stored thumbnail; its URL is its content hash, so it never
+    changes and can be cached forever.
+    """
+
+    path = thumbnails.blob_path(digest)
+    if path is None:
+        abort(404)
+
+    resp = send_file(os.path.abspath(path), mimetype='image/jpeg')
+    resp.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return resp
+
+
+@bp.route('/thumbs/<variant>')
+def thumbnail(variant):
+    """Generate a thumbnail on first request and redirect to it.
+
+    Only sources signed by `thumbnail_url` are accepted.
+    """
+
+    src = request.args.get('src')
+    if (variant not in thumbnails.VARIANTS or
+            not thumbnails.verify_source(src, variant,
+                                         request.args.get('sig'))):
+        abort(404)
+
+    digest = thumbnails.ensure_thumbnail(src, variant)
+    if digest is None:
+        abort(404)
+
+    return redirect(f"/thumbs/{digest}.jpg")
+
+
+##############################################################################
+# Admin
+
+
+def is_admin(user):
+    return (user is not None and
+            user.username in current_app.config['ADMIN_USERNAMES'])
+
+
+@bp.route('/admin/slow-queries')
+def admin_slow_queries():
+    """Recent slow queries in this process, with their plans."""
+
+    from slow_queries import slow_queries
+
+    # don't reveal that the page exists
+    if not is_admin(g.user):
+        abort(404)
+
+    return render_template('admin/slow_queries.html',
+                           entries=slow_queries.entries(),
+                           threshold=current_app.config['SLOW_QUERY_MS'])
+
+
+@bp.route('/admin/slow-queries.jsonl')
+def admin_slow_queries_jsonl():
+    """The same entries as JSON Lines, newest first."""
+
+    from slow_queries import slow_queries, to_jsonl
+
+    if not is_admin(g.user):
+        abort(404)
+
+    return Response(to_jsonl(slow_queries.entries()),
+                    mimetype='application/x-ndjson')
+
+
+@bp.route('/admin/admission')
+def admin_admission():
+    """Limit, load, queue depth and counters of each admission gate in
+    this process.
+    """
+
+    if not is_admin(g.user):
+        abort(404)
+
+    return jsonify(admission.stats())
+
+
+@bp.route('/admin/cache')
+def admin_cache():
+    """Hits, misses, invalidations and errors of the shared cache in this
+    process.
+    """
+
+    if not is_admin(g.user):
+        abort(404)
+
+    return jsonify(cache.stats())
+
+
+@bp.route('/admin/templates')
+def admin_templates():
+    """Loads, compiles and render times of each template in this
+    process.
+    """
+
+    from template_cache import template_cache
+
+    if not is_admin(g.user):
+        abort(404)
+
+    return jsonify(template_cache.stats())
+
+
 ##############################################################################
 # Homepage and error pages
 
 
-@app.route('/')
+@bp.route('/')
 def homepage():
     """Show homepage:
 
@@ -370,21 +843,37 @@ def homepage():
     """
 
     if g.user:
-        followers_ids = [follower.id for follower in g.user.following]
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(followers_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-        likes_ids = [message.id for message in g.user.likes if message in messages]
-
-        return render_template('home.html', messages=messages, likes=likes_ids)
-        
+        stale_key = f"home-timeline:{g.user.id}"
+        if degraded():
+            # the timeline gate is full; show the last timeline we rendered
+            timeline_html = cache.get(stale_key)
+            if timeline_html is None:
+                return busy_response()
+            return render_template('home.html', timeline_html=timeline_html,
+                                   degraded=True)
+
+        followers_ids = follow_graph.following_ids(g.user.id)
+        messages = read_models.messages_by_ids(
+            recent_messages.timeline_ids(followers_ids, limit=100))
+        shown_ids = [message.id for message in messages]
+        likes_ids = [row[0] for row in
+                     shards.session_for_user(g.user.id).query(Likes.message_id)
+                     .filter(Likes.user_id == g.user.id,
+                             Likes.message_id.in_(shown_ids))]
+
+        timeline_html = render_template('messages/home-timeline.html',
+                                        messages=messages, likes=likes_ids)
+        # kept on purpose past new posts and likes, for degraded mode
+        if stale_copies.due(stale_key):
+            cache.set(stale_key, timeline_html,
+                      ttl=current_app.config['ADMISSION_STALE_TTL'])
+
+        return render_template('home.html', timeline_html=timeline_html)
+
     else:
         return render_template('home-anon.html')
 
-@app.errorhandler(404)
+@bp.app_errorhandler(404)
 def not_found(e):
     """404 not found page."""
     return render_template("users/404.html"), 404
@@ -396,10 +885,14 @@ def not_found(e):
 #
 # https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
 
-@app.after_request
+@bp.after_app_request
 def add_header(req):
     """Add non-caching headers on every request."""
 
+    # content-addressed responses (thumbnails) are safe to cache forever
+    if 'immutable' in req.headers.get('Cache-Control', ''):
+        return req
+
     req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     req.headers["Pragma"] = "no-cache"
     req.headers["Expires"] = "0"
@@ -0,0 +1,205 @@
+"""Hot/cold split of the `messages` table.
+
+Nearly every read is for the last few weeks of warbles, but `messages`
+grows forever and every timeline reads its newest end. `archive_messages()`
+moves messages older than a cutoff into `messages_archive` in batches, so
+the hot table and its indexes stay small.
+
+Messages that have likes stay hot, because `likes.message_id` is a foreign
+key to `messages` (with cascading delete). Each batch re-checks for likes
+inside its own transaction, with the batch's rows locked on Postgres. A
+like arriving at the same moment either waits and then fails its foreign
+key check, or commits first and keeps its message hot. Likes from other
+shards have no foreign key to wait on, so one landing mid-batch can end up
+pointing at an archived message. Archived messages can't be liked (see
+`is_hot()`). Each shard (see shards.py) has its own hot table and archive.
+
+Reads go to the hot table first and only touch the archive when they need
+to: `find_message()` / `find_messages()` for messages by id,
+`user_timeline()` to top up a profile that doesn't have enough recent
+messages.
+"""
+
+from datetime import datetime, timedelta
+import time
+
+from flask import current_app
+
+from cache import cache, messages_tag, message_tag
+from jobs import job
+from models import db, Message, ArchivedMessage, Likes
+from snowflake import id_floor
+from timeline_cache import recent_messages
+import shards
+
+ARCHIVE_AFTER_DAYS = 30
+BATCH_SIZE = 1000
+PAUSE_SECONDS = 0.05
+
+COLUMNS = ('id', 'text', 'timestamp', 'user_id')
+
+
+def cutoff(days=ARCHIVE_AFTER_DAYS):
+    return datetime.utcnow() - timedelta(days=days)
+
+
+def _liked_elsewhere(message_ids):
+    """Those of `message_ids` liked by users on any shard."""
+
+    def liked(session):
+        return {row[0] for row in session.query(Likes.message_id)
+                .filter(Likes.message_id.in_(message_ids))}
+
+    return set().union(*shards.scatter(liked))
+
+
+def _archive_shard(session, days, batch_size, pause):
+    hot = Message.__table__
+    cold = ArchivedMessage.__table__
+    # NOT EXISTS rather than NOT IN, so it's an anti-join on
+    # ix_likes_message_id instead of a pass over every like
+    unliked = ~db.exists().where(Likes.__table__.c.message_id == hot.c.id)
+    lock = session.connection().dialect.name == 'postgresql'
+
+    moved = 0
+    after = 0
+    while True:
+        before = cutoff(days)
+        # ids are time-ordered, so the id bound is a primary key range
+        # scan; the timestamp check still applies to backdated imports
+        ids = [row[0] for row in
+               session.query(Message.id)
+               .filter(Message.id > after,
+                       Message.id < id_floor(before),
+                       Message.timestamp < before,
+                       unliked)
+               .order_by(Message.id)
+               .limit(batch_size)]
+        if not ids:
+            return moved
+        after = ids[-1]
+
+        if shards.is_sharded():
+            # the subquery above only sees this shard's likes
+            skip = _liked_elsewhere(ids)
+            ids = [msg_id for msg_id in ids if msg_id not in skip]
+
+        # re-check for likes made since the query above, locking the rows
+        # so a like can't be added to one before the batch commits
+        batch = db.select([hot.c.id, hot.c.user_id]).where(
+            hot.c.id.in_(ids) & unliked)
+        rows = session.execute(
+            batch.with_for_update() if lock else batch).fetchall()
+        ids = [row[0] for row in rows]
+        authors = {row[1] for row in rows}
+        if not ids:
+            session.commit()
+            continue
+
+        session.execute(cold.insert().from_select(
+            COLUMNS,
+            db.select([hot.c[name] for name in COLUMNS])
+            .where(hot.c.id.in_(ids))))
+        session.execute(hot.delete().where(hot.c.id.in_(ids) & unliked))
+        session.commit()
+        moved += len(ids)
+
+        # timelines only merge hot messages; drop the archived ones from
+        # every process's recent-message lists
+        for author_id in authors:
+            recent_messages.forget(author_id)
+        cache.invalidate(*[messages_tag(author_id) for author_id in authors],
+                         *[message_tag(msg_id) for msg_id in ids])
+
+        if pause:
+            time.sleep(pause)
+
+
+def archive_messages(days=ARCHIVE_AFTER_DAYS, batch_size=BATCH_SIZE,
+                     pause=PAUSE_SECONDS):
+    """Move unliked messages older than `days` to the archive, on every
+    shard.
+
+    Each batch is copied and deleted in one transaction. Returns the
+    number of messages moved.
+    """
+
+    return sum(_archive_shard(shards.session(shard), days, batch_size, pause)
+               for shard in range(shards.count()))
+
+
+@job('archive_messages')
+def archive_messages_job(days=None):
+    """Job handler: archive using the app's settings."""
+
+    config = current_app.config
+    archive_messages(
+        days=days or config.get('MESSAGE_ARCHIVE_AFTER_DAYS',
+                                ARCHIVE_AFTER_DAYS),
+        batch_size=config.get('MESSAGE_ARCHIVE_BATCH_SIZE', BATCH_SIZE))
+
+
+def is_hot(message_id):
+    """Is `message_id` in a hot table, so it can be liked?"""
+
+    return any(shards.scatter(
+        lambda session: session.query(
+            session.query(Message.id).filter(Message.id == message_id)
+            .exists()).scalar()))
+
+
+def find_message(message_id):
+    """Get a message by id from the hot table, falling back to the archive."""
+
+    found = find_messages([message_id])
+    return found[0] if found else None
+
+
+def _find_on_shard(session, message_ids):
+    found = {msg.id: msg for msg in
+             session.query(Message).filter(Message.id.in_(message_ids))}
+    missing = [msg_id for msg_id in message_ids if msg_id not in found]
+    if missing:
+        found.update((msg.id, msg) for msg in
+                     session.query(ArchivedMessage).filter(
+                         ArchivedMessage.id.in_(missing)))
+    return found
+
+
+def find_messages(message_ids):
+    """Messages for `message_ids` from either table, in the given order."""
+
+    if not message_ids:
+        return []
+
+    found = {}
+    for part in shards.scatter(
+            lambda session: _find_on_shard(session, message_ids)):
+        found.update(part)
+
+    return shards.attach_users(
+        [found[msg_id] for msg_id in message_ids if msg_id in found])
+
+
+def user_timeline(user_id, limit=100):
+    """A user's newest `limit` messages, reading the archive only if the
+    hot table doesn't have enough.
+    """
+
+    session = shards.session_for_user(user_id)
+    messages = (session
+                .query(Message)
+                .filter(Message.user_id == user_id)
+                .order_by(Message.id.desc())
+                .limit(limit)
+                .all())
+
+    if len(messages) < limit:
+        messages += (session
+                     .query(ArchivedMessage)
+                     .filter(ArchivedMessage.user_id == user_id)
+                     .order_by(ArchivedMessage.id.desc())
+                     .limit(limit - len(messages))
+                     .all())
+
+    return shards.attach_users(messages)
@@ -0,0 +1,212 @@
+"""Username and email availability checks.
+
+Signup used to find out a username was taken only when the INSERT failed,
+after paying for a bcrypt hash, and profile edits checked the password
+before anything else. `is_available()` answers first, so a conflicting
+submission is turned away before it reaches bcrypt.
+
+Names compare case-insensitively, backed by unique indexes on
+`lower(username)` and `lower(email)`. Each process keeps a Bloom filter
+of every lowercased username and email. Most names people try are free,
+and for those the filter answers with no query at all. A "maybe taken"
+answer falls through to one indexed lookup.
+
+The filter only grows. Names set by other processes, on signup or by a
+rename, are picked up every AVAILABILITY_SYNC_SECONDS by reading users
+whose `names_changed_at` is past the last sync. Each sync reaches back
+SYNC_OVERLAP_SECONDS further, for clock skew between app servers and
+transactions that commit late. The whole filter is rebuilt every
+AVAILABILITY_REBUILD_SECONDS, in a background thread, to drop names that
+were given up. Until a process's first build finishes, every name falls
+through to the database. In the short window before a sync the unique
+indexes still catch duplicates.
+"""
+
+from datetime import datetime, timedelta
+import hashlib
+import logging
+import math
+from threading import Lock, Thread
+import time
+
+from flask import current_app
+
+from models import db, User
+
+logger = logging.getLogger(__name__)
+
+CAPACITY = 1000000
+ERROR_RATE = 0.01
+SYNC_SECONDS = 5
+SYNC_OVERLAP_SECONDS = 60
+REBUILD_SECONDS = 600
+
+
+def normalize(name):
+    return name.lower()
+
+
+class BloomFilter:
+    """Set membership with no false negatives and about `error_rate` false
+    positives up to `capacity` items.
+    """
+
+    def __init__(self, capacity=CAPACITY, error_rate=ERROR_RATE):
+        self.size = max(8, int(-capacity * math.log(error_rate) /
+                               math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        # double hashing: k positions from two 64-bit halves of one digest
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(item))
+
+
+class TakenNames:
+    """Per-process Bloom filter of taken usernames and emails."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget everything; the next check rebuilds from the database."""
+
+        with self._lock:
+            self._filter = None
+            # names changed before this (less the overlap) are in the filter
+            self._synced_through = None
+            self._synced_at = 0.0
+            self._built_at = 0.0
+            self._building = False
+
+    def _add(self, username, email):
+        self._filter.add('username:' + normalize(username))
+        self._filter.add('email:' + normalize(email))
+
+    def _rebuild(self):
+        config = current_app.config
+        started = datetime.utcnow()
+        bloom = BloomFilter(
+            config.get('AVAILABILITY_BLOOM_CAPACITY', CAPACITY),
+            config.get('AVAILABILITY_BLOOM_ERROR_RATE', ERROR_RATE))
+        for username, email in db.session.query(User.username, User.email):
+            bloom.add('username:' + normalize(username))
+            bloom.add('email:' + normalize(email))
+
+        now = time.monotonic()
+        with self._lock:
+            self._filter = bloom
+            self._synced_through = started
+            self._synced_at = self._built_at = now
+            self._building = False
+
+    def _rebuild_in_background(self):
+        with self._lock:
+            if self._building:
+                return
+            self._building = True
+
+        app = current_app._get_current_object()
+
+        def run():
+            with app.app_context():
+                try:
+                    self._rebuild()
+                except Exception:
+                    logger.exception("Couldn't rebuild the taken names filter")
+                    with self._lock:
+                        self._building = False
+                finally:
+                    db.session.remove()
+
+        Thread(target=run, name='taken-names', daemon=True).start()
+
+    def _sync(self):
+        """Add names set (by any process) since the last sync."""
+
+        started = datetime.utcnow()
+        since = self._synced_through - timedelta(seconds=SYNC_OVERLAP_SECONDS)
+        rows = (db.session.query(User.username, User.email)
+                .filter(User.names_changed_at >= since)
+                .all())
+        with self._lock:
+            for username, email in rows:
+                self._add(username, email)
+            self._synced_through = max(self._synced_through, started)
+            self._synced_at = time.monotonic()
+
+    def ensure_current(self):
+        config = current_app.config
+        now = time.monotonic()
+        if self._filter is None or now - self._built_at > config.get(
+                'AVAILABILITY_REBUILD_SECONDS', REBUILD_SECONDS):
+            if config.get('AVAILABILITY_BACKGROUND_REBUILD', True):
+                self._rebuild_in_background()
+            else:
+                self._rebuild()
+        # the old filter keeps syncing while a new one is built
+        sync_seconds = config.get('AVAILABILITY_SYNC_SECONDS', SYNC_SECONDS)
+        if (self._filter is not None and
+                time.monotonic() - self._synced_at > sync_seconds):
+            self._sync()
+
+    def add(self, username, email):
+        """Record names taken by a signup or profile edit in this process."""
+
+        with self._lock:
+            if self._filter is not None:
+                self._add(username, email)
+
+    def might_be_taken(self, kind, name):
+        self.ensure_current()
+        bloom = self._filter
+        # not built yet: only the database knows
+        return bloom is None or f'{kind}:{normalize(name)}' in bloom
+
+
+taken_names = TakenNames()
+
+COLUMNS = {
+    'username': User.username,
+    'email': User.email,
+}
+
+
+def is_available(kind, name, except_user_id=None):
+    """Is `name` free to use as a 'username' or 'email'?
+
+    `except_user_id` lets a user keep their own name in another case.
+    """
+
+    if not taken_names.might_be_taken(kind, name):
+        return True
+
+    column = COLUMNS[kind]
+    query = db.session.query(User.id).filter(
+        db.func.lower(column) == normalize(name))
+    if except_user_id is not None:
+        query = query.filter(User.id != except_user_id)
+    return not db.session.query(query.exists()).scalar()
+
+
+def conflicts(username, email, except_user_id=None):
+    """Error messages for whichever of `username` and `email` are taken."""
+
+    errors = []
+    if not is_available('username', username, except_user_id):
+        errors.append("Username already taken")
+    if not is_available('email', email, except_user_id):
+        errors.append("Email already registered")
+    return errors
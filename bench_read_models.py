@@ -0,0 +1,120 @@
+"""Compare ORM and read-model loading for the hot read paths.
+
+Runs against an existing database (e.g. one filled by seed.py). For the
+users with the most followees it loads each page's rows both ways, the way
+the templates use them, and reports wall time and peak Python memory
+(from tracemalloc) per page load. The ORM side is the relationship-based
+code these pages used before, so run it on an unsharded database:
+
+    python bench_read_models.py --runs 20 --config development
+
+- timeline: home timeline of 100 messages with their authors
+- profile: a user's newest 100 messages
+- likes: a user's liked messages
+- following: follow cards
+"""
+
+import argparse
+import statistics
+import time
+import tracemalloc
+
+from app import create_app
+from follow_graph import follow_graph
+from models import db, User
+from timeline_cache import RecentMessagesCache, load_messages
+import archive
+import read_models
+
+
+def _touch_messages(messages):
+    # what the timeline templates read of each row
+    for msg in messages:
+        (msg.id, msg.text, msg.timestamp, msg.user.id, msg.user.username,
+         msg.user.image_url)
+
+
+def _touch_cards(users):
+    for user in users:
+        (user.id, user.username, user.image_url, user.header_image_url,
+         user.bio)
+
+
+# each takes the page's (freshly loaded) user and timeline ids
+ORM_PATHS = {
+    'timeline': lambda user, ids: _touch_messages(load_messages(ids)),
+    'profile': lambda user, ids: _touch_messages(
+        archive.user_timeline(user.id, limit=100)),
+    'likes': lambda user, ids: _touch_messages(user.likes),
+    'following': lambda user, ids: _touch_cards(user.following),
+}
+
+READ_MODEL_PATHS = {
+    'timeline': lambda user, ids: _touch_messages(
+        read_models.messages_by_ids(ids)),
+    'profile': lambda user, ids: _touch_messages(
+        read_models.user_messages(user.id, limit=100)),
+    'likes': lambda user, ids: _touch_messages(
+        read_models.liked_messages(user.id)[0]),
+    'following': lambda user, ids: _touch_cards(
+        read_models.following_cards(user.id)),
+}
+
+
+def measure(fn, user_id, timeline_ids):
+    """(seconds, peak bytes) of one call, starting from an empty session
+    with just the user loaded, as a request would.
+    """
+
+    db.session.expunge_all()
+    user = User.query.get(user_id)
+    tracemalloc.start()
+    start = time.perf_counter()
+    fn(user, timeline_ids)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--users', type=int, default=5,
+                        help="Benchmark this many of the busiest users.")
+    parser.add_argument('--config', default='development')
+    args = parser.parse_args()
+
+    app = create_app(args.config)
+    with app.app_context():
+        follow_graph.ensure_loaded()
+        user_ids = sorted(
+            (user_id for user_id, in db.session.query(User.id)),
+            key=follow_graph.following_count, reverse=True)[:args.users]
+        timelines = {
+            user_id: RecentMessagesCache().timeline_ids(
+                follow_graph.following_ids(user_id), limit=100)
+            for user_id in user_ids}
+
+        results = {}
+        for _ in range(args.runs):
+            for user_id in user_ids:
+                for label, paths in (('orm', ORM_PATHS),
+                                     ('read model', READ_MODEL_PATHS)):
+                    for page, fn in paths.items():
+                        results.setdefault(page, {}).setdefault(
+                            label, []).append(
+                                measure(fn, user_id, timelines[user_id]))
+
+    print(f"{len(user_ids)} users, {args.runs} runs")
+    for page, by_label in results.items():
+        print(f"{page}:")
+        for label, samples in by_label.items():
+            seconds = statistics.median(sample[0] for sample in samples)
+            peak = statistics.median(sample[1] for sample in samples)
+            print(f"  {label:<10} median {seconds * 1000:7.2f}ms  "
+                  f"peak {peak / 1024:8.1f}KB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Measure how long a fresh process takes to get a usable Warbler app.
+
+Each run starts a new Python interpreter (so nothing is already imported),
+imports `app`, calls `create_app()` for the given config and reports the
+wall time and peak memory of that process. Run it like:
+
+    python bench_startup.py --runs 10 --config production
+    python bench_startup.py --models-only
+
+With the production config every template is loaded at startup, so run
+`flask compile-templates` first to time a worker of a built deploy.
+
+`--models-only` times importing just `models`, which is what seed scripts
+and CLI jobs that don't serve requests need.
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+CHILD = r"""
+import json, resource, sys, time
+start = time.perf_counter()
+compiles = 0
+if {models_only!r}:
+    import models
+else:
+    from app import create_app
+    from template_cache import template_stats
+    create_app({config!r})
+    compiles = sum(entry['compiles']
+                   for entry in template_stats.stats().values())
+elapsed = time.perf_counter() - start
+peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({{"seconds": elapsed, "peak_kb": peak_kb,
+                  "modules": len(sys.modules), "compiles": compiles}}))
+"""
+
+
+def measure(config, models_only):
+    code = CHILD.format(config=config, models_only=models_only)
+    out = subprocess.run([sys.executable, '-c', code], check=True,
+                         stdout=subprocess.PIPE, universal_newlines=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--config', default='production')
+    parser.add_argument('--models-only', action='store_true')
+    args = parser.parse_args()
+
+    results = [measure(args.config, args.models_only)
+               for _ in range(args.runs)]
+    seconds = [result['seconds'] for result in results]
+    peak_kb = [result['peak_kb'] for result in results]
+
+    target = 'models' if args.models_only else f"create_app({args.config!r})"
+    print(f"{target}: {args.runs} runs")
+    print(f"  time     median {statistics.median(seconds) * 1000:7.1f}ms  "
+          f"min {min(seconds) * 1000:7.1f}ms  "
+          f"max {max(seconds) * 1000:7.1f}ms")
+    print(f"  peak rss median {statistics.median(peak_kb) / 1024:7.1f}MB")
+    print(f"  modules  {results[0]['modules']}")
+    if not args.models_only:
+        # nonzero with TEMPLATE_PRELOAD means the bytecode cache is stale;
+        # run `flask compile-templates`
+        print(f"  template compiles {results[-1]['compiles']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+"""Bulk message ingest for integrations and backfills.
+
+`messages_add()` posts one warble per request and commit. `ingest()` takes
+many at once: it validates every text in one pass, inserts the valid ones
+with a single executemany per chunk (one transaction per chunk), and then
+refreshes the timeline cache once per chunk and author rather than once per
+message. Tags and mentions are indexed in the same transaction as their
+chunk.
+
+Messages with their own timestamp get a backdated id (see snowflake.py),
+so they sort into timelines by that timestamp rather than by import time.
+
+Input is read one chunk at a time, so a large import never sits in memory
+whole. Bad rows, including lines that aren't JSON and authors that don't
+exist, are reported by index and skipped; they never abort the import.
+"""
+
+from datetime import datetime, timezone
+from itertools import islice
+import json
+from types import SimpleNamespace
+
+from cache import cache, messages_tag
+from models import db, Message, User
+from snowflake import MIN_BACKDATE, BackdatedIds, next_id
+from timeline_cache import recent_messages
+import shards
+import tagging
+
+MAX_LENGTH = 140
+CHUNK_SIZE = 500
+
+
+def _timestamp_error(value):
+    """Why `value` can't be a message's timestamp, or None if it can."""
+
+    if not value:
+        return None
+    try:
+        value = _parse_timestamp(value, None)
+    except (TypeError, ValueError):
+        return "timestamp is not ISO 8601"
+    if value < MIN_BACKDATE:
+        return f"timestamp is before {MIN_BACKDATE.year}"
+    if value > datetime.utcnow():
+        return "timestamp is in the future"
+    return None
+
+
+class InvalidLine:
+    """Stands in for an input line that couldn't be parsed."""
+
+    def __init__(self, reason):
+        self.reason = reason
+
+
+def validate(rows, require_user_id=False):
+    """Split `rows` (dicts with a 'text' key) into valid rows and errors.
+
+    Errors are (index, reason) pairs, indexed into `rows`.
+    """
+
+    valid, errors = _validate_indexed(rows, require_user_id)
+    return [row for index, row in valid], errors
+
+
+def _valid_user_id(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _validate_indexed(rows, require_user_id):
+    """Like `validate()`, but valid rows come as (index, row) pairs."""
+
+    texts = [row.get('text') if isinstance(row, dict) else None
+             for row in rows]
+    lengths = [len(text.strip()) if isinstance(text, str) else -1
+               for text in texts]
+
+    valid = []
+    errors = []
+    for index, (row, length) in enumerate(zip(rows, lengths)):
+        timestamp_error = (None if length < 0 else
+                           _timestamp_error(row.get('timestamp')))
+        if isinstance(row, InvalidLine):
+            errors.append((index, row.reason))
+        elif length < 0:
+            errors.append((index, "text is required"))
+        elif require_user_id and row.get('user_id') is None:
+            errors.append((index, "user_id is required"))
+        elif require_user_id and not _valid_user_id(row['user_id']):
+            errors.append((index, "user_id is not an integer"))
+        elif length == 0:
+            errors.append((index, "text is empty"))
+        elif length > MAX_LENGTH:
+            errors.append((index, f"text is over {MAX_LENGTH} characters"))
+        elif timestamp_error:
+            errors.append((index, timestamp_error))
+        else:
+            valid.append((index, row))
+
+    return valid, errors
+
+
+def _known_authors(valid):
+    """Split (index, row) pairs into those whose user_id is an active user
+    and errors for the rest.
+    """
+
+    user_ids = {row['user_id'] for index, row in valid}
+    known = {row[0] for row in User.active().filter(User.id.in_(user_ids))
+             .with_entities(User.id)}
+    return ([(index, row) for index, row in valid if row['user_id'] in known],
+            [(index, "unknown user_id") for index, row in valid
+             if row['user_id'] not in known])
+
+
+def _parse_timestamp(value, default):
+    """`value` as a naive UTC datetime; times with an offset are converted."""
+
+    if not value:
+        return default
+    if not isinstance(value, datetime):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def ingest(rows, user_id=None, chunk_size=CHUNK_SIZE):
+    """Insert messages from `rows`, `chunk_size` per transaction.
+
+    Each row is a dict with 'text' and optionally 'timestamp' (ISO 8601)
+    and 'user_id'. If `user_id` is given it overrides any per-row author,
+    which is how the API endpoint pins messages to the logged-in user.
+
+    `rows` can be any iterable; it's consumed `chunk_size` rows at a time.
+    Returns (number inserted, list of (index, reason) errors).
+    """
+
+    rows = iter(rows)
+    inserted = 0
+    errors = []
+    offset = 0
+    backdated_ids = BackdatedIds()
+
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return inserted, errors
+
+        valid, chunk_errors = _validate_indexed(
+            chunk, require_user_id=user_id is None)
+        if user_id is None and valid:
+            valid, unknown = _known_authors(valid)
+            chunk_errors = sorted(chunk_errors + unknown)
+        errors.extend((offset + index, reason)
+                      for index, reason in chunk_errors)
+        offset += len(chunk)
+
+        if valid:
+            inserted += _insert([row for index, row in valid], user_id,
+                                backdated_ids)
+
+
+def _insert(chunk, user_id, backdated_ids):
+    """Insert one chunk of valid rows in one transaction per database.
+    Returns the number inserted.
+    """
+
+    now = datetime.utcnow()
+
+    values = []
+    for row in chunk:
+        timestamp = row.get('timestamp')
+        if timestamp:
+            timestamp = _parse_timestamp(timestamp, now)
+            msg_id = backdated_ids(timestamp)
+        else:
+            timestamp, msg_id = now, next_id()
+        values.append({
+            'id': msg_id,
+            'text': row['text'].strip(),
+            'timestamp': timestamp,
+            'user_id': user_id if user_id is not None else row['user_id'],
+        })
+
+    by_shard = {}
+    for value in values:
+        by_shard.setdefault(shards.shard_for_user(value['user_id']),
+                            []).append(value)
+    for shard, shard_values in by_shard.items():
+        shards.session(shard).execute(Message.__table__.insert(),
+                                      shard_values)
+    tagging.index_messages(
+        [SimpleNamespace(**value) for value in values])
+    for shard in by_shard:
+        shards.session(shard).commit()
+    db.session.commit()
+
+    # one cache refresh per author per chunk; the next timeline read
+    # reloads their newest messages in a single query
+    authors = {value['user_id'] for value in values}
+    for author_id in authors:
+        recent_messages.forget(author_id)
+    cache.invalidate(*[messages_tag(author_id) for author_id in authors])
+
+    return len(values)
+
+
+def read_jsonl(lines):
+    """Parse JSON Lines, yielding one value per non-blank line, or an
+    `InvalidLine` for a line that isn't JSON.
+    """
+
+    for line in lines:
+        line = line.strip()
+        if line:
+            try:
+                yield json.loads(line)
+            except ValueError as exc:
+                yield InvalidLine(f"not valid JSON: {exc}")
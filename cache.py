@@ -0,0 +1,681 @@
+"""Cache shared by every worker process, with pluggable backends.
+
+`cache` is set up by `create_app()` (like `db`) and used the same way
+everywhere:
+
+    counts = cache.get_or_set(f"user-counts:{user_id}", load_counts,
+                              tags=[messages_tag(user_id)])
+    ...
+    cache.invalidate(messages_tag(user_id))
+
+CACHE_BACKEND picks where entries live:
+
+- 'local': an LRU dict in this process, bounded by CACHE_MAX_ENTRIES. Fine
+  for one process and for tests; separate gunicorn workers won't see each
+  other's entries or invalidations.
+- 'file': one file per key under CACHE_DIR, shared by every process on the
+  host, bounded by CACHE_MAX_BYTES (least recently written go first).
+- 'redis': anything that speaks the Redis protocol at CACHE_URL, shared by
+  every host. Bound it with Redis's own maxmemory. `flask cache-server`
+  runs a small stand-in backed by the 'local' backend.
+
+Values are JSON. Tags work by versioning: each tag has a random version
+token, every entry records the tokens of its tags when it was computed,
+and `invalidate()` gives the tag a new token, so entries carrying the old
+one read as misses. `get_or_set()` lets only one caller (per process, and
+across processes by way of a short-lived lock key) recompute a missing
+entry while the others wait for its result.
+
+A backend that fails (e.g. Redis is down) counts an error and behaves as
+a miss; the cache never takes a request down with it. Hit, miss and error
+counts for this process are shown at /admin/cache.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import hashlib
+import json
+import logging
+import os
+import socket
+import socketserver
+import struct
+from threading import Lock, local
+import time
+from urllib.parse import urlparse
+
+from flask import current_app
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'warbler:'
+DEFAULT_TTL = 300
+LOCK_TTL = 10
+LOCK_WAIT = 2.0
+LOCK_POLL = 0.05
+
+_MISSING = object()
+
+
+class CacheError(Exception):
+    """A backend couldn't complete a request."""
+
+
+##############################################################################
+# Backends: bytes in, bytes out
+
+
+class LocalBackend:
+    """Size-bounded LRU in this process."""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def _live(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at and expires_at <= now:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def get(self, key):
+        with self._lock:
+            return self._live(key, time.time())
+
+    def get_many(self, keys):
+        with self._lock:
+            now = time.time()
+            return [self._live(key, now) for key in keys]
+
+    def _store(self, key, value, ttl):
+        self._entries[key] = (time.time() + ttl if ttl else 0, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._store(key, value, ttl)
+
+    def add(self, key, value, ttl=None):
+        """Set `key` only if it isn't already set. Returns True if set."""
+
+        with self._lock:
+            if self._live(key, time.time()) is not None:
+                return False
+            self._store(key, value, ttl)
+            return True
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class FileBackend:
+    """One file per key under `directory`, shared by local processes.
+
+    Each file is an 8-byte expiry time followed by the value. Writes go to a
+    temporary file that is renamed into place, so readers never see half a
+    value.
+    """
+
+    HEADER = struct.Struct('>d')
+    PRUNE_EVERY = 200
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._writes = 0
+        self._lock = Lock()
+
+    def _path(self, key):
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as entry:
+                data = entry.read()
+        except FileNotFoundError:
+            return None
+
+        expires_at, = self.HEADER.unpack_from(data)
+        if expires_at and expires_at <= time.time():
+            self._unlink(path)
+            return None
+        return data[self.HEADER.size:]
+
+    def get_many(self, keys):
+        return [self.get(key) for key in keys]
+
+    def _write_tmp(self, path, value, ttl):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{id(value)}.tmp"
+        with open(tmp_path, 'wb') as tmp:
+            tmp.write(self.HEADER.pack(time.time() + ttl if ttl else 0))
+            tmp.write(value)
+        return tmp_path
+
+    def set(self, key, value, ttl=None):
+        path = self._path(key)
+        os.replace(self._write_tmp(path, value, ttl), path)
+        self._wrote()
+
+    def add(self, key, value, ttl=None):
+        path = self._path(key)
+        if self.get(key) is None:
+            # expired leftovers would make the link below fail
+            self._unlink(path)
+
+        tmp_path = self._write_tmp(path, value, ttl)
+        try:
+            # link() refuses to replace an existing file, so only one
+            # process can win
+            os.link(tmp_path, path)
+        except FileExistsError:
+            return False
+        finally:
+            self._unlink(tmp_path)
+
+        self._wrote()
+        return True
+
+    def delete(self, *keys):
+        for key in keys:
+            self._unlink(self._path(key))
+
+    def clear(self):
+        for path, size, mtime in self._files():
+            self._unlink(path)
+
+    def _unlink(self, path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def _files(self):
+        if not os.path.isdir(self.directory):
+            return
+        for shard in os.scandir(self.directory):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                yield entry.path, stat.st_size, stat.st_mtime
+
+    def _wrote(self):
+        with self._lock:
+            self._writes += 1
+            if self._writes % self.PRUNE_EVERY:
+                return
+        self.prune()
+
+    def prune(self):
+        """Remove the oldest entries until the directory is back under 90%
+        of `max_bytes`. Returns the number removed.
+        """
+
+        files = sorted(self._files(), key=lambda item: item[2])
+        total = sum(size for path, size, mtime in files)
+        target = self.max_bytes * 0.9
+        removed = 0
+
+        for path, size, mtime in files:
+            if total <= target:
+                break
+            self._unlink(path)
+            total -= size
+            removed += 1
+
+        return removed
+
+
+class RedisBackend:
+    """Minimal Redis protocol (RESP) client, one connection per thread."""
+
+    def __init__(self, url='redis://localhost:6379/0', timeout=1.0):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or 6379
+        self.db = int(parsed.path.lstrip('/') or 0)
+        self.timeout = timeout
+        self._local = local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            sock = socket.create_connection((self.host, self.port),
+                                            timeout=self.timeout)
+            conn = self._local.conn = (sock, sock.makefile('rb'))
+            if self.db:
+                self._roundtrip(conn, 'SELECT', self.db)
+        return conn
+
+    def execute(self, *args):
+        conn = self._connection()
+        try:
+            return self._roundtrip(conn, *args)
+        except OSError:
+            # drop the connection; the next command reconnects
+            self._local.conn = None
+            conn[0].close()
+            raise
+
+    def _roundtrip(self, conn, *args):
+        sock, reader = conn
+        sock.sendall(encode_command(args))
+        return read_reply(reader)
+
+    def get(self, key):
+        return self.execute('GET', key)
+
+    def get_many(self, keys):
+        return self.execute('MGET', *keys) if keys else []
+
+    def set(self, key, value, ttl=None):
+        if ttl:
+            self.execute('SET', key, value, 'PX', int(ttl * 1000))
+        else:
+            self.execute('SET', key, value)
+
+    def add(self, key, value, ttl=None):
+        args = ['SET', key, value, 'NX']
+        if ttl:
+            args += ['PX', int(ttl * 1000)]
+        return self.execute(*args) is not None
+
+    def delete(self, *keys):
+        if keys:
+            self.execute('DEL', *keys)
+
+    def clear(self):
+        """Empty the whole Redis database; give the cache its own."""
+
+        self.execute('FLUSHDB')
+
+
+def _to_bytes(arg):
+    if isinstance(arg, bytes):
+        return arg
+    return str(arg).encode('utf-8')
+
+
+def encode_command(args):
+    """RESP array of bulk strings for `args`."""
+
+    parts = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        arg = _to_bytes(arg)
+        parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+    return b''.join(parts)
+
+
+def read_reply(reader):
+    """Read one RESP reply from a binary file-like `reader`."""
+
+    line = reader.readline()
+    if not line.endswith(b'\r\n'):
+        raise ConnectionError("connection closed")
+    kind, rest = line[:1], line[1:-2]
+
+    if kind == b'+':
+        return rest.decode('utf-8')
+    if kind == b'-':
+        raise CacheError(rest.decode('utf-8'))
+    if kind == b':':
+        return int(rest)
+    if kind == b'$':
+        length = int(rest)
+        if length < 0:
+            return None
+        data = reader.read(length + 2)
+        return data[:-2]
+    if kind == b'*':
+        count = int(rest)
+        if count < 0:
+            return None
+        return [read_reply(reader) for _ in range(count)]
+
+    raise CacheError(f"bad reply: {line!r}")
+
+
+##############################################################################
+# Redis-protocol stand-in
+
+
+class _RespHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        while True:
+            try:
+                args = read_reply(self.rfile)
+            except (ConnectionError, CacheError, ValueError):
+                return
+            if not isinstance(args, list) or not args:
+                return
+            self.wfile.write(self.server.dispatch(args))
+
+    def finish(self):
+        try:
+            super().finish()
+        except OSError:
+            pass
+
+
+def _bulk(value):
+    if value is None:
+        return b'$-1\r\n'
+    return b'$%d\r\n%s\r\n' % (len(value), value)
+
+
+class RespServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """Serve a `LocalBackend` over the Redis protocol.
+
+    Supports just the commands `RedisBackend` sends, so a multi-worker
+    deployment (or a test) can share a cache without a real Redis.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, backend=None):
+        self.backend = backend or LocalBackend()
+        super().__init__(address, _RespHandler)
+
+    def dispatch(self, args):
+        command = args[0].decode('ascii', 'replace').upper()
+        keys = [arg.decode('utf-8') for arg in args[1:]]
+
+        if command == 'PING':
+            return b'+PONG\r\n'
+        if command in ('SELECT', 'FLUSHDB'):
+            if command == 'FLUSHDB':
+                self.backend.clear()
+            return b'+OK\r\n'
+        if command == 'GET' and len(args) == 2:
+            return _bulk(self.backend.get(keys[0]))
+        if command == 'MGET':
+            values = self.backend.get_many(keys)
+            return b'*%d\r\n' % len(values) + b''.join(map(_bulk, values))
+        if command == 'DEL':
+            self.backend.delete(*keys)
+            return b':%d\r\n' % len(keys)
+        if command == 'SET' and len(args) >= 3:
+            options = [arg.upper() for arg in keys[2:]]
+            ttl = None
+            if 'PX' in options:
+                ttl = int(options[options.index('PX') + 1]) / 1000
+            elif 'EX' in options:
+                ttl = int(options[options.index('EX') + 1])
+            if 'NX' in options:
+                stored = self.backend.add(keys[0], args[2], ttl)
+                return b'+OK\r\n' if stored else b'$-1\r\n'
+            self.backend.set(keys[0], args[2], ttl)
+            return b'+OK\r\n'
+
+        return b'-ERR unsupported command\r\n'
+
+
+##############################################################################
+# The cache
+
+
+def make_backend(config):
+    """Build the backend named by CACHE_BACKEND in `config`."""
+
+    name = config.get('CACHE_BACKEND', 'local')
+
+    if name == 'local':
+        return LocalBackend(max_entries=config.get('CACHE_MAX_ENTRIES', 10000))
+    if name == 'file':
+        return FileBackend(config.get('CACHE_DIR', 'cache'),
+                           max_bytes=config.get('CACHE_MAX_BYTES',
+                                                256 * 1024 * 1024))
+    if name == 'redis':
+        return RedisBackend(config.get('CACHE_URL',
+                                       'redis://localhost:6379/0'))
+
+    raise ValueError(f"Unknown CACHE_BACKEND: {name}")
+
+
+class Cache:
+    """Tagged, single-flight cache over the app's backend."""
+
+    COUNTERS = ('hits', 'misses', 'stale', 'sets', 'invalidations',
+                'computes', 'waits', 'errors')
+
+    def __init__(self, app=None):
+        # key -> [lock, number of callers using it]
+        self._locks = {}
+        self._locks_lock = Lock()
+        self._stats_lock = Lock()
+        self._counts = dict.fromkeys(self.COUNTERS, 0)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['cache'] = make_backend(app.config)
+
+    @property
+    def backend(self):
+        return current_app.extensions['cache']
+
+    def _count(self, name, n=1):
+        with self._stats_lock:
+            self._counts[name] += n
+
+    def stats(self):
+        """Counters for this process, plus the hit rate."""
+
+        with self._stats_lock:
+            stats = dict(self._counts)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+    def _call(self, method, *args, default=None):
+        try:
+            return getattr(self.backend, method)(*args)
+        except (OSError, CacheError):
+            logger.warning("Cache %s failed", method, exc_info=True)
+            self._count('errors')
+            return default
+
+    def _tag_versions(self, tags):
+        """Current version token of each tag, creating any that are missing."""
+
+        if not tags:
+            return {}
+
+        keys = [KEY_PREFIX + 'tag:' + tag for tag in tags]
+        values = self._call('get_many', keys, default=None)
+        if values is None:
+            return None
+
+        versions = {}
+        for tag, key, value in zip(tags, keys, values):
+            if value is None:
+                value = os.urandom(8).hex().encode('ascii')
+                if not self._call('add', key, value, None, default=False):
+                    # someone else created it first (or the backend failed)
+                    value = self._call('get', key)
+            if value is None:
+                return None
+            versions[tag] = value.decode('ascii')
+        return versions
+
+    def tag_versions(self, tags):
+        """{tag: current version token}, or None if the backend failed.
+
+        Lets per-process state notice that another process invalidated a
+        tag: remember the token when loading, and compare later.
+        """
+
+        return self._tag_versions(list(tags))
+
+    def tag_version(self, tag):
+        """Current version token of one tag, or None."""
+
+        versions = self._tag_versions([tag])
+        return None if versions is None else versions[tag]
+
+    def get(self, key, default=None):
+        """Cached value for `key`, or `default` if missing or stale."""
+
+        value = self._get(key)
+        return default if value is _MISSING else value
+
+    def _get(self, key, count=True):
+        raw = self._call('get', KEY_PREFIX + key)
+        if raw is None:
+            if count:
+                self._count('misses')
+            return _MISSING
+
+        entry = json.loads(raw)
+        tags = entry.get('t')
+        if tags and self._tag_versions(list(tags)) != tags:
+            if count:
+                self._count('misses')
+                self._count('stale')
+            return _MISSING
+
+        if count:
+            self._count('hits')
+        return entry['v']
+
+    def set(self, key, value, ttl=None, tags=()):
+        """Store a JSON-serializable `value` under `key`."""
+
+        self._store(key, value, ttl, self._tag_versions(list(tags)))
+
+    def _store(self, key, value, ttl, versions):
+        if versions is None:
+            return
+        ttl = ttl or current_app.config.get('CACHE_DEFAULT_TTL', DEFAULT_TTL)
+        raw = json.dumps({'v': value, 't': versions}).encode('utf-8')
+        self._call('set', KEY_PREFIX + key, raw, ttl)
+        self._count('sets')
+
+    def delete(self, *keys):
+        self._call('delete', *[KEY_PREFIX + key for key in keys])
+
+    def invalidate(self, *tags):
+        """Make every entry carrying any of `tags` a miss."""
+
+        for tag in tags:
+            self._call('set', KEY_PREFIX + 'tag:' + tag,
+                       os.urandom(8).hex().encode('ascii'), None)
+        self._count('invalidations', len(tags))
+
+    def clear(self):
+        self._call('clear')
+
+    @contextmanager
+    def _key_lock(self, key):
+        """Hold this process's lock for `key`; dropped when nobody uses it,
+        so a slow compute only holds up callers of the same key.
+        """
+
+        with self._locks_lock:
+            entry = self._locks.setdefault(key, [Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._locks_lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+
+    def get_or_set(self, key, compute, ttl=None, tags=()):
+        """Cached value for `key`, calling `compute()` to fill it on a miss.
+
+        Only one caller recomputes a given key at a time; the rest wait up
+        to LOCK_WAIT seconds for its result before computing it themselves.
+        """
+
+        value = self._get(key)
+        if value is not _MISSING:
+            return value
+
+        with self._key_lock(key):
+            value = self._get(key, count=False)
+            if value is not _MISSING:
+                self._count('waits')
+                return value
+
+            lock_key = KEY_PREFIX + 'lock:' + key
+            if not self._call('add', lock_key, b'1', LOCK_TTL, default=True):
+                # another process is computing it
+                deadline = time.monotonic() + LOCK_WAIT
+                while time.monotonic() < deadline:
+                    time.sleep(LOCK_POLL)
+                    value = self._get(key, count=False)
+                    if value is not _MISSING:
+                        self._count('waits')
+                        return value
+
+            try:
+                # read tag versions first, so an invalidation that lands
+                # while computing marks the result stale
+                versions = self._tag_versions(list(tags))
+                value = compute()
+                self._count('computes')
+                self._store(key, value, ttl, versions)
+            finally:
+                self._call('delete', lock_key)
+
+        return value
+
+
+cache = Cache()
+
+
+def user_tag(user_id):
+    """Anything showing a user's profile fields (username, image, bio)."""
+
+    return f"user:{user_id}"
+
+
+def messages_tag(user_id):
+    """Anything depending on which messages a user has posted."""
+
+    return f"messages:{user_id}"
+
+
+def likes_tag(user_id):
+    """Anything depending on which messages a user has liked."""
+
+    return f"likes:{user_id}"
+
+
+def follows_tag():
+    """Anything depending on who follows whom."""
+
+    return "follows"
+
+
+def message_tag(message_id):
+    """Anything showing one message: its text, existence or like count."""
+
+    return f"message:{message_id}"
@@ -0,0 +1,299 @@
+"""`flask` CLI commands for maintenance and background work.
+
+Registered on the app by `create_app()`; run them with e.g.
+`FLASK_APP=app flask worker`.
+"""
+
+import os
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from account_deletion import purge_pending
+from jobs import run_worker, job_stats
+import archive
+import bulk_messages
+import export
+import notifications
+import profiler
+import shards
+import snowflake
+import tagging
+import template_cache
+
+
+@click.command('check-query-plans')
+@with_appcontext
+def check_query_plans_command():
+    """EXPLAIN each hot route's query and check it uses its index."""
+
+    from query_plans import check_query_plans
+
+    failures = 0
+    for name, index_name, used, plan in check_query_plans():
+        status = "ok" if used else "MISSING"
+        print(f"{status:8} {name}: {index_name}")
+        if not used:
+            failures += 1
+            print(plan)
+
+    if failures:
+        raise SystemExit(1)
+
+
+@click.command('purge-deleted-users')
+@with_appcontext
+def purge_deleted_users_command():
+    """Finish purging accounts whose background deletion didn't complete."""
+
+    for progress in purge_pending(
+            batch_size=current_app.config['ACCOUNT_PURGE_BATCH_SIZE'],
+            pause=current_app.config['ACCOUNT_PURGE_PAUSE']):
+        print(f"user {progress.user_id}: {progress.messages_deleted} messages, "
+              f"{progress.likes_deleted} likes, "
+              f"{progress.follows_deleted} follows deleted")
+
+
+@click.command('worker')
+@with_appcontext
+@click.option('--concurrency', default=1, help="Number of worker threads.")
+def worker_command(concurrency):
+    """Run background jobs until interrupted."""
+
+    run_worker(current_app._get_current_object(), concurrency=concurrency)
+
+
+@click.command('job-stats')
+@with_appcontext
+def job_stats_command():
+    """Show run counts and timings per job type."""
+
+    for name, status, count, avg_ms, max_ms in job_stats():
+        print(f"{name:20} {status:8} {count:6} "
+              f"avg {avg_ms or 0:8.1f}ms  max {max_ms or 0:8.1f}ms")
+
+
+@click.command('import-messages')
+@with_appcontext
+@click.argument('path', type=click.File('r'))
+@click.option('--chunk-size', default=bulk_messages.CHUNK_SIZE,
+              help="Messages inserted per transaction.")
+def import_messages_command(path, chunk_size):
+    """Import messages from a JSON Lines file.
+
+    Each line is an object with user_id, text and optional timestamp.
+    """
+
+    inserted, errors = bulk_messages.ingest(
+        bulk_messages.read_jsonl(path), chunk_size=chunk_size)
+
+    for index, reason in errors:
+        print(f"row {index + 1}: {reason}")
+    print(f"Imported {inserted} messages, rejected {len(errors)}.")
+
+
+@click.command('export-user')
+@with_appcontext
+@click.argument('user_id', type=int)
+@click.option('--format', 'fmt', default='jsonl',
+              type=click.Choice(sorted(export.FORMATS)))
+@click.option('--gzip', 'compress', is_flag=True, help="Gzip the output.")
+@click.option('--output', type=click.File('wb'), default='-')
+def export_user_command(user_id, fmt, compress, output):
+    """Write a user's messages, likes and follows to a file (or stdout)."""
+
+    for chunk in export.export_user(user_id, fmt, compress=compress):
+        output.write(chunk)
+
+
+@click.command('archive-messages')
+@with_appcontext
+@click.option('--days', type=int, help="Archive messages older than this.")
+def archive_messages_command(days):
+    """Move old, unliked messages to the archive table."""
+
+    moved = archive.archive_messages(
+        days=days or current_app.config['MESSAGE_ARCHIVE_AFTER_DAYS'],
+        batch_size=current_app.config['MESSAGE_ARCHIVE_BATCH_SIZE'])
+    print(f"Archived {moved} messages.")
+
+
+@click.command('backfill-tags')
+@with_appcontext
+@click.option('--chunk-size', default=tagging.BACKFILL_CHUNK_SIZE,
+              help="Messages per job.")
+def backfill_tags_command(chunk_size):
+    """Queue jobs that index #tags and @mentions in existing messages.
+
+    Run `flask worker --concurrency N` to work through them in parallel.
+    """
+
+    queued = tagging.backfill(chunk_size=chunk_size)
+    print(f"Queued {queued} index_messages jobs.")
+
+
+@click.command('deliver-notifications')
+@with_appcontext
+def deliver_notifications_command():
+    """Fold pending like/follow/mention events into notifications now."""
+
+    delivered = notifications.deliver(
+        batch_size=current_app.config['NOTIFICATION_BATCH_SIZE'])
+    print(f"Delivered {delivered} events.")
+
+
+@click.command('profile-token')
+@with_appcontext
+@click.option('--minutes', default=10, help="How long the token is valid.")
+def profile_token_command(minutes):
+    """Print an X-Warbler-Profile header value for profiling requests."""
+
+    secret = (current_app.config.get('PROFILE_SECRET') or
+              current_app.config['SECRET_KEY'])
+    token = profiler.sign_token(secret, time.time() + minutes * 60)
+    print(f"{profiler.HEADER}: {token}")
+
+
+@click.command('profile-report')
+@with_appcontext
+@click.option('--dir', 'directory', help="Profiles to read (PROFILE_DIR).")
+@click.option('--output', type=click.Path(file_okay=False),
+              help="Write one merged <endpoint>.folded per endpoint here.")
+@click.option('--top', default=5, help="Hottest frames to list per endpoint.")
+def profile_report_command(directory, output, top):
+    """Summarize sampled request profiles per endpoint."""
+
+    directory = directory or current_app.config['PROFILE_DIR']
+    merged = profiler.aggregate(directory)
+    if output:
+        os.makedirs(output, exist_ok=True)
+
+    by_samples = sorted(merged.items(),
+                        key=lambda item: -sum(item[1][1].values()))
+    for endpoint, (requests, counts) in by_samples:
+        samples = sum(counts.values())
+        print(f"{endpoint}: {requests} requests, {samples} samples")
+        for frame, count in profiler.top_frames(counts, top):
+            print(f"  {count / samples:6.1%}  {frame}")
+        if output:
+            with open(os.path.join(output, endpoint + profiler.SUFFIX),
+                      'w') as f:
+                profiler.write_collapsed(counts, f)
+
+
+@click.command('migrate-message-ids')
+@with_appcontext
+def migrate_message_ids_command():
+    """Renumber messages that still have serial ids to time-ordered ids.
+
+    Safe to interrupt and re-run. Restart the web workers afterwards, so
+    their timeline caches drop the old ids.
+    """
+
+    moved = snowflake.migrate_legacy_ids(
+        batch_size=current_app.config['MESSAGE_ID_MIGRATION_BATCH_SIZE'],
+        pause=current_app.config['MESSAGE_ID_MIGRATION_PAUSE'])
+    print(f"Renumbered {moved} messages.")
+
+
+@click.command('init-shards')
+@with_appcontext
+def init_shards_command():
+    """Create the message tables on every shard, upgrade likes tables made
+    before likes were keyed by user and message, and record the bucket map.
+
+    Safe to re-run; an existing map is left as it is.
+    """
+
+    upgraded = shards.create_tables()
+    if upgraded:
+        print(f"Upgraded likes on {upgraded} shards.")
+    if not shards.ShardBucket.query.first():
+        shards.save_map(shards.current().bucket_map())
+    print(f"{shards.count()} shards ready.")
+
+
+@click.command('rebalance-shards')
+@with_appcontext
+@click.option('--dry-run', is_flag=True, help="Only list the moves.")
+def rebalance_shards_command(dry_run):
+    """Spread user buckets evenly over the shards in MESSAGE_SHARDS.
+
+    Run after adding a shard. Each bucket's rows are copied, then the map
+    is switched; do this when traffic is quiet.
+    """
+
+    moves = shards.rebalance(dry_run=dry_run)
+    for bucket, from_shard, to_shard in moves:
+        print(f"bucket {bucket}: shard {from_shard} -> {to_shard}")
+    print(f"{'Would move' if dry_run else 'Moved'} {len(moves)} buckets.")
+
+
+@click.command('compile-templates')
+@with_appcontext
+@click.option('--clear', is_flag=True, help="Drop all cached bytecode first.")
+def compile_templates_command(clear):
+    """Compile every template into the bytecode cache.
+
+    Run at build time, from the directory the app runs in, so new workers
+    start without compiling any templates.
+    """
+
+    env = current_app.jinja_env
+    if env.bytecode_cache is None:
+        raise click.ClickException("TEMPLATE_CACHE_DIR is not set.")
+    if clear:
+        env.bytecode_cache.clear()
+
+    compiled, cached = template_cache.compile_templates(env)
+    print(f"Compiled {compiled} templates, {cached} already up to date.")
+
+
+@click.command('cache-server')
+@click.option('--host', default='127.0.0.1')
+@click.option('--port', default=6379)
+@click.option('--max-entries', default=100000)
+def cache_server_command(host, port, max_entries):
+    """Serve an in-memory cache over the Redis protocol.
+
+    A stand-in for Redis, so several workers can share CACHE_BACKEND=redis
+    during development.
+    """
+
+    from cache import RespServer, LocalBackend
+
+    server = RespServer((host, port), LocalBackend(max_entries=max_entries))
+    print(f"Cache listening on {host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+COMMANDS = [
+    check_query_plans_command,
+    purge_deleted_users_command,
+    worker_command,
+    job_stats_command,
+    import_messages_command,
+    export_user_command,
+    archive_messages_command,
+    backfill_tags_command,
+    deliver_notifications_command,
+    cache_server_command,
+    compile_templates_command,
+    migrate_message_ids_command,
+    init_shards_command,
+    rebalance_shards_command,
+    profile_token_command,
+    profile_report_command,
+]
+
+
+def register_commands(app):
+    """Add every command to `app.cli`."""
+
+    for command in COMMANDS:
+        app.cli.add_command(command)
@@ -0,0 +1,167 @@
+"""Configuration for each environment Warbler runs in.
+
+Pick one by name with `create_app('testing')`, or set `WARBLER_CONFIG`.
+"""
+
+import os
+
+
+class Config:
+    """Settings shared by every environment."""
+
+    # Get DB_URI from environ variable (useful for production/testing) or,
+    # if not set there, use development local db.
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL',
+                                             'postgresql:///warbler')
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+
+    SECRET_KEY = os.environ.get('SECRET_KEY', "it's a secret")
+
+    DEBUG_TB_INTERCEPT_REDIRECTS = False
+
+    ACCOUNT_PURGE_BATCH_SIZE = 500
+    ACCOUNT_PURGE_PAUSE = 0.05
+
+    BULK_MESSAGES_MAX = 10000
+
+    # a job whose worker hasn't renewed its claim for this long is requeued
+    JOB_LEASE_SECONDS = 300
+
+    NOTIFICATION_DELIVERY_DELAY = 5
+    NOTIFICATION_BATCH_SIZE = 1000
+
+    # directory for the cross-process live-update bus; unset means
+    # streams only see messages posted to the same process
+    LIVE_BUS_DIR = os.environ.get('LIVE_BUS_DIR')
+    LIVE_STREAM_SECONDS = 300
+
+    # how often each process checks whether another changed the follow
+    # graph (see follow_graph.py)
+    FOLLOW_GRAPH_SYNC_SECONDS = 5
+
+    # 'local' (this process only), 'file' (shared on this host) or 'redis'
+    CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'local')
+    CACHE_URL = os.environ.get('CACHE_URL', 'redis://localhost:6379/0')
+    CACHE_DIR = os.environ.get('CACHE_DIR', 'cache')
+    CACHE_DEFAULT_TTL = 300
+    CACHE_MAX_ENTRIES = 10000
+    CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+    # profile 1 in PROFILE_SAMPLE_RATE requests (0: only those sent with a
+    # signed X-Warbler-Profile header; see profiler.py)
+    PROFILE_SAMPLE_RATE = int(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+    PROFILE_SECRET = os.environ.get('PROFILE_SECRET')
+    PROFILE_INTERVAL = 0.005
+    PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+
+    # usernames allowed to see /admin pages
+    ADMIN_USERNAMES = [name for name in
+                       os.environ.get('ADMIN_USERNAMES', '').split(',') if name]
+
+    # record queries slower than this, with their plans (see slow_queries.py)
+    SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 250))
+    SLOW_QUERY_ANALYZE_RATE = 10
+    SLOW_QUERY_EXPLAIN_COOLDOWN = 60
+    SLOW_QUERY_BUFFER_SIZE = 200
+    SLOW_QUERY_LOG = os.environ.get('SLOW_QUERY_LOG')
+
+    MESSAGE_ARCHIVE_AFTER_DAYS = 30
+    MESSAGE_ARCHIVE_BATCH_SIZE = 1000
+
+    # pin this process's message id worker (0-511); unset leases a free one
+    SNOWFLAKE_WORKER_ID = (int(os.environ['SNOWFLAKE_WORKER_ID'])
+                           if os.environ.get('SNOWFLAKE_WORKER_ID') else None)
+    MESSAGE_ID_MIGRATION_BATCH_SIZE = 1000
+    MESSAGE_ID_MIGRATION_PAUSE = 0.05
+
+    # database URLs to spread messages and likes over, comma-separated
+    # (see shards.py); unset keeps them in the main database
+    MESSAGE_SHARDS = [url for url in
+                      os.environ.get('MESSAGE_SHARDS', '').split(',') if url]
+    SHARD_POOL_SIZE = 8
+    SHARD_MAP_TTL = 10
+
+    # concurrency limits per class of expensive route (see admission.py):
+    # `limit` at once per process, `queue` more waiting up to `wait` seconds
+    ADMISSION_CLASSES = {
+        'timeline': {'limit': 16, 'queue': 32, 'wait': 0.5},
+        'listing': {'limit': 4, 'queue': 8, 'wait': 0.5},
+        'password': {'limit': 4, 'queue': 16, 'wait': 1.0},
+        'delete': {'limit': 2, 'queue': 4, 'wait': 1.0},
+        'bulk': {'limit': 2, 'queue': 2, 'wait': 0},
+    }
+    ADMISSION_RETRY_AFTER = 2
+    # how long a rendered home timeline can stand in when its gate is full,
+    # and how often a user's copy is saved again as they keep viewing
+    ADMISSION_STALE_TTL = 300
+    ADMISSION_STALE_REFRESH = 60
+
+    # Bloom filter of taken usernames and emails (see availability.py)
+    AVAILABILITY_BLOOM_CAPACITY = 1000000
+    AVAILABILITY_BLOOM_ERROR_RATE = 0.01
+    AVAILABILITY_SYNC_SECONDS = 5
+    AVAILABILITY_REBUILD_SECONDS = 600
+    AVAILABILITY_BACKGROUND_REBUILD = True
+
+    # compiled templates, written by `flask compile-templates` (see
+    # template_cache.py); TEMPLATE_PRELOAD loads them all at startup
+    TEMPLATE_CACHE_DIR = os.environ.get('TEMPLATE_CACHE_DIR',
+                                        'template_cache')
+    TEMPLATE_PRELOAD = False
+
+    THUMBNAIL_DIR = os.environ.get('THUMBNAIL_DIR', 'thumbnails')
+    IMAGE_ORIGIN_DIR = os.environ.get('IMAGE_ORIGIN_DIR')
+    IMAGE_FETCH_REMOTE = bool(os.environ.get('IMAGE_FETCH_REMOTE'))
+
+
+class DevelopmentConfig(Config):
+    """Local development: debug toolbar on."""
+
+    DEBUG = True
+
+
+class TestingConfig(Config):
+    """Test runs: separate database, no CSRF, no debug toolbar."""
+
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL',
+                                             'postgresql:///warbler-test')
+    WTF_CSRF_ENABLED = False
+    ACCOUNT_PURGE_PAUSE = 0
+    # minimum bcrypt cost; hashing dominates test time at the default of 12
+    BCRYPT_LOG_ROUNDS = 4
+    # tests share one connection per test; build on it, not in a thread
+    AVAILABILITY_BACKGROUND_REBUILD = False
+    CACHE_BACKEND = 'local'
+    # the lease table lives in the test database; no need for one here
+    SNOWFLAKE_WORKER_ID = 0
+    SLOW_QUERY_MS = None
+    TEMPLATE_CACHE_DIR = None
+
+
+class ProductionConfig(Config):
+    """Deployed app and worker processes."""
+
+    DEBUG = False
+    TEMPLATE_PRELOAD = True
+
+
+CONFIGS = {
+    'development': DevelopmentConfig,
+    'testing': TestingConfig,
+    'production': ProductionConfig,
+}
+
+
+def get_config(config=None):
+    """Resolve `config`: an environment name from CONFIGS, a config object,
+    or None to use the WARBLER_CONFIG environment variable (default
+    'development').
+    """
+
+    if config is None:
+        config = os.environ.get('WARBLER_CONFIG', 'development')
+    if isinstance(config, str):
+        config = CONFIGS[config]
+    return config
@@ -0,0 +1,39 @@
+"""Cached per-user counts for profile and homepage stats.
+
+The stat tabs used to do `user.messages | length` and friends, which loads
+every message, like and follow row just to count them, on every page
+view. Follow counts come from the in-memory follow graph; message and like
+counts come from one COUNT query each, cached until the user posts,
+deletes or likes something.
+"""
+
+from cache import cache, messages_tag, likes_tag
+from follow_graph import follow_graph
+from models import db, Message, ArchivedMessage, Likes
+import shards
+
+
+def _db_counts(user_id):
+    session = shards.session_for_user(user_id)
+    messages = sum(
+        session.query(db.func.count(model.id))
+        .filter(model.user_id == user_id)
+        .scalar()
+        for model in (Message, ArchivedMessage))
+    likes = (session.query(db.func.count(Likes.message_id))
+             .filter(Likes.user_id == user_id)
+             .scalar())
+    return {'messages': messages, 'likes': likes}
+
+
+def user_counts(user_id):
+    """{'messages', 'likes', 'following', 'followers'} for `user_id`."""
+
+    counts = cache.get_or_set(f"user-counts:{user_id}",
+                              lambda: _db_counts(user_id),
+                              tags=[messages_tag(user_id), likes_tag(user_id)])
+
+    follow_graph.ensure_loaded()
+    return dict(counts,
+                following=follow_graph.following_count(user_id),
+                followers=follow_graph.followers_count(user_id))
@@ -0,0 +1,134 @@
+"""Streaming export of a user's messages, likes and follows.
+
+Rows are read with server-side cursors (`stream_results` + `yield_per`) as
+plain tuples and written out one record at a time, so memory stays flat no
+matter how much data the account has. Output is JSON Lines or CSV,
+optionally gzip-compressed as it streams.
+"""
+
+import csv
+import io
+import json
+import zlib
+
+from models import db, Message, ArchivedMessage, Likes, Follows
+import shards
+
+CHUNK_ROWS = 1000
+FORMATS = {
+    'jsonl': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+CSV_FIELDS = ['type', 'id', 'text', 'timestamp', 'user_id', 'message_id']
+
+
+def _stream(query):
+    return query.execution_options(stream_results=True).yield_per(CHUNK_ROWS)
+
+
+def iter_records(user_id):
+    """Yield one dict per message, like and follow edge of `user_id`."""
+
+    # messages and likes are on the user's shard, follows in the main
+    # database
+    shard_session = shards.session_for_user(user_id)
+
+    messages = _stream(shard_session.query(Message.id, Message.text,
+                                           Message.timestamp)
+                       .filter(Message.user_id == user_id)
+                       .order_by(Message.id))
+    for msg_id, text, timestamp in messages:
+        yield {'type': 'message', 'id': msg_id, 'text': text,
+               'timestamp': timestamp.isoformat()}
+
+    archived = _stream(shard_session.query(ArchivedMessage.id,
+                                           ArchivedMessage.text,
+                                           ArchivedMessage.timestamp)
+                       .filter(ArchivedMessage.user_id == user_id)
+                       .order_by(ArchivedMessage.id))
+    for msg_id, text, timestamp in archived:
+        yield {'type': 'message', 'id': msg_id, 'text': text,
+               'timestamp': timestamp.isoformat()}
+
+    likes = _stream(shard_session.query(Likes.message_id, Likes.created_at)
+                    .filter(Likes.user_id == user_id)
+                    .order_by(Likes.created_at, Likes.message_id))
+    for message_id, created_at in likes:
+        yield {'type': 'like', 'message_id': message_id,
+               'timestamp': created_at.isoformat()}
+
+    following = _stream(db.session.query(Follows.user_being_followed_id)
+                        .filter(Follows.user_following_id == user_id)
+                        .order_by(Follows.user_being_followed_id))
+    for followed_id, in following:
+        yield {'type': 'following', 'user_id': followed_id}
+
+    followers = _stream(db.session.query(Follows.user_following_id)
+                        .filter(Follows.user_being_followed_id == user_id)
+                        .order_by(Follows.user_following_id))
+    for follower_id, in followers:
+        yield {'type': 'follower', 'user_id': follower_id}
+
+
+def to_jsonl(records):
+    for record in records:
+        yield json.dumps(record) + "\n"
+
+
+def to_csv(records):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=CSV_FIELDS)
+    writer.writeheader()
+
+    for record in records:
+        writer.writerow(record)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def encode(records, fmt):
+    """Serialize records as `fmt` ('jsonl' or 'csv'), yielding strings."""
+
+    if fmt == 'csv':
+        return to_csv(records)
+    return to_jsonl(records)
+
+
+def chunked(strings, size=64 * 1024):
+    """Join small strings into ~`size`-byte chunks of UTF-8."""
+
+    pending = []
+    pending_size = 0
+    for string in strings:
+        data = string.encode('utf-8')
+        pending.append(data)
+        pending_size += len(data)
+        if pending_size >= size:
+            yield b"".join(pending)
+            pending = []
+            pending_size = 0
+
+    if pending:
+        yield b"".join(pending)
+
+
+def gzipped(chunks):
+    """Gzip-compress a stream of byte chunks incrementally."""
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_user(user_id, fmt='jsonl', compress=False):
+    """Byte chunks of `user_id`'s export in `fmt`, gzipped if `compress`."""
+
+    chunks = chunked(encode(iter_records(user_id), fmt))
+    return gzipped(chunks) if compress else chunks
@@ -0,0 +1,245 @@
+"""Compact in-memory index of the follow graph.
+
+`User.following` and `User.followers` load full `User` rows just to answer
+"does A follow B?" or "how many followers does B have?". This index keeps
+the `follows` table as sorted int32 neighbor arrays per user, in both
+directions, so those questions become a binary search or a `len()`.
+
+The index is read-mostly: it is loaded from `follows` and kept current in
+this process by calling `add()` / `remove()` after a follow or unfollow
+commits. Every process has its own copy, so a change also calls
+`publish()`, which invalidates the shared `follows_tag()`. Each process
+checks that tag at most every FOLLOW_GRAPH_SYNC_SECONDS and reloads when
+it has changed, so other workers catch up within that interval.
+"""
+
+from array import array
+from bisect import bisect_left
+import sys
+from threading import Lock
+import time
+
+from flask import current_app
+
+from cache import cache, follows_tag
+from models import db, Follows, User
+
+SYNC_SECONDS = 5
+
+
+def _contains(arr, value):
+    """Binary search a sorted array for `value`."""
+
+    i = bisect_left(arr, value)
+    return i < len(arr) and arr[i] == value
+
+
+def _insert(arr, value):
+    """Insert `value` into sorted array, keeping it sorted and unique.
+
+    Returns True if the value was added.
+    """
+
+    i = bisect_left(arr, value)
+    if i < len(arr) and arr[i] == value:
+        return False
+    arr.insert(i, value)
+    return True
+
+
+def _discard(arr, value):
+    """Remove `value` from sorted array if present.
+
+    Returns True if the value was removed.
+    """
+
+    i = bisect_left(arr, value)
+    if i < len(arr) and arr[i] == value:
+        del arr[i]
+        return True
+    return False
+
+
+class FollowGraph:
+    """Forward (following) and reverse (followers) adjacency of `follows`.
+
+    Each user id maps to an `array('i')` of neighbor ids kept in sorted
+    order, so membership is O(log d) and counts are O(1).
+    """
+
+    def __init__(self):
+        self._following = {}
+        self._followers = {}
+        self._lock = Lock()
+        self._reload_lock = Lock()
+        self._version = None
+        self._checked_at = 0.0
+        self.loaded = False
+
+    def load(self, edges):
+        """Replace the index with `edges`, an iterable of
+        (follower_id, followed_id) pairs.
+        """
+
+        following = {}
+        followers = {}
+
+        for follower_id, followed_id in edges:
+            following.setdefault(follower_id, []).append(followed_id)
+            followers.setdefault(followed_id, []).append(follower_id)
+
+        following = {uid: array('i', sorted(set(ids)))
+                     for uid, ids in following.items()}
+        followers = {uid: array('i', sorted(set(ids)))
+                     for uid, ids in followers.items()}
+
+        with self._lock:
+            self._following = following
+            self._followers = followers
+            self.loaded = True
+
+    def load_from_db(self):
+        """(Re)build the index from the `follows` table, leaving out edges
+        of deleted accounts whose follows haven't been purged yet.
+        """
+
+        # read the version first, so a change made during the load
+        # triggers another one
+        version = cache.tag_version(follows_tag())
+        follower = db.aliased(User)
+        followed = db.aliased(User)
+        rows = (db.session.query(Follows.user_following_id,
+                                 Follows.user_being_followed_id)
+                .join(follower, follower.id == Follows.user_following_id)
+                .join(followed, followed.id == Follows.user_being_followed_id)
+                .filter(follower.deleted_at.is_(None),
+                        followed.deleted_at.is_(None))
+                .yield_per(10000))
+        self.load(rows)
+        self._version = version
+        self._checked_at = time.monotonic()
+
+    def reset(self):
+        """Forget everything; the next `ensure_loaded()` reloads."""
+
+        with self._lock:
+            self._following = {}
+            self._followers = {}
+            self._version = None
+            self._checked_at = 0.0
+            self.loaded = False
+
+    def ensure_loaded(self):
+        """Load from the database the first time the index is needed, and
+        reload when another process has published a change.
+        """
+
+        if not self.loaded:
+            with self._reload_lock:
+                if not self.loaded:
+                    self.load_from_db()
+            return self
+
+        sync_seconds = current_app.config.get('FOLLOW_GRAPH_SYNC_SECONDS',
+                                              SYNC_SECONDS)
+        if time.monotonic() - self._checked_at < sync_seconds:
+            return self
+        # one thread reloads; the others keep using the current index
+        if not self._reload_lock.acquire(blocking=False):
+            return self
+        try:
+            self._checked_at = time.monotonic()
+            version = cache.tag_version(follows_tag())
+            if version is not None and version != self._version:
+                self.load_from_db()
+        finally:
+            self._reload_lock.release()
+        return self
+
+    def publish(self):
+        """Tell other processes the follow graph changed.
+
+        Call after `add()`, `remove()` or `remove_user()`.
+        """
+
+        cache.invalidate(follows_tag())
+
+    def add(self, follower_id, followed_id):
+        """Record that `follower_id` now follows `followed_id`."""
+
+        with self._lock:
+            _insert(self._following.setdefault(follower_id, array('i')),
+                    followed_id)
+            _insert(self._followers.setdefault(followed_id, array('i')),
+                    follower_id)
+
+    def remove(self, follower_id, followed_id):
+        """Record that `follower_id` no longer follows `followed_id`."""
+
+        with self._lock:
+            if follower_id in self._following:
+                _discard(self._following[follower_id], followed_id)
+            if followed_id in self._followers:
+                _discard(self._followers[followed_id], follower_id)
+
+    def remove_user(self, user_id):
+        """Drop every edge touching `user_id` (e.g. when it is deleted)."""
+
+        with self._lock:
+            for followed_id in self._following.pop(user_id, ()):
+                if followed_id in self._followers:
+                    _discard(self._followers[followed_id], user_id)
+            for follower_id in self._followers.pop(user_id, ()):
+                if follower_id in self._following:
+                    _discard(self._following[follower_id], user_id)
+
+    def is_following(self, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`?"""
+
+        return _contains(self._following.get(follower_id, ()), followed_id)
+
+    def is_followed_by(self, user_id, other_id):
+        """Is `user_id` followed by `other_id`?"""
+
+        return self.is_following(other_id, user_id)
+
+    def is_mutual(self, user_id, other_id):
+        """Do `user_id` and `other_id` follow each other?"""
+
+        return (self.is_following(user_id, other_id) and
+                self.is_following(other_id, user_id))
+
+    def following_count(self, user_id):
+        return len(self._following.get(user_id, ()))
+
+    def followers_count(self, user_id):
+        return len(self._followers.get(user_id, ()))
+
+    def following_ids(self, user_id):
+        """List of ids `user_id` follows, ascending."""
+
+        return self._following.get(user_id, array('i')).tolist()
+
+    def follower_ids(self, user_id):
+        """List of ids following `user_id`, ascending."""
+
+        return self._followers.get(user_id, array('i')).tolist()
+
+    def edge_count(self):
+        return sum(len(ids) for ids in self._following.values())
+
+    def nbytes(self):
+        """Approximate memory held by the index, in bytes."""
+
+        total = sys.getsizeof(self._following) + sys.getsizeof(self._followers)
+        for adjacency in (self._following, self._followers):
+            for ids in adjacency.values():
+                total += sys.getsizeof(ids)
+        return total
+
+    def bytes_per_edge(self):
+        edges = self.edge_count()
+        return self.nbytes() / edges if edges else 0.0
+
+
+follow_graph = FollowGraph()
@@ -0,0 +1,280 @@
+"""Durable background job queue backed by the `jobs` table.
+
+Routes call `enqueue()` to record work and return straight away; a worker
+process started with `flask worker` claims jobs and runs them. `enqueue()`
+only adds the job to the session, so it commits with the caller's own
+changes, or not at all if they roll back.
+
+Claiming uses `SELECT ... FOR UPDATE SKIP LOCKED` on Postgres, so many
+workers can poll the same table without blocking each other. Other
+databases (SQLite) claim with a conditional `UPDATE ... WHERE status =
+'queued'` and treat a zero rowcount as "someone else got it".
+
+A claim is a lease: the job is locked until `locked_until`, which the
+running worker keeps pushing forward. If the worker dies, the lease runs
+out and the next claim requeues the job (or fails it, if that was its
+last attempt).
+
+Failed jobs are retried with exponential backoff until `max_attempts` is
+reached. Each run records its duration so slow job types are easy to spot.
+
+Register a job type with the `job` decorator:
+
+    @job('purge_user')
+    def purge_user_job(user_id):
+        ...
+"""
+
+from datetime import datetime, timedelta
+import json
+import logging
+import os
+import socket
+from threading import Thread, Event
+import time
+import traceback
+
+from models import db, Job
+
+logger = logging.getLogger(__name__)
+
+HANDLERS = {}
+
+POLL_SECONDS = 1.0
+BACKOFF_SECONDS = 5
+LEASE_SECONDS = 300
+
+
+def job(name):
+    """Register the decorated function as the handler for jobs `name`."""
+
+    def register(fn):
+        HANDLERS[name] = fn
+        return fn
+
+    return register
+
+
+def enqueue(name, priority=0, delay=0, max_attempts=5, **kwargs):
+    """Add a `name` job with `kwargs` to the session. Returns the job.
+
+    The caller commits it, usually with the changes that needed it.
+    """
+
+    if name not in HANDLERS:
+        raise ValueError(f"Unknown job type: {name}")
+
+    new_job = Job(
+        name=name,
+        kwargs=json.dumps(kwargs),
+        priority=priority,
+        max_attempts=max_attempts,
+        run_at=datetime.utcnow() + timedelta(seconds=delay),
+    )
+    db.session.add(new_job)
+    db.session.flush()
+    return new_job
+
+
+def _ready_jobs():
+    return (Job.query
+            .filter(Job.status == 'queued', Job.run_at <= datetime.utcnow())
+            .order_by(Job.priority.desc(), Job.run_at, Job.id))
+
+
+def requeue_expired():
+    """Requeue running jobs whose worker let the lease run out, failing
+    those that have used all their attempts. Returns the number changed.
+    """
+
+    now = datetime.utcnow()
+    expired = Job.query.filter(Job.status == 'running',
+                               Job.locked_until < now)
+    failed = (expired.filter(Job.attempts >= Job.max_attempts)
+              .update({'status': 'failed', 'finished_at': now,
+                       'locked_by': None, 'locked_until': None,
+                       'last_error': "Worker stopped before finishing"},
+                      synchronize_session=False))
+    requeued = expired.update({'status': 'queued', 'locked_by': None,
+                               'locked_until': None},
+                              synchronize_session=False)
+    db.session.commit()
+    return failed + requeued
+
+
+def claim(worker_id, lease=LEASE_SECONDS):
+    """Claim the next runnable job for `worker_id` for `lease` seconds, or
+    return None.
+    """
+
+    requeue_expired()
+    now = datetime.utcnow()
+    locked_until = now + timedelta(seconds=lease)
+
+    if db.engine.dialect.name == 'postgresql':
+        next_job = _ready_jobs().with_for_update(skip_locked=True).first()
+        if next_job is None:
+            db.session.rollback()
+            return None
+        next_job.status = 'running'
+        next_job.locked_by = worker_id
+        next_job.locked_until = locked_until
+        next_job.started_at = now
+        next_job.attempts += 1
+        db.session.commit()
+        return next_job
+
+    for candidate_id, in _ready_jobs().with_entities(Job.id).limit(10):
+        claimed = (Job.query
+                   .filter(Job.id == candidate_id, Job.status == 'queued')
+                   .update({'status': 'running',
+                            'locked_by': worker_id,
+                            'locked_until': locked_until,
+                            'started_at': now,
+                            'attempts': Job.attempts + 1},
+                           synchronize_session=False))
+        db.session.commit()
+        if claimed:
+            return Job.query.get(candidate_id)
+
+    return None
+
+
+class _LeaseRenewer(Thread):
+    """Keeps pushing a running job's lease forward until stopped."""
+
+    def __init__(self, engine, job_id, worker_id, lease):
+        super().__init__(name=f"job-lease-{job_id}", daemon=True)
+        self.engine = engine
+        self.job_id = job_id
+        self.worker_id = worker_id
+        self.lease = lease
+        self.stopped = Event()
+
+    def run(self):
+        jobs = Job.__table__
+        while not self.stopped.wait(self.lease / 3):
+            try:
+                with self.engine.begin() as conn:
+                    conn.execute(
+                        jobs.update()
+                        .where((jobs.c.id == self.job_id) &
+                               (jobs.c.locked_by == self.worker_id))
+                        .values(locked_until=datetime.utcnow() +
+                                timedelta(seconds=self.lease)))
+            except Exception:
+                logger.exception("Couldn't renew the lease on job %s",
+                                 self.job_id)
+
+
+def run_job(claimed_job, lease=LEASE_SECONDS):
+    """Run a claimed job and record its outcome and timing."""
+
+    handler = HANDLERS.get(claimed_job.name)
+    job_id = claimed_job.id
+    renewer = _LeaseRenewer(db.engine, job_id, claimed_job.locked_by, lease)
+    renewer.start()
+    started = time.perf_counter()
+
+    try:
+        if handler is None:
+            raise LookupError(f"No handler for job type {claimed_job.name}")
+        handler(**json.loads(claimed_job.kwargs))
+    except Exception:
+        db.session.rollback()
+        claimed_job = Job.query.get(job_id)
+        claimed_job.last_error = traceback.format_exc()
+        if claimed_job.attempts >= claimed_job.max_attempts:
+            claimed_job.status = 'failed'
+            claimed_job.finished_at = datetime.utcnow()
+        else:
+            claimed_job.status = 'queued'
+            claimed_job.run_at = datetime.utcnow() + timedelta(
+                seconds=BACKOFF_SECONDS * 2 ** (claimed_job.attempts - 1))
+        logger.exception("Job %s (%s) failed", job_id, claimed_job.name)
+    else:
+        claimed_job = Job.query.get(job_id)
+        claimed_job.status = 'done'
+        claimed_job.finished_at = datetime.utcnow()
+        claimed_job.last_error = None
+
+    renewer.stopped.set()
+    renewer.join()
+    claimed_job.locked_by = None
+    claimed_job.locked_until = None
+    claimed_job.duration_ms = (time.perf_counter() - started) * 1000
+    db.session.commit()
+    return claimed_job
+
+
+def run_pending(worker_id=None, limit=None, lease=LEASE_SECONDS):
+    """Run jobs in this thread until the queue is empty (or `limit` runs).
+
+    Returns the number of jobs run. Handy for tests and cron-style use.
+    """
+
+    worker_id = worker_id or _default_worker_id()
+    ran = 0
+    while limit is None or ran < limit:
+        claimed_job = claim(worker_id, lease)
+        if claimed_job is None:
+            break
+        run_job(claimed_job, lease)
+        ran += 1
+    return ran
+
+
+def _default_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def run_worker(app, concurrency=1, poll=POLL_SECONDS, stop=None):
+    """Run `concurrency` worker threads until `stop` is set."""
+
+    stop = stop or Event()
+    lease = app.config.get('JOB_LEASE_SECONDS', LEASE_SECONDS)
+
+    def loop(n):
+        worker_id = f"{_default_worker_id()}:{n}"
+        with app.app_context():
+            while not stop.is_set():
+                try:
+                    claimed_job = claim(worker_id, lease)
+                    if claimed_job is None:
+                        stop.wait(poll)
+                        continue
+                    run_job(claimed_job, lease)
+                except Exception:
+                    logger.exception("Worker %s crashed claiming a job",
+                                     worker_id)
+                    db.session.rollback()
+                    stop.wait(poll)
+                finally:
+                    db.session.remove()
+
+    threads = [Thread(target=loop, args=(n,), name=f"job-worker-{n}",
+                      daemon=True)
+               for n in range(concurrency)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(timeout=poll)
+    except KeyboardInterrupt:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+def job_stats():
+    """Count, mean and max duration per (job name, status)."""
+
+    return (db.session.query(Job.name, Job.status,
+                             db.func.count(Job.id),
+                             db.func.avg(Job.duration_ms),
+                             db.func.max(Job.duration_ms))
+            .group_by(Job.name, Job.status)
+            .order_by(Job.name, Job.status)
+            .all())
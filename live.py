@@ -0,0 +1,235 @@
+"""Live timeline updates over server-sent events.
+
+Instead of reloading `/` (and re-running the homepage query and render) to
+see new warbles, the homepage opens an EventSource on `/stream/timeline`.
+`messages_add()` renders the new message's list item once and publishes
+it. Each stream then receives the fragments for the authors its user follows.
+
+Within a process, `broker` hands each event to the subscriptions following
+its author. For several worker processes on one host, set `LIVE_BUS_DIR`:
+each process binds a Unix datagram socket in that directory, and publishing
+sends the event to every other socket there. Sockets left behind by dead
+processes are removed the first time a send to them fails.
+
+Each open stream holds a worker thread, so serve the app with threaded or
+async workers. Streams end after LIVE_STREAM_SECONDS and the browser
+reconnects by itself. On reconnect the stream reads the user's current
+follows again.
+"""
+
+import itertools
+import json
+import logging
+import os
+from queue import Queue, Empty, Full
+import socket
+from threading import Lock, Thread
+import time
+
+from flask import current_app
+
+logger = logging.getLogger(__name__)
+
+QUEUE_SIZE = 100
+HEARTBEAT_SECONDS = 15
+STREAM_SECONDS = 300
+MAX_DATAGRAM = 64 * 1024
+
+
+class Subscription:
+    """One open stream: the authors it follows and its pending events."""
+
+    def __init__(self, author_ids, maxsize=QUEUE_SIZE):
+        self.author_ids = frozenset(author_ids)
+        self.queue = Queue(maxsize)
+        self.dropped = 0
+
+    def get(self, timeout=None):
+        """Next event, or None if none arrives within `timeout`."""
+
+        try:
+            return self.queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+
+class Broker:
+    """In-process pub/sub keyed by author id."""
+
+    def __init__(self):
+        self._by_author = {}
+        self._lock = Lock()
+
+    def subscribe(self, author_ids, maxsize=QUEUE_SIZE):
+        subscription = Subscription(author_ids, maxsize)
+        with self._lock:
+            for author_id in subscription.author_ids:
+                self._by_author.setdefault(author_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for author_id in subscription.author_ids:
+                subscribers = self._by_author.get(author_id)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._by_author[author_id]
+
+    def dispatch(self, event):
+        """Hand `event` to every subscription following its author.
+
+        A subscription whose queue is full (a stalled client) misses the
+        event rather than holding up everyone else.
+        """
+
+        with self._lock:
+            subscribers = list(self._by_author.get(event['author_id'], ()))
+
+        for subscription in subscribers:
+            try:
+                subscription.queue.put_nowait(event)
+            except Full:
+                subscription.dropped += 1
+
+        return len(subscribers)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(set().union(*self._by_author.values()))
+
+
+class SocketBus:
+    """Share events between processes through Unix datagram sockets in
+    `directory`, passing the ones from other processes to `on_event`.
+    """
+
+    _serial = itertools.count()
+
+    def __init__(self, directory, on_event):
+        self.directory = directory
+        self.on_event = on_event
+        self.path = os.path.join(
+            directory, f"{os.getpid()}-{next(self._serial)}.sock")
+        self._sock = None
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(self.path)
+        Thread(target=self._receive, name='live-bus', daemon=True).start()
+        return self
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def _receive(self):
+        while self._sock is not None:
+            try:
+                data = self._sock.recv(MAX_DATAGRAM)
+            except OSError:
+                return
+            try:
+                self.on_event(json.loads(data))
+            except Exception:
+                logger.exception("Bad live event")
+
+    def send(self, event):
+        """Send `event` to every other process on the bus."""
+
+        data = json.dumps(event).encode('utf-8')
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if path == self.path or not name.endswith('.sock'):
+                continue
+            try:
+                self._sock.sendto(data, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # nobody is listening any more
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            except OSError:
+                # receiver's buffer is full; it misses this one
+                logger.warning("Dropped live event for %s", path)
+
+
+broker = Broker()
+
+_bus = None
+_bus_lock = Lock()
+
+
+def _get_bus():
+    """This process's bus, started on first use if LIVE_BUS_DIR is set."""
+
+    global _bus
+
+    directory = current_app.config.get('LIVE_BUS_DIR')
+    if not directory:
+        return None
+
+    with _bus_lock:
+        if _bus is None:
+            _bus = SocketBus(directory, broker.dispatch).start()
+    return _bus
+
+
+def publish(event):
+    """Deliver `event` (a dict with 'author_id') to streams in this
+    process and, through the bus, in every other one.
+    """
+
+    bus = _get_bus()
+    if bus is not None:
+        bus.send(event)
+    return broker.dispatch(event)
+
+
+def publish_message(msg, html):
+    """Publish a new message and its rendered list item."""
+
+    return publish({'author_id': msg.user_id, 'id': msg.id, 'html': html})
+
+
+def format_event(event):
+    """`event` as one SSE frame."""
+
+    lines = [f"id: {event['id']}", "event: message"]
+    lines.extend(f"data: {line}" for line in event['html'].splitlines())
+    return "\n".join(lines) + "\n\n"
+
+
+def stream(author_ids, seconds=STREAM_SECONDS, heartbeat=HEARTBEAT_SECONDS):
+    """SSE frames for new messages by `author_ids`, as a generator.
+
+    Sends a comment line every `heartbeat` seconds so proxies keep the
+    connection open, and stops after `seconds`. Call it inside the request;
+    the generator itself doesn't need the app context.
+    """
+
+    _get_bus()
+    return _frames(author_ids, seconds, heartbeat)
+
+
+def _frames(author_ids, seconds, heartbeat):
+    subscription = broker.subscribe(author_ids)
+    deadline = time.monotonic() + seconds
+
+    try:
+        yield f"retry: {heartbeat * 1000}\n\n"
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            event = subscription.get(timeout=min(heartbeat, remaining))
+            yield format_event(event) if event else ": keepalive\n\n"
+    finally:
+        broker.unsubscribe(subscription)
@@ -0,0 +1,42 @@
+"""access-path indexes for timelines, followers and likes
+
+Revision ID: 8c4f2b7d1e30
+Revises: 5a1d3c0e9b21
+Create Date: 2026-10-19 09:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c4f2b7d1e30'
+down_revision = '5a1d3c0e9b21'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    # homepage() / users_show(): messages by author, newest first
+    ('ix_messages_user_id_timestamp', 'messages', ['user_id', 'timestamp']),
+    # User.following: the PK leads with user_being_followed_id, so lookups
+    # by follower need their own index
+    ('ix_follows_user_following_id', 'follows',
+     ['user_following_id', 'user_being_followed_id']),
+    # User.likes / unlike_msg()
+    ('ix_likes_user_id_message_id', 'likes', ['user_id', 'message_id']),
+]
+
+
+def upgrade():
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction block
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns,
+                            postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.drop_index(name, table_name=table,
+                          postgresql_concurrently=True)
@@ -0,0 +1,54 @@
+"""notifications
+
+Revision ID: a4d81f6c2e95
+Revises: f2c6a9e1d357
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4d81f6c2e95'
+down_revision = 'f2c6a9e1d357'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('users', sa.Column('unread_notifications', sa.Integer(),
+                                     server_default='0', nullable=False))
+    op.create_table('notification_events',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('kind', sa.Text(), nullable=False),
+    sa.Column('actor_id', sa.Integer(), nullable=False),
+    sa.Column('recipient_id', sa.Integer(), nullable=True),
+    sa.Column('message_id', sa.Integer(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('notifications',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('recipient_id', sa.Integer(), nullable=False),
+    sa.Column('kind', sa.Text(), nullable=False),
+    sa.Column('message_id', sa.Integer(), nullable=True),
+    sa.Column('actor_count', sa.Integer(), nullable=False),
+    sa.Column('last_actor_id', sa.Integer(), nullable=True),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.Column('read_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['recipient_id'], ['users.id'], ondelete='cascade'),
+    sa.ForeignKeyConstraint(['last_actor_id'], ['users.id'],
+                            ondelete='set null'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_notifications_recipient_id_updated_at',
+                    'notifications', ['recipient_id', 'updated_at'])
+
+
+def downgrade():
+    op.drop_index('ix_notifications_recipient_id_updated_at',
+                  table_name='notifications')
+    op.drop_table('notifications')
+    op.drop_table('notification_events')
+    op.drop_column('users', 'unread_notifications')
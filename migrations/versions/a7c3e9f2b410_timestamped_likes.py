@@ -0,0 +1,137 @@
+"""timestamped likes keyed by (user_id, message_id)
+
+Revision ID: a7c3e9f2b410
+Revises: e4b9c2d71a06
+Create Date: 2026-10-19 14:00:00.000000
+
+Drops the unique constraint on likes.message_id, which let only one user
+ever like a message. Adds created_at and makes (user_id, message_id) the
+primary key in place of the serial id.
+
+Written to run while the app is up (Postgres 12+):
+
+- created_at is added nullable, then given a default of now, so likes
+  made by app processes that don't know the column yet get one too.
+  Existing rows are backfilled BACKFILL_BATCH_SIZE ids per transaction,
+  walking the serial id upwards, and rows missing their user or message
+  are deleted in the same batches. Nobody recorded when legacy likes
+  happened, so they get the liked message's timestamp as the earliest
+  time they could have been made.
+- indexes are built CONCURRENTLY, and the new primary key takes over its
+  already-built unique index.
+- NOT NULL is proven by validating a CHECK constraint first. That doesn't
+  block writes, and the SET NOT NULLs then skip their table scans.
+
+Alembic only migrates the main database. `flask init-shards` brings the
+likes tables on shards to the new shape.
+"""
+import time
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7c3e9f2b410'
+down_revision = 'e4b9c2d71a06'
+branch_labels = None
+depends_on = None
+
+BACKFILL_BATCH_SIZE = 5000
+BACKFILL_PAUSE = 0.05
+
+# the highest id in the next batch after :after
+NEXT_BATCH = sa.text("""
+    SELECT max(id) FROM (SELECT id FROM likes WHERE id > :after
+                         ORDER BY id LIMIT :limit) AS batch
+""")
+
+# rows missing either end were never shown anywhere
+DELETE_BROKEN = sa.text("""
+    DELETE FROM likes WHERE id > :after AND id <= :upto
+                      AND (user_id IS NULL OR message_id IS NULL)
+""")
+
+BACKFILL = sa.text("""
+    UPDATE likes SET created_at = COALESCE(
+        (SELECT timestamp FROM messages WHERE messages.id = likes.message_id),
+        now() AT TIME ZONE 'utc')
+    WHERE id > :after AND id <= :upto AND created_at IS NULL
+""")
+
+
+def upgrade():
+    op.add_column('likes', sa.Column('created_at', sa.DateTime(),
+                                     nullable=True))
+    # set separately so existing rows stay NULL for the backfill
+    op.alter_column('likes', 'created_at', existing_type=sa.DateTime(),
+                    server_default=sa.text("(now() AT TIME ZONE 'utc')"))
+    op.drop_constraint('likes_message_id_key', 'likes', type_='unique')
+
+    with op.get_context().autocommit_block():
+        conn = op.get_bind()
+        after = 0
+        while True:
+            upto = conn.execute(NEXT_BATCH, after=after,
+                                limit=BACKFILL_BATCH_SIZE).scalar()
+            if upto is None:
+                break
+            conn.execute(DELETE_BROKEN, after=after, upto=upto)
+            conn.execute(BACKFILL, after=after, upto=upto)
+            after = upto
+            time.sleep(BACKFILL_PAUSE)
+
+        op.create_index('ix_likes_user_id_message_id_unique', 'likes',
+                        ['user_id', 'message_id'], unique=True,
+                        postgresql_concurrently=True)
+        op.create_index('ix_likes_user_id_created_at', 'likes',
+                        ['user_id', 'created_at', 'message_id'],
+                        postgresql_concurrently=True)
+        op.create_index('ix_likes_message_id', 'likes', ['message_id'],
+                        postgresql_concurrently=True)
+        op.drop_index('ix_likes_user_id_message_id', table_name='likes',
+                      postgresql_concurrently=True)
+
+    op.execute("ALTER TABLE likes ADD CONSTRAINT likes_not_null CHECK "
+               "(user_id IS NOT NULL AND message_id IS NOT NULL "
+               "AND created_at IS NOT NULL) NOT VALID")
+    op.execute("ALTER TABLE likes VALIDATE CONSTRAINT likes_not_null")
+    for column, type_ in (('user_id', sa.Integer()),
+                          ('message_id', sa.BigInteger()),
+                          ('created_at', sa.DateTime())):
+        op.alter_column('likes', column, nullable=False, existing_type=type_)
+    op.drop_constraint('likes_not_null', 'likes', type_='check')
+
+    op.drop_constraint('likes_pkey', 'likes', type_='primary')
+    op.execute("ALTER TABLE likes ADD CONSTRAINT likes_pkey PRIMARY KEY "
+               "USING INDEX ix_likes_user_id_message_id_unique")
+    op.drop_column('likes', 'id')
+
+
+def downgrade():
+    # likes of a message by more than one user can't go back to a unique
+    # message_id; keep the earliest
+    op.execute("DELETE FROM likes a USING likes b "
+               "WHERE a.message_id = b.message_id "
+               "AND (a.created_at, a.user_id) > (b.created_at, b.user_id)")
+
+    op.drop_constraint('likes_pkey', 'likes', type_='primary')
+    op.add_column('likes', sa.Column('id', sa.Integer(), nullable=False,
+                                     autoincrement=True))
+    op.execute("CREATE SEQUENCE likes_id_seq OWNED BY likes.id")
+    op.execute("UPDATE likes SET id = nextval('likes_id_seq')")
+    op.execute("ALTER TABLE likes ALTER COLUMN id "
+               "SET DEFAULT nextval('likes_id_seq')")
+    op.create_primary_key('likes_pkey', 'likes', ['id'])
+    op.create_unique_constraint('likes_message_id_key', 'likes',
+                                ['message_id'])
+
+    op.drop_index('ix_likes_message_id', table_name='likes')
+    op.drop_index('ix_likes_user_id_created_at', table_name='likes')
+    op.create_index('ix_likes_user_id_message_id', 'likes',
+                    ['user_id', 'message_id'])
+    op.alter_column('likes', 'user_id', nullable=True,
+                    existing_type=sa.Integer())
+    op.alter_column('likes', 'message_id', nullable=True,
+                    existing_type=sa.BigInteger())
+    op.drop_column('likes', 'created_at')
@@ -0,0 +1,35 @@
+"""account deletion tombstones and purge progress
+
+Revision ID: b3e91a5c7f42
+Revises: 8c4f2b7d1e30
+Create Date: 2026-10-19 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3e91a5c7f42'
+down_revision = '8c4f2b7d1e30'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('users', sa.Column('deleted_at', sa.DateTime(), nullable=True))
+    op.create_table('account_deletions',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('status', sa.Text(), nullable=False),
+    sa.Column('requested_at', sa.DateTime(), nullable=False),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.Column('messages_deleted', sa.Integer(), nullable=False),
+    sa.Column('likes_deleted', sa.Integer(), nullable=False),
+    sa.Column('follows_deleted', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('user_id')
+    )
+
+
+def downgrade():
+    op.drop_table('account_deletions')
+    op.drop_column('users', 'deleted_at')
@@ -0,0 +1,29 @@
+"""job leases
+
+Revision ID: b9d4e6a1c235
+Revises: a7c3e9f2b410
+Create Date: 2026-10-19 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b9d4e6a1c235'
+down_revision = 'a7c3e9f2b410'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('jobs', sa.Column('locked_until', sa.DateTime(),
+                                    nullable=True))
+    # jobs claimed before leases existed get one now; if their worker is
+    # gone they are requeued once it runs out
+    op.execute("UPDATE jobs SET locked_until = now() AT TIME ZONE 'utc' "
+               "+ interval '5 minutes' WHERE status = 'running'")
+
+
+def downgrade():
+    op.drop_column('jobs', 'locked_until')
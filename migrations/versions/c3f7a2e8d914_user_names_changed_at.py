@@ -0,0 +1,35 @@
+"""users.names_changed_at
+
+Revision ID: c3f7a2e8d914
+Revises: b9d4e6a1c235
+Create Date: 2026-10-19 16:00:00.000000
+
+Lets each process's availability filter pick up renamed users, not just
+new ones. Existing rows get the time of the migration; the server default
+stays so app servers still on the previous release can keep inserting
+users while this one rolls out. A constant default is added without
+rewriting the table (Postgres 11+).
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3f7a2e8d914'
+down_revision = 'b9d4e6a1c235'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('users', sa.Column(
+        'names_changed_at', sa.DateTime(), nullable=False,
+        server_default=sa.text("(now() AT TIME ZONE 'utc')")))
+    with op.get_context().autocommit_block():
+        op.create_index('ix_users_names_changed_at', 'users',
+                        ['names_changed_at'], postgresql_concurrently=True)
+
+
+def downgrade():
+    op.drop_index('ix_users_names_changed_at', table_name='users')
+    op.drop_column('users', 'names_changed_at')
@@ -0,0 +1,87 @@
+"""time-ordered 64-bit message ids
+
+Revision ID: c8e3f5a70b16
+Revises: a4d81f6c2e95
+Create Date: 2026-10-19 12:30:00.000000
+
+Widens message ids (and every column that refers to one) to bigint, and
+replaces the (user_id, timestamp) timeline indexes with (user_id, id).
+Changing a column's type rewrites the table, so run this in a maintenance
+window. Existing rows keep their serial ids until `flask
+migrate-message-ids` renumbers them.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c8e3f5a70b16'
+down_revision = 'a4d81f6c2e95'
+branch_labels = None
+depends_on = None
+
+MESSAGE_ID_COLUMNS = [
+    ('messages', 'id'),
+    ('messages_archive', 'id'),
+    ('likes', 'message_id'),
+    ('message_tags', 'message_id'),
+    ('mentions', 'message_id'),
+    ('notifications', 'message_id'),
+    ('notification_events', 'message_id'),
+]
+
+OLD_INDEXES = [
+    ('ix_messages_user_id_timestamp', 'messages', ['user_id', 'timestamp']),
+    ('ix_messages_archive_user_id_timestamp', 'messages_archive',
+     ['user_id', 'timestamp']),
+]
+
+NEW_INDEXES = [
+    ('ix_messages_user_id_id', 'messages', ['user_id', 'id']),
+    ('ix_messages_archive_user_id_id', 'messages_archive', ['user_id', 'id']),
+]
+
+
+def upgrade():
+    for table, column in MESSAGE_ID_COLUMNS:
+        op.alter_column(table, column, type_=sa.BigInteger(),
+                        existing_type=sa.Integer())
+    # ids now come from the app, not the serial sequence
+    op.alter_column('messages', 'id', server_default=None,
+                    existing_type=sa.BigInteger())
+
+    op.create_table('id_worker_leases',
+    sa.Column('worker_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('owner', sa.Text(), nullable=False),
+    sa.Column('expires_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('worker_id')
+    )
+
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction block
+    with op.get_context().autocommit_block():
+        for name, table, columns in NEW_INDEXES:
+            op.create_index(name, table, columns,
+                            postgresql_concurrently=True)
+        for name, table, columns in OLD_INDEXES:
+            op.drop_index(name, table_name=table,
+                          postgresql_concurrently=True)
+
+
+def downgrade():
+    # only possible before `migrate-message-ids` has renumbered anything
+    with op.get_context().autocommit_block():
+        for name, table, columns in OLD_INDEXES:
+            op.create_index(name, table, columns,
+                            postgresql_concurrently=True)
+        for name, table, columns in NEW_INDEXES:
+            op.drop_index(name, table_name=table,
+                          postgresql_concurrently=True)
+
+    op.drop_table('id_worker_leases')
+
+    op.execute("ALTER TABLE messages ALTER COLUMN id "
+               "SET DEFAULT nextval('messages_id_seq')")
+    for table, column in MESSAGE_ID_COLUMNS:
+        op.alter_column(table, column, type_=sa.Integer(),
+                        existing_type=sa.BigInteger())
@@ -0,0 +1,28 @@
+"""shard bucket map
+
+Revision ID: d1f7a3b95c28
+Revises: c8e3f5a70b16
+Create Date: 2026-10-19 13:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd1f7a3b95c28'
+down_revision = 'c8e3f5a70b16'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('shard_buckets',
+    sa.Column('bucket', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('shard', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('bucket')
+    )
+
+
+def downgrade():
+    op.drop_table('shard_buckets')
@@ -0,0 +1,37 @@
+"""case-insensitive unique usernames and emails
+
+Revision ID: e4b9c2d71a06
+Revises: d1f7a3b95c28
+Create Date: 2026-10-19 13:30:00.000000
+
+The indexes are built CONCURRENTLY, so signups and profile edits carry
+on while they build.
+
+Fails if two existing accounts differ only in case; rename one of them
+first. A failed concurrent build leaves an invalid index behind; drop it
+before running the migration again.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4b9c2d71a06'
+down_revision = 'd1f7a3b95c28'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        op.create_index('ix_users_lower_username', 'users',
+                        [sa.text('lower(username)')], unique=True,
+                        postgresql_concurrently=True)
+        op.create_index('ix_users_lower_email', 'users',
+                        [sa.text('lower(email)')], unique=True,
+                        postgresql_concurrently=True)
+
+
+def downgrade():
+    op.drop_index('ix_users_lower_email', table_name='users')
+    op.drop_index('ix_users_lower_username', table_name='users')
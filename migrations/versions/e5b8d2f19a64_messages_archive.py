@@ -0,0 +1,35 @@
+"""cold archive table for old messages
+
+Revision ID: e5b8d2f19a64
+Revises: d7a20c4e8f13
+Create Date: 2026-10-19 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5b8d2f19a64'
+down_revision = 'd7a20c4e8f13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('messages_archive',
+    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('text', sa.String(length=140), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_messages_archive_user_id_timestamp', 'messages_archive',
+                    ['user_id', 'timestamp'])
+
+
+def downgrade():
+    op.drop_index('ix_messages_archive_user_id_timestamp',
+                  table_name='messages_archive')
+    op.drop_table('messages_archive')
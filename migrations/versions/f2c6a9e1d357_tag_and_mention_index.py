@@ -0,0 +1,40 @@
+"""tag and mention index
+
+Revision ID: f2c6a9e1d357
+Revises: e5b8d2f19a64
+Create Date: 2026-10-19 11:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2c6a9e1d357'
+down_revision = 'e5b8d2f19a64'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('message_tags',
+    sa.Column('tag', sa.Text(), nullable=False),
+    sa.Column('message_id', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('tag', 'message_id')
+    )
+    op.create_index('ix_message_tags_message_id', 'message_tags',
+                    ['message_id'])
+    op.create_table('mentions',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('message_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='cascade'),
+    sa.PrimaryKeyConstraint('user_id', 'message_id')
+    )
+    op.create_index('ix_mentions_message_id', 'mentions', ['message_id'])
+
+
+def downgrade():
+    op.drop_index('ix_mentions_message_id', table_name='mentions')
+    op.drop_table('mentions')
+    op.drop_index('ix_message_tags_message_id', table_name='message_tags')
+    op.drop_table('message_tags')
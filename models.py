@@ -4,6 +4,7 @@ from datetime import datetime
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
@@ -13,6 +14,10 @@ class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
 
     __tablename__ = 'follows'
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
 
     user_being_followed_id = db.Column(
         db.Integer,
@@ -28,24 +33,32 @@ class Follows(db.Model):
 
 
 class Likes(db.Model):
-    """Mapping user likes to warbles."""
+    """A user liking a warble, and when they did."""
 
     __tablename__ = 'likes' 
-
-    id = db.Column(
-        db.Integer,
-        primary_key=True
+    __table_args__ = (
+        # covers a user's likes page: newest first, keyset-paginated
+        db.Index('ix_likes_user_id_created_at', 'user_id', 'created_at',
+                 'message_id'),
+        db.Index('ix_likes_message_id', 'message_id'),
     )
 
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id', ondelete='cascade')
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
     )
 
     message_id = db.Column(
-        db.Integer,
+        db.BigInteger,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        primary_key=True,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
     )
 
 
@@ -94,6 +107,29 @@ class User(db.Model):
         nullable=False,
     )
 
+    # set when the account is deleted; the rows are purged in the background
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
+    # kept up to date as notifications are delivered and read, so the
+    # navbar badge never has to count rows
+    unread_notifications = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # when username or email last changed; every process's availability
+    # filter adds names changed since its last sync
+    names_changed_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        index=True,
+    )
+
     messages = db.relationship('Message')
 
     followers = db.relationship(
@@ -118,6 +154,12 @@ class User(db.Model):
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    @classmethod
+    def active(cls):
+        """Query of users that haven't deleted their account."""
+
+        return cls.query.filter(cls.deleted_at.is_(None))
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
@@ -160,7 +202,7 @@ class User(db.Model):
         If can't find matching user (or if password is wrong), returns False.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.active().filter_by(username=username).first()
 
         if user:
             is_auth = bcrypt.check_password_hash(user.password, password)
@@ -170,14 +212,77 @@ class User(db.Model):
         return False
 
 
+# names are unique ignoring case (see availability.py)
+db.Index('ix_users_lower_username', db.func.lower(User.username), unique=True)
+db.Index('ix_users_lower_email', db.func.lower(User.email), unique=True)
+
+
+@event.listens_for(User.username, 'set')
+@event.listens_for(User.email, 'set')
+def _names_changed(user, value, oldvalue, initiator):
+    if value != oldvalue:
+        user.names_changed_at = datetime.utcnow()
+
+
+def _next_message_id():
+    # imported here: snowflake imports this module
+    from snowflake import next_id
+    return next_id()
+
+
 class Message(db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = 'messages'
+    __table_args__ = (
+        db.Index('ix_messages_user_id_id', 'user_id', 'id'),
+    )
 
+    # time-ordered (see snowflake.py), so newest first is ORDER BY id DESC
     id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+        autoincrement=False,
+        default=_next_message_id,
+    )
+
+    text = db.Column(
+        db.String(140),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    user_id = db.Column(
         db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    user = db.relationship('User')
+
+
+
+class ArchivedMessage(db.Model):
+    """A message moved out of `messages` once it is old and unliked.
+
+    Same columns as `Message`; keeping old rows here keeps the hot table
+    and its indexes small enough to stay in memory.
+    """
+
+    __tablename__ = 'messages_archive'
+    __table_args__ = (
+        db.Index('ix_messages_archive_user_id_id', 'user_id', 'id'),
+    )
+
+    id = db.Column(
+        db.BigInteger,
         primary_key=True,
+        autoincrement=False,
     )
 
     text = db.Column(
@@ -188,7 +293,6 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
     )
 
     user_id = db.Column(
@@ -200,6 +304,325 @@ class Message(db.Model):
     user = db.relationship('User')
 
 
+class MessageTag(db.Model):
+    """Inverted index from a #tag to the messages that use it."""
+
+    __tablename__ = 'message_tags'
+    __table_args__ = (
+        db.Index('ix_message_tags_message_id', 'message_id'),
+    )
+
+    tag = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    # no foreign key: the row stays put when its message is archived
+    message_id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+    )
+
+
+class Mention(db.Model):
+    """Inverted index from a mentioned user to the messages naming them."""
+
+    __tablename__ = 'mentions'
+    __table_args__ = (
+        db.Index('ix_mentions_message_id', 'message_id'),
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # no foreign key, as for MessageTag
+    message_id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+    )
+
+
+class NotificationEvent(db.Model):
+    """Something a user should hear about, not yet delivered.
+
+    Routes append these in their own transaction; the `deliver_notifications`
+    job folds them into `Notification` rows in batches.
+    """
+
+    __tablename__ = 'notification_events'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # 'like', 'follow' or 'mention'
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    actor_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # None for likes: the message's author is looked up on delivery
+    recipient_id = db.Column(
+        db.Integer,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+
+class Notification(db.Model):
+    """One line in a user's notifications, e.g. "12 people liked your
+    warble". Unread events of the same kind about the same message are
+    coalesced into one row.
+    """
+
+    __tablename__ = 'notifications'
+    __table_args__ = (
+        db.Index('ix_notifications_recipient_id_updated_at',
+                 'recipient_id', 'updated_at'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    recipient_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+    )
+
+    actor_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+    )
+
+    last_actor_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='set null'),
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    read_at = db.Column(
+        db.DateTime,
+    )
+
+    last_actor = db.relationship('User', foreign_keys=[last_actor_id])
+
+
+class IdWorkerLease(db.Model):
+    """A Snowflake worker id held by one running process."""
+
+    __tablename__ = 'id_worker_leases'
+
+    worker_id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    # host:pid:random, unique per process
+    owner = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    expires_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+
+class ShardBucket(db.Model):
+    """Which shard holds the messages and likes of one bucket of users.
+
+    Buckets missing here are on shard `bucket % number of shards`.
+    """
+
+    __tablename__ = 'shard_buckets'
+
+    bucket = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    shard = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+
+class AccountDeletion(db.Model):
+    """Progress of purging a deleted account's rows."""
+
+    __tablename__ = 'account_deletions'
+
+    # no foreign key: the user row is the last thing the purge deletes
+    user_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        default='pending',
+    )
+
+    requested_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+    messages_deleted = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    likes_deleted = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    follows_deleted = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+
+class Job(db.Model):
+    """A unit of background work."""
+
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        db.Index('ix_jobs_status_priority_run_at',
+                 'status', 'priority', 'run_at'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    name = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # JSON-encoded keyword arguments for the handler
+    kwargs = db.Column(
+        db.Text,
+        nullable=False,
+        default='{}',
+    )
+
+    # higher runs first
+    priority = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        default='queued',
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    max_attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=5,
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    started_at = db.Column(
+        db.DateTime,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+    duration_ms = db.Column(
+        db.Float,
+    )
+
+    locked_by = db.Column(
+        db.Text,
+    )
+
+    # a running job whose lease has passed is requeued by the next claim
+    locked_until = db.Column(
+        db.DateTime,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    def __repr__(self):
+        return f"<Job #{self.id}: {self.name} {self.status}>"
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
@@ -208,3 +631,4 @@ def connect_db(app):
 
     db.app = app
     db.init_app(app)
+    bcrypt.init_app(app)
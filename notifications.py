@@ -0,0 +1,215 @@
+"""Notifications for likes, follows and mentions.
+
+Writing a finished notification inside `like_msg()` or `add_follow()` would
+mean a read-modify-write of the recipient's notifications on every like.
+Instead the route only appends a `NotificationEvent` row, in the same
+transaction as the like itself, and queues (at most once per
+NOTIFICATION_DELIVERY_DELAY seconds per process) a `deliver_notifications`
+job.
+
+Delivery takes events in id order, a batch at a time, and folds them into
+`Notification` rows: unread events of the same kind about the same message
+(or all unread follows) become one row with a count, which is how "12
+people liked your warble" is shown. Each recipient's
+`User.unread_notifications` is bumped in the same transaction, so the
+navbar badge reads a column already loaded with `g.user`.
+"""
+
+from datetime import datetime
+from threading import Lock
+import time
+
+from flask import current_app
+
+from jobs import job, enqueue
+from models import db, User, Message, NotificationEvent, Notification
+import shards
+
+BATCH_SIZE = 1000
+DELIVERY_DELAY = 5
+PAGE_SIZE = 50
+
+# monotonic time until which this process already has a delivery queued
+_delivery_queued_until = 0.0
+_delivery_lock = Lock()
+
+
+def notify(kind, actor_id, recipient_id=None, message_id=None):
+    """Append an event. Doesn't commit; it goes in with the caller's commit.
+
+    For likes pass just `message_id`; the recipient (the message's author)
+    is looked up on delivery.
+    """
+
+    if recipient_id is not None and recipient_id == actor_id:
+        return
+
+    db.session.add(NotificationEvent(kind=kind, actor_id=actor_id,
+                                     recipient_id=recipient_id,
+                                     message_id=message_id))
+
+
+def schedule_delivery():
+    """Queue and commit a delivery job unless this process queued one
+    recently.
+
+    Call after committing the events.
+    """
+
+    global _delivery_queued_until
+
+    delay = current_app.config.get('NOTIFICATION_DELIVERY_DELAY',
+                                   DELIVERY_DELAY)
+    now = time.monotonic()
+    with _delivery_lock:
+        if now < _delivery_queued_until:
+            return None
+        _delivery_queued_until = now + delay
+
+    delivery = enqueue('deliver_notifications', delay=delay)
+    db.session.commit()
+    return delivery
+
+
+def _claim_events(batch_size):
+    query = (NotificationEvent.query
+             .order_by(NotificationEvent.id)
+             .limit(batch_size))
+    if db.engine.dialect.name == 'postgresql':
+        # concurrent deliveries take disjoint batches
+        query = query.with_for_update(skip_locked=True)
+    return query.all()
+
+
+def _deliver_batch(events):
+    """Fold `events` into notifications and unread counts. Doesn't commit."""
+
+    like_ids = {event.message_id for event in events if event.kind == 'like'}
+    authors = {}
+    if like_ids:
+        for rows in shards.scatter(
+                lambda session: session.query(Message.id, Message.user_id)
+                .filter(Message.id.in_(like_ids)).all()):
+            authors.update(rows)
+
+    # (recipient_id, kind, message_id) -> [count, last actor, last time]
+    grouped = {}
+    for event in events:
+        recipient_id = (authors.get(event.message_id)
+                        if event.kind == 'like' else event.recipient_id)
+        if recipient_id is None or recipient_id == event.actor_id:
+            continue
+        message_id = None if event.kind == 'follow' else event.message_id
+        entry = grouped.setdefault((recipient_id, event.kind, message_id),
+                                   [0, None, None])
+        entry[0] += 1
+        entry[1] = event.actor_id
+        entry[2] = event.created_at
+
+    user_ids = ({key[0] for key in grouped} |
+                {entry[1] for entry in grouped.values()})
+    active = {row[0] for row in
+              db.session.query(User.id).filter(User.id.in_(user_ids),
+                                               User.deleted_at.is_(None))
+              } if user_ids else set()
+    grouped = {key: entry for key, entry in grouped.items()
+               if key[0] in active and entry[1] in active}
+
+    recipients = {key[0] for key in grouped}
+    unread = {}
+    if recipients:
+        for notification in Notification.query.filter(
+                Notification.recipient_id.in_(recipients),
+                Notification.read_at.is_(None)):
+            key = (notification.recipient_id, notification.kind,
+                   notification.message_id)
+            if key in grouped:
+                unread[key] = notification
+
+    new_counts = {}
+    for key, (count, last_actor_id, updated_at) in grouped.items():
+        notification = unread.get(key)
+        if notification is None:
+            recipient_id, kind, message_id = key
+            db.session.add(Notification(recipient_id=recipient_id, kind=kind,
+                                        message_id=message_id,
+                                        actor_count=count,
+                                        last_actor_id=last_actor_id,
+                                        updated_at=updated_at))
+            new_counts[recipient_id] = new_counts.get(recipient_id, 0) + 1
+        else:
+            notification.actor_count += count
+            notification.last_actor_id = last_actor_id
+            notification.updated_at = updated_at
+
+    if new_counts:
+        users = User.__table__
+        db.session.execute(
+            users.update()
+            .where(users.c.id == db.bindparam('recipient_id'))
+            .values(unread_notifications=users.c.unread_notifications +
+                    db.bindparam('count')),
+            [{'recipient_id': recipient_id, 'count': count}
+             for recipient_id, count in new_counts.items()])
+
+    (NotificationEvent.query
+     .filter(NotificationEvent.id.in_([event.id for event in events]))
+     .delete(synchronize_session=False))
+
+
+def deliver(batch_size=BATCH_SIZE):
+    """Deliver every pending event, `batch_size` per transaction.
+
+    Returns the number of events processed.
+    """
+
+    processed = 0
+    while True:
+        events = _claim_events(batch_size)
+        if not events:
+            db.session.rollback()
+            return processed
+
+        _deliver_batch(events)
+        db.session.commit()
+        processed += len(events)
+
+
+@job('deliver_notifications')
+def deliver_notifications_job():
+    """Job handler: deliver pending notification events."""
+
+    deliver(batch_size=current_app.config.get('NOTIFICATION_BATCH_SIZE',
+                                              BATCH_SIZE))
+
+
+def recent(user_id, limit=PAGE_SIZE):
+    """A user's newest notifications, read or not."""
+
+    return (Notification.query
+            .filter(Notification.recipient_id == user_id)
+            .order_by(Notification.updated_at.desc())
+            .limit(limit)
+            .all())
+
+
+def mark_all_read(user):
+    """Mark everything `user` has been notified about as read, and commit.
+
+    The badge count goes down by the number of rows marked here rather
+    than to zero, so notifications delivered meanwhile stay counted.
+    """
+
+    marked = (Notification.query
+              .filter(Notification.recipient_id == user.id,
+                      Notification.read_at.is_(None))
+              .update({'read_at': datetime.utcnow()},
+                      synchronize_session=False))
+    if marked:
+        users = User.__table__
+        db.session.execute(
+            users.update()
+            .where(users.c.id == user.id)
+            .values(unread_notifications=users.c.unread_notifications -
+                    marked))
+    db.session.commit()
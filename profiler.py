@@ -0,0 +1,222 @@
+"""Opt-in sampling profiler for production requests.
+
+`flask_debugtoolbar` is for development only. This profiles a few real
+requests cheaply. A request is profiled when:
+
+- it carries an `X-Warbler-Profile` header signed with PROFILE_SECRET
+  (`flask profile-token` prints one), or
+- PROFILE_SAMPLE_RATE is N > 0 and the request is picked 1 time in N.
+
+While any request is being profiled, one background thread wakes every
+PROFILE_INTERVAL seconds and records the current stack of each profiled
+request's thread. Stacks start at Flask's dispatch, so they cover the view,
+the queries it makes and the Jinja templates it renders (template frames
+are named after the template file). Nothing is traced, so profiled requests
+only pay for the sampler thread's share of the GIL.
+
+When a profiled request ends, its samples are written in collapsed-stack
+format (`frame;frame;frame count` per line, as flamegraph.pl and speedscope
+read it) to PROFILE_DIR/<endpoint>.<id>.folded. `flask profile-report`
+merges those files per endpoint.
+"""
+
+from collections import Counter
+import hashlib
+import hmac
+import itertools
+import os
+import random
+import sys
+from threading import Lock, Thread, get_ident
+import time
+
+from flask import current_app, g, request
+
+HEADER = 'X-Warbler-Profile'
+INTERVAL = 0.005
+SUFFIX = '.folded'
+
+# frames above this one are the WSGI server and Flask's own plumbing
+ROOT_FRAME = 'full_dispatch_request'
+
+
+def sign_token(secret, expires_at):
+    """Header value that enables profiling until `expires_at` (Unix time)."""
+
+    expires_at = int(expires_at)
+    digest = hmac.new(secret.encode('utf-8'), f"profile:{expires_at}".encode(),
+                      hashlib.sha256).hexdigest()
+    return f"{expires_at}.{digest}"
+
+
+def verify_token(secret, token, now=None):
+    """Is `token` signed with `secret` and not yet expired?"""
+
+    expires_at, _, digest = (token or '').partition('.')
+    if not expires_at.isdigit():
+        return False
+    if int(expires_at) < (now or time.time()):
+        return False
+    return hmac.compare_digest(sign_token(secret, expires_at), token)
+
+
+def _frame_name(code):
+    name = f"{os.path.basename(code.co_filename)}:{code.co_name}"
+    return name.replace(';', ':').replace(' ', '_')
+
+
+def collapse(frame):
+    """`frame`'s stack, outermost first, as one collapsed-stack line."""
+
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame.f_code))
+        if frame.f_code.co_name == ROOT_FRAME:
+            break
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class Sampler:
+    """Background thread sampling the stacks of registered threads."""
+
+    def __init__(self, interval=INTERVAL):
+        self.interval = interval
+        self._active = {}
+        self._lock = Lock()
+        self._thread = None
+
+    def start(self, ident):
+        """Start sampling thread `ident`; returns its sample Counter."""
+
+        counts = Counter()
+        with self._lock:
+            self._active[ident] = counts
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name='profiler',
+                                      daemon=True)
+                self._thread.start()
+        return counts
+
+    def stop(self, ident):
+        """Stop sampling thread `ident`; returns its samples."""
+
+        with self._lock:
+            return self._active.pop(ident, Counter())
+
+    def sample(self):
+        """Take one sample of every registered thread."""
+
+        frames = sys._current_frames()
+        with self._lock:
+            active = list(self._active.items())
+        for ident, counts in active:
+            frame = frames.get(ident)
+            if frame is not None:
+                counts[collapse(frame)] += 1
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._active:
+                    # idle: exit, and let the next start() spawn a new one
+                    self._thread = None
+                    return
+            self.sample()
+            time.sleep(self.interval)
+
+
+class Profiler:
+    """Flask extension that decides which requests to profile."""
+
+    _serial = itertools.count()
+
+    def __init__(self):
+        self.sampler = Sampler()
+
+    def init_app(self, app):
+        self.sampler.interval = app.config.get('PROFILE_INTERVAL', INTERVAL)
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+
+    def _wanted(self):
+        config = current_app.config
+        token = request.headers.get(HEADER)
+        if token:
+            secret = config.get('PROFILE_SECRET') or config['SECRET_KEY']
+            return verify_token(secret, token)
+
+        rate = config.get('PROFILE_SAMPLE_RATE') or 0
+        return rate > 0 and random.randrange(rate) == 0
+
+    def _before_request(self):
+        if request.endpoint in (None, 'static') or not self._wanted():
+            return
+        g.profile = {
+            'endpoint': request.endpoint,
+            'id': f"{int(time.time() * 1000)}.{os.getpid()}."
+                  f"{next(self._serial)}",
+            'thread': get_ident(),
+        }
+        self.sampler.start(g.profile['thread'])
+
+    def _teardown_request(self, exc):
+        profile = g.pop('profile', None)
+        if profile is None:
+            return
+        counts = self.sampler.stop(profile['thread'])
+
+        directory = current_app.config.get('PROFILE_DIR', 'profiles')
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory,
+                            f"{profile['endpoint']}.{profile['id']}{SUFFIX}")
+        with open(path, 'w') as f:
+            write_collapsed(counts, f)
+
+
+def write_collapsed(counts, f):
+    for stack, count in sorted(counts.items()):
+        f.write(f"{stack} {count}\n")
+
+
+def read_collapsed(f):
+    """Parse collapsed-stack lines into a Counter."""
+
+    counts = Counter()
+    for line in f:
+        stack, _, count = line.rstrip('\n').rpartition(' ')
+        if stack and count.isdigit():
+            counts[stack] += int(count)
+    return counts
+
+
+def aggregate(directory):
+    """Merge every profile in `directory` by endpoint.
+
+    Returns {endpoint: (number of requests, Counter of stacks)}.
+    """
+
+    merged = {}
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(SUFFIX):
+            continue
+        # <endpoint>.<ms>.<pid>.<n>.folded; endpoints contain dots too
+        endpoint = name[:-len(SUFFIX)].rsplit('.', 3)[0]
+        with open(os.path.join(directory, name)) as f:
+            counts = read_collapsed(f)
+        requests, total = merged.get(endpoint, (0, Counter()))
+        total.update(counts)
+        merged[endpoint] = (requests + 1, total)
+    return merged
+
+
+def top_frames(counts, limit=10):
+    """Leaf frames with the most samples: where time is actually spent."""
+
+    leaves = Counter()
+    for stack, count in counts.items():
+        leaves[stack.rpartition(';')[2]] += count
+    return leaves.most_common(limit)
+
+
+profiler = Profiler()
@@ -0,0 +1,103 @@
+"""EXPLAIN-based checks that hot routes use their access-path indexes.
+
+Each entry in `HOT_QUERIES` rebuilds the query a route issues and names the
+index its plan is expected to use. `check_query_plans()` runs `EXPLAIN` for
+each one and reports whether that index shows up in the plan.
+
+Run it against a database with:
+
+    FLASK_APP=app flask check-query-plans
+"""
+
+from models import db, User, Message, Follows, Likes
+
+
+def homepage_query(user_id):
+    """Timeline query from homepage()."""
+
+    return (Message
+            .query
+            .filter(Message.user_id.in_([user_id]))
+            .order_by(Message.id.desc())
+            .limit(100))
+
+
+def users_show_query(user_id):
+    """Profile timeline query from users_show()."""
+
+    return (Message
+            .query
+            .filter(Message.user_id == user_id)
+            .order_by(Message.id.desc())
+            .limit(100))
+
+
+def following_query(user_id):
+    """Lookup behind User.following."""
+
+    return (db.session.query(Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == user_id))
+
+
+def likes_query(user_id):
+    """Likes page query from users_likes()."""
+
+    return (db.session.query(Likes.created_at, Likes.message_id)
+            .filter(Likes.user_id == user_id)
+            .order_by(Likes.created_at.desc(), Likes.message_id.desc())
+            .limit(51))
+
+
+HOT_QUERIES = {
+    'homepage': (homepage_query, 'ix_messages_user_id_id'),
+    'users_show': (users_show_query, 'ix_messages_user_id_id'),
+    'show_following': (following_query, 'ix_follows_user_following_id'),
+    'users_likes': (likes_query, 'ix_likes_user_id_created_at'),
+}
+
+
+def compile_query(query):
+    """Render an ORM query as SQL text for the current dialect."""
+
+    return str(query.statement.compile(
+        dialect=db.engine.dialect,
+        compile_kwargs={"literal_binds": True}))
+
+
+def explain(query):
+    """Return the plan for `query` as a single string."""
+
+    sql = compile_query(query)
+
+    if db.engine.dialect.name == 'postgresql':
+        with db.engine.connect() as conn:
+            trans = conn.begin()
+            # small test tables always look cheapest to seq scan; we want to
+            # know whether the index *can* serve the query
+            conn.execute(db.text("SET LOCAL enable_seqscan = off"))
+            rows = conn.execute(db.text(f"EXPLAIN {sql}")).fetchall()
+            trans.rollback()
+        return "\n".join(row[0] for row in rows)
+
+    if db.engine.dialect.name == 'sqlite':
+        rows = db.session.execute(db.text(f"EXPLAIN QUERY PLAN {sql}"))
+        return "\n".join(row[-1] for row in rows)
+
+    rows = db.session.execute(db.text(f"EXPLAIN {sql}"))
+    return "\n".join(str(row) for row in rows)
+
+
+def check_query_plans(user_id=None):
+    """Explain every hot query.
+
+    Returns a list of (name, index_name, used, plan) tuples.
+    """
+
+    if user_id is None:
+        user_id = db.session.query(db.func.min(User.id)).scalar() or 1
+
+    results = []
+    for name, (build, index_name) in HOT_QUERIES.items():
+        plan = explain(build(user_id))
+        results.append((name, index_name, index_name in plan, plan))
+    return results
@@ -0,0 +1,195 @@
+"""Lightweight read models for timelines and user cards.
+
+Timelines and follow lists only print a handful of fields, but loading
+them through the ORM builds full identity-mapped `User` and `Message`
+instances (password hash, bio, location and all) and tracks every one in
+the session. The functions here select just the columns a page shows with
+Core `select()`s and return small `__slots__` objects that the templates
+use exactly like the ORM instances they replace.
+
+They are read-only snapshots: nothing here is attached to a session, so
+there's nothing to lazy-load, flush or expire.
+"""
+
+from datetime import datetime, timedelta
+
+from follow_graph import follow_graph
+from models import db, User, Message, ArchivedMessage, Likes
+import shards
+
+USERS = User.__table__
+MESSAGE_TABLES = (Message.__table__, ArchivedMessage.__table__)
+LIKES_PAGE_SIZE = 50
+
+
+class UserCard:
+    """What timelines and follow cards show of a user."""
+
+    __slots__ = ('id', 'username', 'image_url', 'header_image_url', 'bio')
+
+    def __init__(self, id, username, image_url, header_image_url, bio):
+        self.id = id
+        self.username = username
+        self.image_url = image_url
+        self.header_image_url = header_image_url
+        self.bio = bio
+
+    def __repr__(self):
+        return f"<UserCard #{self.id}: {self.username}>"
+
+
+class MessageRow:
+    """A message as timelines show it, with its author's `UserCard`."""
+
+    __slots__ = ('id', 'text', 'timestamp', 'user_id', 'user')
+
+    def __init__(self, id, text, timestamp, user_id, user=None):
+        self.id = id
+        self.text = text
+        self.timestamp = timestamp
+        self.user_id = user_id
+        self.user = user
+
+    def __repr__(self):
+        return f"<MessageRow #{self.id}: user {self.user_id}>"
+
+
+def _card_columns():
+    return [USERS.c.id, USERS.c.username, USERS.c.image_url,
+            USERS.c.header_image_url, USERS.c.bio]
+
+
+def _message_columns(table):
+    return [table.c.id, table.c.text, table.c.timestamp, table.c.user_id]
+
+
+def user_cards(user_ids, active_only=False):
+    """{id: UserCard} for `user_ids`, in one query."""
+
+    if not user_ids:
+        return {}
+
+    query = db.select(_card_columns()).where(USERS.c.id.in_(user_ids))
+    if active_only:
+        query = query.where(USERS.c.deleted_at.is_(None))
+    return {row[0]: UserCard(*row) for row in db.session.execute(query)}
+
+
+def _with_users(messages):
+    """`messages` with their author cards, leaving out those whose author
+    is deleted and not yet purged.
+    """
+
+    cards = user_cards({msg.user_id for msg in messages}, active_only=True)
+    for msg in messages:
+        msg.user = cards.get(msg.user_id)
+    return [msg for msg in messages if msg.user is not None]
+
+
+def _find_on_shard(session, message_ids):
+    found = {}
+    for table in MESSAGE_TABLES:
+        missing = [msg_id for msg_id in message_ids if msg_id not in found]
+        if not missing:
+            break
+        found.update((row[0], row) for row in session.execute(
+            db.select(_message_columns(table))
+            .where(table.c.id.in_(missing))))
+    return found
+
+
+def messages_by_ids(message_ids):
+    """MessageRows for `message_ids` from the hot table or the archive, in
+    the given order, skipping deleted authors' messages.
+    """
+
+    if not message_ids:
+        return []
+
+    found = {}
+    for part in shards.scatter(
+            lambda session: _find_on_shard(session, message_ids)):
+        found.update(part)
+
+    return _with_users([MessageRow(*found[msg_id]) for msg_id in message_ids
+                        if msg_id in found])
+
+
+def user_messages(user_id, limit=100):
+    """A user's newest `limit` MessageRows, topped up from the archive like
+    `archive.user_timeline()`.
+    """
+
+    session = shards.session_for_user(user_id)
+    rows = []
+    for table in MESSAGE_TABLES:
+        rows += session.execute(
+            db.select(_message_columns(table))
+            .where(table.c.user_id == user_id)
+            .order_by(table.c.id.desc())
+            .limit(limit - len(rows))).fetchall()
+        if len(rows) >= limit:
+            break
+
+    return _with_users([MessageRow(*row) for row in rows])
+
+
+def like_cursor(created_at, message_id):
+    """Opaque 'before' param for the likes page after this like."""
+
+    micros = (created_at - datetime(1970, 1, 1)) // timedelta(microseconds=1)
+    return f"{micros}-{message_id}"
+
+
+def parse_like_cursor(cursor):
+    """(created_at, message_id) from `like_cursor()`, or None."""
+
+    # message ids can be negative, so split at the first '-' only
+    micros, _, message_id = (cursor or '').partition('-')
+    try:
+        return (datetime(1970, 1, 1) + timedelta(microseconds=int(micros)),
+                int(message_id))
+    except (ValueError, OverflowError):
+        return None
+
+
+def liked_messages(user_id, before=None, limit=LIKES_PAGE_SIZE):
+    """MessageRows `user_id` has liked, most recently liked first, after
+    the like `before` (a `like_cursor()`).
+
+    Reads only the (user_id, created_at, message_id) index. Returns
+    (messages, next_before); next_before is None on the last page.
+    """
+
+    likes = Likes.__table__
+    query = (db.select([likes.c.created_at, likes.c.message_id])
+             .where(likes.c.user_id == user_id))
+    after = parse_like_cursor(before)
+    if after is not None:
+        query = query.where(db.tuple_(likes.c.created_at, likes.c.message_id)
+                            < db.tuple_(*after))
+
+    rows = shards.session_for_user(user_id).execute(
+        query.order_by(likes.c.created_at.desc(), likes.c.message_id.desc())
+        .limit(limit + 1)).fetchall()
+    next_before = like_cursor(*rows[limit - 1]) if len(rows) > limit else None
+    return messages_by_ids([row[1] for row in rows[:limit]]), next_before
+
+
+def _cards_in_order(user_ids):
+    cards = user_cards(user_ids, active_only=True)
+    return [cards[user_id] for user_id in user_ids if user_id in cards]
+
+
+def following_cards(user_id):
+    """UserCards of the active users `user_id` follows."""
+
+    follow_graph.ensure_loaded()
+    return _cards_in_order(follow_graph.following_ids(user_id))
+
+
+def follower_cards(user_id):
+    """UserCards of the active users following `user_id`."""
+
+    follow_graph.ensure_loaded()
+    return _cards_in_order(follow_graph.follower_ids(user_id))
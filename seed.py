@@ -1,8 +1,18 @@
 """Seed database with sample data from CSV Files."""
 
 from csv import DictReader
-from app import db
-from models import User, Message, Follows
+from datetime import datetime
+from flask import Flask
+from flask_migrate import Migrate, stamp
+from config import get_config
+from models import db, connect_db, User, Message, Follows
+from snowflake import backdated_id
+
+# just the database; the web app's routes and hooks aren't needed here
+app = Flask(__name__)
+app.config.from_object(get_config())
+connect_db(app)
+Migrate(app, db)
 
 
 db.drop_all()
@@ -12,9 +22,17 @@ with open('generator/users.csv') as users:
     db.session.bulk_insert_mappings(User, DictReader(users))
 
 with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+    rows = list(DictReader(messages))
+    for index, row in enumerate(rows):
+        row['timestamp'] = datetime.fromisoformat(row['timestamp'])
+        row['id'] = backdated_id(row['timestamp'], index)
+    db.session.bulk_insert_mappings(Message, rows)
 
 with open('generator/follows.csv') as follows:
     db.session.bulk_insert_mappings(Follows, DictReader(follows))
 
 db.session.commit()
+
+# the tables above match the latest migration, so record that
+with app.app_context():
+    stamp()
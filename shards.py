@@ -0,0 +1,508 @@
+"""Horizontal sharding of messages and likes by user.
+
+Users, follows, tags, notifications and everything else stay in the main
+database. `messages`, `messages_archive` and `likes` can be spread over
+the databases listed in MESSAGE_SHARDS. Each row goes by its user id: a
+message lives with its author, a like with the user who liked.
+
+Users are hashed into NUM_BUCKETS buckets. The `shard_buckets` table in the
+main database says which shard holds each bucket, so rebalancing moves
+whole buckets without rehashing everyone (`flask rebalance-shards`).
+
+With MESSAGE_SHARDS unset there is a single shard, the main database,
+reached through `db.session`. Everything below then behaves exactly as an
+unsharded app would, in one transaction.
+
+Reads that know the user go to one shard. Reads that don't (messages by
+id, like counts, a home timeline of many authors) `scatter()` the query
+across shards in parallel on a thread pool and merge the results. Message
+ids are time-ordered, so merging by id is merging by time.
+
+Shards have no foreign keys into the main database (or, for likes, to
+messages on other shards), so code that deletes messages removes their
+likes explicitly. Create shard tables with `flask init-shards`; alembic
+only manages the main database. Run `flask migrate-message-ids` before
+enabling shards: it only knows the main database.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from threading import Lock
+import time
+
+from flask import current_app
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.orm.attributes import set_committed_value
+
+from models import db, User, Message, ArchivedMessage, Likes, ShardBucket
+
+NUM_BUCKETS = 1024
+POOL_SIZE = 8
+MAP_TTL = 10
+MOVE_BATCH_SIZE = 1000
+
+# created on every shard by `flask init-shards`; copies of the main
+# tables without foreign keys
+shard_metadata = db.MetaData()
+
+db.Table(
+    'messages', shard_metadata,
+    db.Column('id', db.BigInteger, primary_key=True, autoincrement=False),
+    db.Column('text', db.String(140), nullable=False),
+    db.Column('timestamp', db.DateTime, nullable=False),
+    db.Column('user_id', db.Integer, nullable=False),
+    db.Index('ix_messages_user_id_id', 'user_id', 'id'),
+)
+
+db.Table(
+    'messages_archive', shard_metadata,
+    db.Column('id', db.BigInteger, primary_key=True, autoincrement=False),
+    db.Column('text', db.String(140), nullable=False),
+    db.Column('timestamp', db.DateTime, nullable=False),
+    db.Column('user_id', db.Integer, nullable=False),
+    db.Index('ix_messages_archive_user_id_id', 'user_id', 'id'),
+)
+
+db.Table(
+    'likes', shard_metadata,
+    db.Column('user_id', db.Integer, primary_key=True, autoincrement=False),
+    db.Column('message_id', db.BigInteger, primary_key=True,
+              autoincrement=False),
+    db.Column('created_at', db.DateTime, nullable=False),
+    db.Index('ix_likes_user_id_created_at', 'user_id', 'created_at',
+             'message_id'),
+    db.Index('ix_likes_message_id', 'message_id'),
+)
+
+
+def bucket_for(user_id):
+    """`user_id`'s bucket. Multiplicative hashing spreads consecutive ids
+    over all the buckets.
+    """
+
+    return ((user_id * 0x9E3779B1) & 0xFFFFFFFF) * NUM_BUCKETS >> 32
+
+
+class ShardSet:
+    """Engines, sessions and the bucket map for one app's shards."""
+
+    def __init__(self, urls=(), pool_size=POOL_SIZE, map_ttl=MAP_TTL):
+        self.engines = [create_engine(url) for url in urls]
+        self.sessions = [scoped_session(sessionmaker(bind=engine))
+                         for engine in self.engines]
+        # scattered work always runs on the pool, so it never touches the
+        # calling thread's sessions
+        self.pool = ThreadPoolExecutor(pool_size) if self.engines else None
+        self.map_ttl = map_ttl
+        self._map = None
+        self._map_expires = 0.0
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self.engines) or 1
+
+    def bucket_map(self):
+        """{bucket: shard}, re-read from the main database every
+        `map_ttl` seconds so every process follows a rebalance.
+        """
+
+        now = time.monotonic()
+        with self._lock:
+            if self._map is not None and now < self._map_expires:
+                return self._map
+
+        stored = dict(db.session.query(ShardBucket.bucket, ShardBucket.shard))
+        buckets = {bucket: stored.get(bucket, bucket % len(self))
+                   for bucket in range(NUM_BUCKETS)}
+        with self._lock:
+            self._map = buckets
+            self._map_expires = now + self.map_ttl
+        return buckets
+
+    def forget_map(self):
+        with self._lock:
+            self._map = None
+
+    def remove_sessions(self):
+        for session in self.sessions:
+            session.remove()
+
+    def dispose(self):
+        self.remove_sessions()
+        if self.pool is not None:
+            self.pool.shutdown()
+        for engine in self.engines:
+            engine.dispose()
+
+
+def init_app(app):
+    app.extensions['shards'] = ShardSet(
+        app.config.get('MESSAGE_SHARDS') or (),
+        pool_size=app.config.get('SHARD_POOL_SIZE', POOL_SIZE),
+        map_ttl=app.config.get('SHARD_MAP_TTL', MAP_TTL))
+
+    @app.teardown_appcontext
+    def remove_shard_sessions(exc):
+        app.extensions['shards'].remove_sessions()
+
+
+def current():
+    return current_app.extensions['shards']
+
+
+def count():
+    return len(current())
+
+
+def is_sharded():
+    return len(current().engines) > 1
+
+
+def session(shard):
+    """Session for `shard`; `db.session` when unsharded."""
+
+    shards = current()
+    return shards.sessions[shard] if shards.engines else db.session
+
+
+def shard_for_user(user_id):
+    shards = current()
+    if not shards.engines:
+        return 0
+    return shards.bucket_map()[bucket_for(user_id)]
+
+
+def session_for_user(user_id):
+    """Session for the shard holding `user_id`'s messages and likes."""
+
+    return session(shard_for_user(user_id))
+
+
+def commit(shard_session):
+    """Commit `shard_session`, then the main session. One commit when
+    unsharded.
+
+    The two commits aren't atomic. If the main one fails, the shard's rows
+    stay without what went with them in the main database: a like without
+    its notification event, a message without its tag and mention rows
+    (`flask backfill-tags` rebuilds those). Only use this where the main
+    database's writes can be lost or rebuilt like that.
+    """
+
+    shard_session.commit()
+    if shard_session is not db.session:
+        db.session.commit()
+
+
+def rollback(shard_session):
+    shard_session.rollback()
+    if shard_session is not db.session:
+        db.session.rollback()
+
+
+def _run(shard_set, shards, fn, commit):
+    def run(shard):
+        shard_session = shard_set.sessions[shard]
+        try:
+            result = fn(shard, shard_session)
+            if commit:
+                shard_session.commit()
+            return result
+        finally:
+            shard_session.remove()
+
+    return list(shard_set.pool.map(run, shards))
+
+
+def scatter(fn, shards=None, commit=False):
+    """[fn(session) for each shard], run in parallel on the pool.
+
+    `fn` must only use the session it's given; it runs without the app
+    context. Objects it returns are detached, so load what you need
+    (see `attach_users()`). With `commit`, each shard commits what `fn`
+    did; unsharded, it's left in `db.session` for the caller to commit
+    with everything else.
+    """
+
+    shard_set = current()
+    if not shard_set.engines:
+        return [fn(db.session)]
+    if shards is None:
+        shards = range(len(shard_set.engines))
+    return _run(shard_set, shards, lambda shard, shard_session:
+                fn(shard_session), commit)
+
+
+def scatter_by_user(user_ids, fn):
+    """[fn(session, the user_ids on that shard)] over just the shards
+    holding `user_ids`, in parallel.
+    """
+
+    if not user_ids:
+        return []
+
+    shard_set = current()
+    if not shard_set.engines:
+        return [fn(db.session, list(user_ids))]
+
+    by_shard = {}
+    for user_id in user_ids:
+        by_shard.setdefault(shard_for_user(user_id), []).append(user_id)
+    return _run(shard_set, sorted(by_shard), lambda shard, shard_session:
+                fn(shard_session, by_shard[shard]), False)
+
+
+def attach_users(messages):
+    """Set `msg.user` on messages read from shards, with one query to the
+    main database, so templates never lazy-load it from a shard.
+    """
+
+    user_ids = {msg.user_id for msg in messages}
+    if not user_ids:
+        return messages
+
+    users = {user.id: user
+             for user in User.query.filter(User.id.in_(user_ids))}
+    for msg in messages:
+        set_committed_value(msg, 'user', users.get(msg.user_id))
+    return messages
+
+
+##############################################################################
+# Rebalancing
+
+
+def create_tables():
+    """Create the shard tables on every shard that lacks them, and bring
+    older likes tables up to date. Returns how many likes tables it
+    upgraded.
+    """
+
+    upgraded = 0
+    for engine in current().engines:
+        shard_metadata.create_all(engine)
+        upgraded += _upgrade_likes(engine)
+    return upgraded
+
+
+def _upgrade_likes(engine):
+    """Copy a shard's likes table from the serial-id shape to the one in
+    `shard_metadata`, keyed by (user_id, message_id) with created_at.
+    Returns whether there was anything to upgrade.
+
+    Runs in one transaction that holds the table until it's done, so likes
+    on the shard wait. Legacy likes get their message's time from its id,
+    as the earliest time they could have been made.
+    """
+
+    # snowflake imports timeline_cache, which imports this module
+    from snowflake import LEGACY_ID_LIMIT, id_time
+
+    columns = {column['name']
+               for column in inspect(engine).get_columns('likes')}
+    if 'id' not in columns:
+        return False
+
+    likes = shard_metadata.tables['likes']
+    now = datetime.utcnow()
+    with engine.begin() as conn:
+        conn.execute(db.text("ALTER TABLE likes RENAME TO likes_old"))
+        for index in ('ix_likes_user_id_message_id', 'ix_likes_message_id'):
+            conn.execute(db.text(f"DROP INDEX IF EXISTS {index}"))
+        likes.create(conn)
+
+        last = 0
+        while True:
+            rows = conn.execute(db.text(
+                "SELECT id, user_id, message_id FROM likes_old "
+                "WHERE id > :last ORDER BY id LIMIT :limit"),
+                {'last': last, 'limit': MOVE_BATCH_SIZE}).fetchall()
+            if not rows:
+                break
+            last = rows[-1].id
+
+            # the old table allowed duplicates and rows missing either end
+            page = {(row.user_id, row.message_id): row.message_id
+                    for row in rows
+                    if row.user_id is not None and row.message_id is not None}
+            present = {tuple(row) for row in conn.execute(
+                db.select([likes.c.user_id, likes.c.message_id])
+                .where(db.tuple_(likes.c.user_id, likes.c.message_id)
+                       .in_(list(page))))} if page else set()
+            missing = [{'user_id': user_id, 'message_id': message_id,
+                        'created_at': (id_time(message_id)
+                                       if message_id >= LEGACY_ID_LIMIT
+                                       else now)}
+                       for user_id, message_id in page
+                       if (user_id, message_id) not in present]
+            if missing:
+                conn.execute(likes.insert(), missing)
+
+        conn.execute(db.text("DROP TABLE likes_old"))
+    return True
+
+
+def save_map(buckets):
+    """Store {bucket: shard} as the map every process reads."""
+
+    ShardBucket.query.delete()
+    db.session.bulk_insert_mappings(
+        ShardBucket, [{'bucket': bucket, 'shard': shard}
+                      for bucket, shard in sorted(buckets.items())])
+    db.session.commit()
+    current().forget_map()
+
+
+def plan_moves(buckets, shard_count):
+    """Moves that even out {bucket: shard} over `shard_count` shards.
+
+    Buckets on shards that no longer exist always move; otherwise buckets
+    move from the fullest shards to the emptiest, as few as possible.
+    Returns a list of (bucket, from_shard, to_shard).
+    """
+
+    held = {shard: [] for shard in range(shard_count)}
+    homeless = []
+    for bucket, shard in sorted(buckets.items()):
+        (held[shard] if shard in held else homeless).append(bucket)
+
+    base, extra = divmod(len(buckets), shard_count)
+    # the first `extra` shards take one bucket more
+    target = {shard: base + (shard < extra) for shard in held}
+
+    surplus = list(homeless)
+    for shard in held:
+        while len(held[shard]) > target[shard]:
+            surplus.append(held[shard].pop())
+
+    moves = []
+    for shard in held:
+        while len(held[shard]) < target[shard]:
+            bucket = surplus.pop(0)
+            moves.append((bucket, buckets[bucket], shard))
+            held[shard].append(bucket)
+    return moves
+
+
+def _key(values):
+    """A primary key as a value for `IN`: a scalar or a tuple."""
+
+    values = tuple(values)
+    return values[0] if len(values) == 1 else values
+
+
+def _move_rows(table, source, dest, user_ids, delete=False):
+    """Copy the rows of `user_ids` in `table` that `dest` doesn't have yet
+    from `source`, a page at a time in primary key order from the lowest
+    key. With `delete`, each page is then deleted from `source`, once
+    every row in it is on `dest`.
+
+    Safe to re-run. Returns the number of rows deleted.
+    """
+
+    columns = list(table.primary_key.columns)
+    key = columns[0] if len(columns) == 1 else db.tuple_(*columns)
+    names = [column.name for column in table.c]
+    query = (db.select([table])
+             .where(table.c.user_id.in_(user_ids))
+             .order_by(*columns)
+             .limit(MOVE_BATCH_SIZE))
+
+    deleted = 0
+    last = None
+    while True:
+        page = query if last is None else query.where(
+            key > (last if len(columns) == 1 else db.tuple_(*last)))
+        rows = [dict(zip(names, row))
+                for row in source.execute(page).fetchall()]
+        if not rows:
+            return deleted
+
+        keys = [_key(row[column.name] for column in columns) for row in rows]
+        present = {_key(row) for row in
+                   dest.execute(db.select(columns).where(key.in_(keys)))}
+        missing = [row for row, row_key in zip(rows, keys)
+                   if row_key not in present]
+        if missing:
+            dest.execute(table.insert(), missing)
+        dest.commit()
+
+        if delete:
+            deleted += source.execute(
+                table.delete().where(key.in_(keys))).rowcount
+            source.commit()
+        last = keys[-1]
+
+
+def _count_rows(shard_session, tables, user_ids):
+    return sum(shard_session.execute(
+        db.select([db.func.count()]).select_from(table)
+        .where(table.c.user_id.in_(user_ids))).scalar()
+        for table in tables)
+
+
+def move_bucket(bucket, from_shard, to_shard, settle=None):
+    """Move one bucket's messages and likes, then point the map at
+    `to_shard`.
+
+    Rows are copied, the map is switched, and after `settle` seconds (long
+    enough for every process to re-read the map) the copy runs again to
+    pick up anything written to the old shard meanwhile, deleting each
+    page from the old shard once the new one has all of it. Copies page
+    through primary keys from the lowest, so ids of any sign and backdated
+    imports below earlier pages are all moved. Every step can be re-run.
+
+    Deletes, likes and unlikes on the old shard inside the settle window
+    can be lost, so rebalance when traffic is quiet. Raises RuntimeError if
+    rows are still being written to the old shard after the final copy;
+    they stay there until `move_bucket` is run again.
+    """
+
+    if settle is None:
+        settle = current().map_ttl + 1
+
+    user_ids = [user_id for user_id, in db.session.query(User.id)
+                if bucket_for(user_id) == bucket]
+    source, dest = session(from_shard), session(to_shard)
+    tables = [Message.__table__, ArchivedMessage.__table__, Likes.__table__]
+
+    batches = [user_ids[start:start + MOVE_BATCH_SIZE]
+               for start in range(0, len(user_ids), MOVE_BATCH_SIZE)]
+    for batch in batches:
+        for table in tables:
+            _move_rows(table, source, dest, batch)
+
+    db.session.merge(ShardBucket(bucket=bucket, shard=to_shard))
+    db.session.commit()
+    current().forget_map()
+    if batches:
+        time.sleep(settle)
+
+    moved = 0
+    for batch in batches:
+        for table in tables:
+            moved += _move_rows(table, source, dest, batch, delete=True)
+
+        left = _count_rows(source, tables, batch)
+        if left:
+            raise RuntimeError(
+                f"{left} rows were written to shard {from_shard} while "
+                f"moving bucket {bucket}; run the move again")
+
+    return moved
+
+
+def rebalance(dry_run=False, settle=None):
+    """Even out buckets over the configured shards. Returns the moves."""
+
+    buckets = current().bucket_map()
+    if not ShardBucket.query.first():
+        # first run: record the default layout before changing it
+        save_map(buckets)
+
+    moves = plan_moves(buckets, count())
+    if not dry_run:
+        for bucket, from_shard, to_shard in moves:
+            move_bucket(bucket, from_shard, to_shard, settle=settle)
+    return moves
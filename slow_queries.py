@@ -0,0 +1,209 @@
+"""Slow-query log with the plan of each slow query.
+
+Most of our SQL is generated by the ORM (timelines, `User.likes`, the
+relationship loads in templates), so a query that gets slower as the
+tables grow is hard to spot by reading code. `slow_queries` times every
+statement. When one takes longer than SLOW_QUERY_MS it records:
+
+- the SQL (without its parameters, which may hold user data),
+- how long it took,
+- the route that issued it,
+- the statement's plan from `EXPLAIN`.
+
+On Postgres, 1 in SLOW_QUERY_ANALYZE_RATE plans use `EXPLAIN ANALYZE`,
+which runs the query a second time. Only SELECTs are explained, and each
+distinct statement at most once per EXPLAIN_COOLDOWN seconds, so a
+regression that slows every request doesn't double the load. Tables the
+plan reads with a sequential scan are listed on the entry.
+
+The newest SLOW_QUERY_BUFFER_SIZE entries are kept in memory per process
+and shown at /admin/slow-queries (or /admin/slow-queries.jsonl). Set
+SLOW_QUERY_LOG to also append every entry to a JSON Lines file shared by
+all processes.
+"""
+
+from collections import deque
+from datetime import datetime
+import json
+import logging
+import random
+import re
+from threading import Lock
+import time
+
+from flask import current_app, has_app_context, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+BUFFER_SIZE = 200
+EXPLAIN_COOLDOWN = 60
+
+SEQ_SCAN_RES = {
+    'postgresql': re.compile(r'Seq Scan on (\w+)'),
+    # "SCAN messages" is a full scan; indexed reads are "SEARCH ..." or
+    # "SCAN messages USING [COVERING] INDEX ..."
+    'sqlite': re.compile(r'^SCAN (?:TABLE )?(\w+)(?!.*USING)', re.M),
+}
+
+
+def _explain_prefix(dialect, analyze):
+    if dialect == 'postgresql':
+        return "EXPLAIN (ANALYZE, BUFFERS) " if analyze else "EXPLAIN "
+    if dialect == 'sqlite':
+        return "EXPLAIN QUERY PLAN "
+    return "EXPLAIN "
+
+
+def _format_plan(dialect, rows):
+    if dialect == 'postgresql':
+        return "\n".join(row[0] for row in rows)
+    if dialect == 'sqlite':
+        return "\n".join(row[-1] for row in rows)
+    return "\n".join(str(row) for row in rows)
+
+
+def seq_scans(dialect, plan):
+    """Tables `plan` reads in full."""
+
+    pattern = SEQ_SCAN_RES.get(dialect)
+    return sorted(set(pattern.findall(plan))) if pattern and plan else []
+
+
+class SlowQueryLog:
+    """Records statements slower than SLOW_QUERY_MS, with their plans."""
+
+    def __init__(self, size=BUFFER_SIZE):
+        self._entries = deque(maxlen=size)
+        self._explained = {}
+        self._lock = Lock()
+        self._listening = False
+
+    def init_app(self, app):
+        size = app.config.get('SLOW_QUERY_BUFFER_SIZE', BUFFER_SIZE)
+        with self._lock:
+            if self._entries.maxlen != size:
+                self._entries = deque(self._entries, maxlen=size)
+            if not self._listening:
+                # every engine, including ones made after this call
+                event.listen(Engine, 'before_cursor_execute', self._before)
+                event.listen(Engine, 'after_cursor_execute', self._after)
+                self._listening = True
+
+    def entries(self):
+        """Recorded entries, newest first."""
+
+        with self._lock:
+            return list(reversed(self._entries))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._explained.clear()
+
+    def _before(self, conn, cursor, statement, parameters, context,
+                executemany):
+        conn.info['query_started'] = time.perf_counter()
+
+    def _after(self, conn, cursor, statement, parameters, context,
+               executemany):
+        started = conn.info.pop('query_started', None)
+        if started is None or not has_app_context():
+            return
+
+        threshold = current_app.config.get('SLOW_QUERY_MS')
+        duration_ms = (time.perf_counter() - started) * 1000
+        if threshold is None or duration_ms < threshold:
+            return
+
+        try:
+            self.record(conn, statement, parameters, executemany, duration_ms)
+        except Exception:
+            # never fail the query we were only watching
+            logger.exception("Couldn't record slow query")
+
+    def _should_explain(self, statement, executemany):
+        if executemany or not statement.lstrip().lower().startswith('select'):
+            return False
+
+        now = time.monotonic()
+        with self._lock:
+            if now < self._explained.get(statement, 0):
+                return False
+            if len(self._explained) > 1000:
+                self._explained.clear()
+            self._explained[statement] = now + current_app.config.get(
+                'SLOW_QUERY_EXPLAIN_COOLDOWN', EXPLAIN_COOLDOWN)
+        return True
+
+    def explain(self, conn, statement, parameters, analyze=False):
+        """Plan for `statement`, run on `conn`'s own DBAPI connection so it
+        sees the same transaction. Returns None if EXPLAIN fails.
+        """
+
+        dialect = conn.dialect.name
+        cursor = conn.connection.cursor()
+        # a failed statement aborts the whole transaction on Postgres;
+        # fence EXPLAIN off in a savepoint so the request carries on
+        savepoint = dialect == 'postgresql'
+        try:
+            if savepoint:
+                cursor.execute("SAVEPOINT slow_query_explain")
+            try:
+                cursor.execute(_explain_prefix(dialect, analyze) + statement,
+                               parameters)
+                rows = cursor.fetchall()
+            except Exception:
+                if savepoint:
+                    cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+                logger.warning("EXPLAIN failed", exc_info=True)
+                return None
+            if savepoint:
+                cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+        finally:
+            cursor.close()
+
+        return _format_plan(dialect, rows)
+
+    def record(self, conn, statement, parameters, executemany, duration_ms):
+        config = current_app.config
+        dialect = conn.dialect.name
+
+        plan = None
+        analyzed = False
+        if self._should_explain(statement, executemany):
+            rate = config.get('SLOW_QUERY_ANALYZE_RATE') or 0
+            analyzed = (dialect == 'postgresql' and rate > 0 and
+                        random.randrange(rate) == 0)
+            plan = self.explain(conn, statement, parameters, analyze=analyzed)
+
+        entry = {
+            'at': datetime.utcnow().isoformat(),
+            'duration_ms': round(duration_ms, 1),
+            'sql': statement,
+            'endpoint': request.endpoint if has_request_context() else None,
+            'path': request.path if has_request_context() else None,
+            'plan': plan,
+            'analyzed': analyzed and plan is not None,
+            'seq_scans': seq_scans(dialect, plan),
+        }
+
+        with self._lock:
+            self._entries.append(entry)
+
+        path = config.get('SLOW_QUERY_LOG')
+        if path:
+            with open(path, 'a') as f:
+                f.write(json.dumps(entry) + "\n")
+
+        logger.warning("Slow query (%.0f ms) from %s: %s", duration_ms,
+                       entry['endpoint'], " ".join(statement.split())[:200])
+        return entry
+
+
+def to_jsonl(entries):
+    return "".join(json.dumps(entry) + "\n" for entry in entries)
+
+
+slow_queries = SlowQueryLog()
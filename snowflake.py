@@ -0,0 +1,335 @@
+"""Time-ordered 64-bit message ids.
+
+Message ids are generated in the app instead of by a database sequence,
+Snowflake-style:
+
+    | 41 bits: ms since EPOCH | 10 bits: worker | 12 bits: sequence |
+
+so sorting by id sorts by posting time. Timelines, cursors and the archive
+cutoff can then work on the primary key alone instead of the (unindexed,
+non-unique) timestamp.
+
+Each process needs its own worker id. Set SNOWFLAKE_WORKER_ID to pin one,
+or leave it unset and each process leases a free id from
+`id_worker_leases`. It renews the lease every RENEW_SECONDS, and a lease
+that isn't renewed for LEASE_SECONDS can be taken by another process.
+
+The top bit of the worker field marks backdated ids, for rows whose
+time is in the past: imported messages that carry their own timestamp, and
+legacy rows renumbered by `migrate_legacy_ids()`. Live workers only use ids
+0-511, so these can never collide with ids generated now. EPOCH is set well
+before the oldest data, so backdated ids are never negative; dates before
+MIN_BACKDATE, and dates in the future, are refused.
+"""
+
+from datetime import datetime, timedelta
+import os
+import socket
+from threading import Lock
+import time
+import uuid
+
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+
+from cache import cache, messages_tag
+from jobs import job
+from models import (db, Message, ArchivedMessage, Likes, MessageTag, Mention,
+                    Notification, NotificationEvent, IdWorkerLease)
+from timeline_cache import recent_messages
+
+# 41 bits of milliseconds last until 2069 (MAX_TIME)
+EPOCH = datetime(2000, 1, 1)
+EPOCH_UNIX_MS = (EPOCH - datetime(1970, 1, 1)) // timedelta(milliseconds=1)
+
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+MAX_WORKERS = 1 << (WORKER_BITS - 1)
+BACKDATED = 1 << (WORKER_BITS - 1 + SEQUENCE_BITS)
+TIME_SHIFT = WORKER_BITS + SEQUENCE_BITS
+
+# serial ids from before this change are all below this; every Snowflake id
+# (anything generated more than a second after EPOCH) is above it
+LEGACY_ID_LIMIT = 1 << 32
+MIN_BACKDATE = EPOCH + timedelta(milliseconds=LEGACY_ID_LIMIT >> TIME_SHIFT)
+# the last millisecond that fits the time field of a signed 64-bit id
+MAX_TIME = EPOCH + timedelta(milliseconds=(1 << (63 - TIME_SHIFT)) - 1)
+
+LEASE_SECONDS = 600
+RENEW_SECONDS = 60
+
+BATCH_SIZE = 1000
+PAUSE_SECONDS = 0.05
+
+
+def to_ms(dt):
+    """Milliseconds from EPOCH to naive UTC datetime `dt`."""
+
+    return (dt - EPOCH) // timedelta(milliseconds=1)
+
+
+def make_id(ms, worker_id, sequence=0):
+    return (ms << TIME_SHIFT) | (worker_id << SEQUENCE_BITS) | sequence
+
+
+def id_time(message_id):
+    """When `message_id` was generated (or backdated to)."""
+
+    return EPOCH + timedelta(milliseconds=message_id >> TIME_SHIFT)
+
+
+def id_floor(dt):
+    """Smallest id generated at or after `dt`; for range filters."""
+
+    return make_id(max(to_ms(dt), 0), 0)
+
+
+def backdated_id(dt, n):
+    """Id for a row dated `dt`, made unique within its millisecond by `n`.
+
+    Two rows dated to the same millisecond collide only if their `n` are
+    equal modulo 2**21. `dt` is naive UTC. Raises ValueError for dates
+    before MIN_BACKDATE, whose ids would fall among the legacy serial ids,
+    and for dates in the future, whose ids would sort above every message
+    posted until then (or past MAX_TIME, not fit in 64 bits at all).
+    """
+
+    if dt < MIN_BACKDATE:
+        raise ValueError(f"can't give an id to a date before {MIN_BACKDATE}")
+    if dt > MAX_TIME:
+        raise ValueError(f"can't give an id to a date after {MAX_TIME}")
+    if dt > datetime.utcnow():
+        raise ValueError(f"can't backdate an id to a future date, {dt}")
+    return (to_ms(dt) << TIME_SHIFT) | BACKDATED | (n & (BACKDATED - 1))
+
+
+class BackdatedIds:
+    """Backdated ids for one import, numbered by a counter.
+
+    Rows in the same import never collide until it passes 2**21 rows. The
+    counter starts at a random point, so two imports only collide if they
+    have rows in the same millisecond at the same count from their starts;
+    re-importing the same rows in the same order collides with chance
+    1 in 2**21.
+    """
+
+    def __init__(self, start=None):
+        self._n = (int.from_bytes(os.urandom(3), 'big')
+                   if start is None else start)
+
+    def __call__(self, dt):
+        self._n += 1
+        return backdated_id(dt, self._n)
+
+
+class SnowflakeGenerator:
+    """Unique, increasing ids for one worker id. Thread-safe."""
+
+    def __init__(self, worker_id, clock=time.time):
+        if not 0 <= worker_id < MAX_WORKERS:
+            raise ValueError(f"worker id must be in 0-{MAX_WORKERS - 1}")
+
+        self.worker_id = worker_id
+        self.pid = os.getpid()
+        self._clock = clock
+        self._last_ms = -1
+        self._sequence = 0
+        self._lock = Lock()
+
+    def next_id(self):
+        with self._lock:
+            ms = int(self._clock() * 1000) - EPOCH_UNIX_MS
+            # if the clock steps back, or we've used all 4096 ids in this
+            # millisecond, keep counting forward from the last one rather
+            # than wait
+            if ms <= self._last_ms:
+                ms = self._last_ms
+                self._sequence += 1
+                if self._sequence > MAX_SEQUENCE:
+                    ms += 1
+                    self._sequence = 0
+            else:
+                self._sequence = 0
+
+            self._last_ms = ms
+            return make_id(ms, self.worker_id, self._sequence)
+
+
+##############################################################################
+# Worker id leases
+
+
+def claim_lease(engine, owner, now=None):
+    """Lease the lowest free worker id for `owner`. Returns the id."""
+
+    leases = IdWorkerLease.__table__
+    now = now or datetime.utcnow()
+    expires_at = now + timedelta(seconds=LEASE_SECONDS)
+
+    with engine.connect() as conn:
+        taken = dict(conn.execute(
+            db.select([leases.c.worker_id, leases.c.expires_at])).fetchall())
+
+    for worker_id in range(MAX_WORKERS):
+        if worker_id in taken and taken[worker_id] > now:
+            continue
+        try:
+            with engine.begin() as conn:
+                if worker_id in taken:
+                    # expired: take it over, unless someone else just did
+                    claimed = conn.execute(
+                        leases.update()
+                        .where(leases.c.worker_id == worker_id)
+                        .where(leases.c.expires_at == taken[worker_id])
+                        .values(owner=owner, expires_at=expires_at)).rowcount
+                else:
+                    conn.execute(leases.insert().values(
+                        worker_id=worker_id, owner=owner,
+                        expires_at=expires_at))
+                    claimed = 1
+        except IntegrityError:
+            continue
+        if claimed:
+            return worker_id
+
+    raise RuntimeError("No free snowflake worker ids")
+
+
+def renew_lease(engine, worker_id, owner, now=None):
+    """Extend our lease. False if it expired and someone else took it."""
+
+    leases = IdWorkerLease.__table__
+    expires_at = (now or datetime.utcnow()) + timedelta(seconds=LEASE_SECONDS)
+
+    with engine.begin() as conn:
+        return conn.execute(
+            leases.update()
+            .where(leases.c.worker_id == worker_id)
+            .where(leases.c.owner == owner)
+            .values(expires_at=expires_at)).rowcount == 1
+
+
+_generator = None
+_renew_at = 0.0
+_lock = Lock()
+
+
+def _new_owner():
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+_owner = _new_owner()
+
+
+def _current_generator():
+    """This process's generator, (re)leasing a worker id when due."""
+
+    global _generator, _renew_at, _owner
+
+    with _lock:
+        generator = _generator
+        if generator is not None and generator.pid != os.getpid():
+            # forked after the parent made one: never share its worker id
+            generator = None
+            _owner = _new_owner()
+
+        fixed = current_app.config.get('SNOWFLAKE_WORKER_ID')
+        if fixed is not None:
+            if generator is None or generator.worker_id != fixed:
+                generator = SnowflakeGenerator(fixed)
+        elif generator is None:
+            generator = SnowflakeGenerator(claim_lease(db.engine, _owner))
+            _renew_at = time.monotonic() + RENEW_SECONDS
+        elif time.monotonic() >= _renew_at:
+            if not renew_lease(db.engine, generator.worker_id, _owner):
+                generator = SnowflakeGenerator(claim_lease(db.engine, _owner))
+            _renew_at = time.monotonic() + RENEW_SECONDS
+
+        _generator = generator
+        return generator
+
+
+def next_id():
+    """A new message id."""
+
+    return _current_generator().next_id()
+
+
+##############################################################################
+# Renumbering legacy rows
+
+# every column holding a message id
+MESSAGE_ID_REFERENCES = (
+    Likes.message_id,
+    MessageTag.message_id,
+    Mention.message_id,
+    Notification.message_id,
+    NotificationEvent.message_id,
+)
+
+
+def migrate_legacy_ids(batch_size=BATCH_SIZE, pause=PAUSE_SECONDS):
+    """Give rows with serial ids backdated Snowflake ids, in batches.
+
+    The new id comes from the row's timestamp and its old id, so a timeline
+    sorted by the new ids shows legacy rows in the order it used to (by
+    timestamp, then id). New ids are all at least LEGACY_ID_LIMIT, so rows
+    already renumbered are never picked up again. Each batch copies rows to their new ids, repoints
+    everything that refers to them and deletes the old rows, in one
+    transaction. Returns the number of rows renumbered.
+    """
+
+    moved = 0
+    for model in (Message, ArchivedMessage):
+        table = model.__table__
+
+        while True:
+            rows = db.session.execute(
+                db.select([table])
+                .where(table.c.id >= 0, table.c.id < LEGACY_ID_LIMIT)
+                .order_by(table.c.id)
+                .limit(batch_size)).fetchall()
+            if not rows:
+                break
+
+            new_ids = [{'old_id': row.id,
+                        'new_id': backdated_id(row.timestamp, row.id)}
+                       for row in rows]
+
+            # copies first, so likes can point at them before the old
+            # rows (and their cascades) go
+            db.session.execute(table.insert(), [
+                dict(row, id=ids['new_id'])
+                for row, ids in zip(rows, new_ids)])
+            for column in MESSAGE_ID_REFERENCES:
+                db.session.execute(
+                    column.table.update()
+                    .where(column == db.bindparam('old_id'))
+                    .values({column.name: db.bindparam('new_id')}),
+                    new_ids)
+            db.session.execute(table.delete().where(
+                table.c.id.in_([row.id for row in rows])))
+            db.session.commit()
+            moved += len(rows)
+
+            authors = {row.user_id for row in rows}
+            for author_id in authors:
+                recent_messages.forget(author_id)
+            cache.invalidate(*[messages_tag(author_id)
+                               for author_id in authors])
+
+            if pause:
+                time.sleep(pause)
+
+    return moved
+
+
+@job('migrate_message_ids')
+def migrate_legacy_ids_job():
+    """Job handler: renumber legacy rows using the app's batch settings."""
+
+    config = current_app.config
+    migrate_legacy_ids(
+        batch_size=config.get('MESSAGE_ID_MIGRATION_BATCH_SIZE', BATCH_SIZE),
+        pause=config.get('MESSAGE_ID_MIGRATION_PAUSE', PAUSE_SECONDS))
@@ -0,0 +1,210 @@
+"""#tag and @mention index for messages.
+
+`Message.text` is an opaque string, so "every message tagged #python" or
+"every message mentioning me" would otherwise be a full scan with LIKE.
+When a message is posted its tags and mentions are parsed out and written
+to `message_tags` and `mentions`. Both tables have the search key first in
+their primary key, so a timeline page is one index range scan.
+
+Timelines page by message id (newest first) with a keyset cursor: each
+page hands back the last id it showed, and the next page asks for ids
+below it. Unlike OFFSET, that costs the same however deep you page.
+
+Messages posted before this index existed are indexed by `index_messages`
+jobs, each covering one id range; `backfill()` queues one per chunk, so
+`flask worker --concurrency N` works through them in parallel.
+"""
+
+import re
+
+from archive import find_messages
+from jobs import job, enqueue
+from models import db, User, Message, ArchivedMessage, MessageTag, Mention
+import shards
+
+TAG_RE = re.compile(r'(?<![\w#@])#(\w+)')
+MENTION_RE = re.compile(r'(?<![\w#@])@(\w+)')
+
+MAX_TAG_LENGTH = 50
+PAGE_SIZE = 20
+BACKFILL_CHUNK_SIZE = 5000
+
+# message ids are signed 64-bit; cursors outside that can't be bound
+MIN_ID = -2 ** 63
+MAX_ID = 2 ** 63 - 1
+
+
+def extract_tags(text):
+    """Distinct tags in `text`, lowercased, without the '#'."""
+
+    return sorted({tag.lower() for tag in TAG_RE.findall(text)
+                   if len(tag) <= MAX_TAG_LENGTH})
+
+
+def extract_mentions(text):
+    """Distinct usernames @mentioned in `text`, lowercased, without the
+    '@'. Usernames are unique ignoring case, so @Bob means bob.
+    """
+
+    return sorted({name.lower() for name in MENTION_RE.findall(text)})
+
+
+def index_messages(messages):
+    """Add index rows for `messages`, any objects with `id` and `text`.
+
+    Doesn't commit; call it in the same transaction as the insert. Returns
+    the (user_id, message_id) pairs of the mentions it found.
+    """
+
+    tag_rows = []
+    mentioned = {}
+    for msg in messages:
+        tag_rows.extend({'tag': tag, 'message_id': msg.id}
+                        for tag in extract_tags(msg.text))
+        for username in extract_mentions(msg.text):
+            mentioned.setdefault(username, []).append(msg.id)
+
+    mention_rows = []
+    if mentioned:
+        # one query resolves every username in the batch
+        lowered = db.func.lower(User.username)
+        users = (db.session.query(lowered, User.id)
+                 .filter(lowered.in_(mentioned),
+                         User.deleted_at.is_(None)))
+        for username, user_id in users:
+            mention_rows.extend({'user_id': user_id, 'message_id': msg_id}
+                                for msg_id in mentioned[username])
+
+    if tag_rows:
+        db.session.execute(MessageTag.__table__.insert(), tag_rows)
+    if mention_rows:
+        db.session.execute(Mention.__table__.insert(), mention_rows)
+
+    return [(row['user_id'], row['message_id']) for row in mention_rows]
+
+
+def unindex_messages(message_ids):
+    """Drop index rows for `message_ids`. Doesn't commit."""
+
+    if not message_ids:
+        return
+
+    (MessageTag.query
+     .filter(MessageTag.message_id.in_(message_ids))
+     .delete(synchronize_session=False))
+    (Mention.query
+     .filter(Mention.message_id.in_(message_ids))
+     .delete(synchronize_session=False))
+
+
+def index_range(start_id, end_id):
+    """(Re)index messages with start_id <= id < end_id, in both the hot
+    table and the archive of every shard, and commit. Returns how many were
+    read.
+    """
+
+    indexed = 0
+    for shard in range(shards.count()):
+        for model in (Message, ArchivedMessage):
+            rows = (shards.session(shard).query(model.id, model.text)
+                    .filter(model.id >= start_id, model.id < end_id)
+                    .all())
+            # safe to re-run: replace whatever this range already had
+            unindex_messages([row.id for row in rows])
+            index_messages(rows)
+            indexed += len(rows)
+
+    db.session.commit()
+    return indexed
+
+
+@job('index_messages')
+def index_messages_job(start_id, end_id):
+    """Job handler: index one id range."""
+
+    index_range(start_id, end_id)
+
+
+def _chunk_starts(session, model, chunk_size):
+    """First id of every `chunk_size` run of `model` ids, in order."""
+
+    start = session.query(db.func.min(model.id)).scalar()
+    while start is not None:
+        yield start
+        start = (session.query(model.id)
+                 .filter(model.id >= start)
+                 .order_by(model.id)
+                 .offset(chunk_size)
+                 .limit(1)
+                 .scalar())
+
+
+def backfill(chunk_size=BACKFILL_CHUNK_SIZE):
+    """Queue `index_messages` jobs covering every message ever posted, each
+    for at most `chunk_size` messages per table. Returns the number of jobs
+    queued.
+    """
+
+    # ids are sparse (see snowflake.py), so chunk boundaries come from the
+    # ids that exist rather than from stepping through the id range
+    starts = set()
+    end_id = None
+    for shard in range(shards.count()):
+        session = shards.session(shard)
+        for model in (Message, ArchivedMessage):
+            starts.update(_chunk_starts(session, model, chunk_size))
+            high = session.query(db.func.max(model.id)).scalar()
+            if high is not None:
+                end_id = high + 1 if end_id is None else max(end_id, high + 1)
+
+    starts = sorted(starts)
+    for start_id, next_start in zip(starts, starts[1:] + [end_id]):
+        enqueue('index_messages', priority=-1,
+                start_id=start_id, end_id=next_start)
+    db.session.commit()
+
+    return len(starts)
+
+
+def _clamp_id(value):
+    """`value` moved into the range of a message id."""
+
+    return min(max(value, MIN_ID), MAX_ID)
+
+
+def _page(message_ids, limit):
+    """Turn `limit + 1` ids into (messages, cursor for the next page)."""
+
+    next_before = message_ids[limit - 1] if len(message_ids) > limit else None
+    messages = [msg for msg in find_messages(message_ids[:limit])
+                if msg.user.deleted_at is None]
+    return messages, next_before
+
+
+def tag_timeline(tag, before=None, limit=PAGE_SIZE):
+    """Newest messages tagged `tag` with id below `before`.
+
+    Returns (messages, next_before); next_before is None on the last page.
+    """
+
+    query = (db.session.query(MessageTag.message_id)
+             .filter(MessageTag.tag == tag.lower()))
+    if before is not None:
+        query = query.filter(MessageTag.message_id < _clamp_id(before))
+
+    ids = [row[0] for row in
+           query.order_by(MessageTag.message_id.desc()).limit(limit + 1)]
+    return _page(ids, limit)
+
+
+def mentions_timeline(user_id, before=None, limit=PAGE_SIZE):
+    """Newest messages mentioning `user_id`, paged like `tag_timeline()`."""
+
+    query = (db.session.query(Mention.message_id)
+             .filter(Mention.user_id == user_id))
+    if before is not None:
+        query = query.filter(Mention.message_id < _clamp_id(before))
+
+    ids = [row[0] for row in
+           query.order_by(Mention.message_id.desc()).limit(limit + 1)]
+    return _page(ids, limit)
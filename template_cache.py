@@ -0,0 +1,178 @@
+"""Precompiled templates and per-template render times.
+
+Jinja compiles each template from source to Python the first time a
+process loads it. With macros, includes and `base.html`, a freshly spawned
+worker spends its first requests compiling, so every deploy and scale-up
+shows a spike of slow renders.
+
+`flask compile-templates` compiles the whole `templates/` tree into a
+bytecode cache in TEMPLATE_CACHE_DIR. Run it as part of the build, in the
+directory the app will run from, because entries are keyed by template
+name and path. Workers then load templates by unmarshalling bytecode, with
+no compiling. Each entry stores a hash of the template source it was
+compiled from. When that hash doesn't match the current source, the entry
+is ignored and rewritten, so an edited template is never served stale.
+With TEMPLATE_PRELOAD on, `create_app()` loads every template before
+serving, so the first request doesn't pay for loading either.
+
+Every template load and every top-level render is timed per template.
+Renders of included and extended templates count toward the page that
+pulled them in. Totals for this process are shown at /admin/templates.
+"""
+
+import os
+from threading import Lock
+import time
+
+from jinja2 import BaseLoader, FileSystemBytecodeCache, Template
+
+
+class TemplateStats:
+    """Load and render counts and times per template name."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._stats = {}
+
+    def _entry(self, name):
+        return self._stats.setdefault(name, {
+            'renders': 0, 'render_ms': 0.0, 'max_render_ms': 0.0,
+            'loads': 0, 'load_ms': 0.0, 'compiles': 0})
+
+    def record_render(self, name, ms):
+        with self._lock:
+            entry = self._entry(name)
+            entry['renders'] += 1
+            entry['render_ms'] += ms
+            entry['max_render_ms'] = max(entry['max_render_ms'], ms)
+
+    def record_load(self, name, ms):
+        with self._lock:
+            entry = self._entry(name)
+            entry['loads'] += 1
+            entry['load_ms'] += ms
+
+    def record_compile(self, name):
+        with self._lock:
+            self._entry(name)['compiles'] += 1
+
+    def stats(self):
+        """{name: counters}, with the average render time filled in."""
+
+        with self._lock:
+            stats = {name: dict(entry) for name, entry in self._stats.items()}
+        for entry in stats.values():
+            entry['avg_render_ms'] = (entry['render_ms'] / entry['renders']
+                                      if entry['renders'] else None)
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._stats.clear()
+
+
+template_stats = TemplateStats()
+
+
+class TimedTemplate(Template):
+    """A template that records how long each `render()` takes."""
+
+    def render(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            template_stats.record_render(
+                self.name, (time.perf_counter() - started) * 1000)
+
+
+class TimedLoader(BaseLoader):
+    """Wraps the app's loader to time each template load."""
+
+    def __init__(self, loader):
+        self.loader = loader
+
+    def get_source(self, environment, template):
+        return self.loader.get_source(environment, template)
+
+    def list_templates(self):
+        return self.loader.list_templates()
+
+    def load(self, environment, name, globals=None):
+        started = time.perf_counter()
+        try:
+            return super().load(environment, name, globals)
+        finally:
+            template_stats.record_load(
+                name, (time.perf_counter() - started) * 1000)
+
+
+class TemplateBytecodeCache(FileSystemBytecodeCache):
+    """Bytecode on disk; counts the loads that had to compile."""
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        super().__init__(directory)
+
+    def get_bucket(self, environment, name, filename, source):
+        bucket = super().get_bucket(environment, name, filename, source)
+        if bucket.code is None:
+            # missing, from another Jinja or Python version, or compiled
+            # from different source
+            template_stats.record_compile(name)
+        return bucket
+
+
+def compile_templates(env):
+    """Load every template through `env`'s bytecode cache.
+
+    Returns (compiled, cached): how many had to be compiled and how many
+    were already up to date.
+    """
+
+    bcc = env.bytecode_cache
+    compiled = cached = 0
+    for name in env.list_templates():
+        source, filename, _ = env.loader.get_source(env, name)
+        bucket = bcc.get_bucket(env, name, filename, source)
+        if bucket.code is None:
+            bucket.code = env.compile(source, name, filename)
+            bcc.set_bucket(bucket)
+            compiled += 1
+        else:
+            cached += 1
+    return compiled, cached
+
+
+def preload(env):
+    """Load every template into `env`'s in-memory cache."""
+
+    names = env.list_templates()
+    for name in names:
+        env.get_template(name)
+    return len(names)
+
+
+class TemplateCache:
+    """Wires the bytecode cache, preloading and timing into an app."""
+
+    def init_app(self, app):
+        """Call after the app's Jinja globals are set: on older Jinja,
+        templates copy the globals when they're loaded.
+        """
+
+        env = app.jinja_env
+        env.template_class = TimedTemplate
+        env.loader = TimedLoader(env.loader)
+
+        directory = app.config.get('TEMPLATE_CACHE_DIR')
+        if directory:
+            env.bytecode_cache = TemplateBytecodeCache(directory)
+        if app.config.get('TEMPLATE_PRELOAD'):
+            preload(env)
+
+    def stats(self):
+        return template_stats.stats()
+
+
+template_cache = TemplateCache()
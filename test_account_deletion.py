@@ -0,0 +1,108 @@
+"""Account deletion tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_account_deletion.py
+
+
+from datetime import datetime
+
+from account_deletion import tombstone_user, purge_user, purge_pending
+from models import (db, User, Message, ArchivedMessage, Follows, Likes,
+                    MessageTag, Mention, AccountDeletion)
+
+from testing import DatabaseTestCase
+
+
+class AccountDeletionTestCase(DatabaseTestCase):
+    """Test tombstoning and purging accounts in batches."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.alice = User.signup("alice", "alice@test.com", "password", None)
+        self.bob = User.signup("bob", "bob@test.com", "password", None)
+        db.session.flush()
+
+        self.posts = [Message(text=f"#post {n}", user_id=self.alice.id)
+                      for n in range(5)]
+        self.reply = Message(text="@alice hi", user_id=self.bob.id)
+        old = ArchivedMessage(id=1, text="old", user_id=self.alice.id,
+                              timestamp=datetime(2020, 1, 1))
+        db.session.add_all(self.posts + [self.reply, old])
+        db.session.flush()
+
+        db.session.add_all(
+            [MessageTag(tag="post", message_id=msg.id) for msg in self.posts] +
+            [Mention(user_id=self.alice.id, message_id=self.reply.id),
+             Likes(user_id=self.bob.id, message_id=self.posts[0].id),
+             Likes(user_id=self.bob.id, message_id=self.posts[1].id),
+             Likes(user_id=self.alice.id, message_id=self.reply.id),
+             Follows(user_following_id=self.alice.id,
+                     user_being_followed_id=self.bob.id),
+             Follows(user_following_id=self.bob.id,
+                     user_being_followed_id=self.alice.id)])
+        db.session.commit()
+        self.alice_id = self.alice.id
+
+    def test_tombstone(self):
+        """Is the account hidden at once, with its rows left for later?"""
+
+        tombstone_user(self.alice)
+
+        self.assertIsNone(User.active().filter_by(id=self.alice_id).first())
+        self.assertEqual(AccountDeletion.query.get(self.alice_id).status,
+                         'pending')
+        self.assertEqual(Message.query.filter_by(
+            user_id=self.alice_id).count(), 5)
+
+    def test_purge(self):
+        """Are all the user's rows deleted, in batches, and counted?"""
+
+        tombstone_user(self.alice)
+        progress = purge_user(self.alice_id, batch_size=2, pause=0)
+
+        self.assertEqual(progress.status, 'finished')
+        self.assertIsNotNone(progress.finished_at)
+        self.assertEqual(progress.messages_deleted, 6)
+        self.assertEqual(progress.likes_deleted, 3)
+        self.assertEqual(progress.follows_deleted, 2)
+
+        self.assertIsNone(User.query.get(self.alice_id))
+        self.assertEqual(Message.query.all(), [self.reply])
+        self.assertEqual(ArchivedMessage.query.count(), 0)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(MessageTag.query.count(), 0)
+        self.assertEqual(Mention.query.count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+
+    def test_resume(self):
+        """Does a purge that stopped partway finish the rest?"""
+
+        tombstone_user(self.alice)
+        # where an interrupted run left off: status running, the first
+        # batch of messages gone and counted
+        progress = AccountDeletion.query.get(self.alice_id)
+        progress.status = 'running'
+        progress.messages_deleted = 2
+        for msg in self.posts[:2]:
+            MessageTag.query.filter_by(message_id=msg.id).delete()
+            Likes.query.filter_by(message_id=msg.id).delete()
+            db.session.delete(msg)
+        progress.likes_deleted = 2
+        db.session.commit()
+
+        purged, = purge_pending(batch_size=2, pause=0)
+
+        self.assertEqual(purged.user_id, self.alice_id)
+        self.assertEqual(purged.status, 'finished')
+        self.assertEqual(purged.messages_deleted, 6)
+        self.assertEqual(purged.likes_deleted, 3)
+        self.assertEqual(Message.query.all(), [self.reply])
+
+    def test_finished_not_repeated(self):
+        tombstone_user(self.alice)
+        purge_user(self.alice_id, pause=0)
+
+        self.assertEqual(purge_pending(pause=0), [])
+        self.assertEqual(purge_user(self.alice_id).messages_deleted, 6)
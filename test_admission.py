@@ -0,0 +1,153 @@
+"""Admission control tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_admission.py
+
+
+from threading import Thread
+import time
+from unittest import TestCase
+
+from admission import Gate
+from cache import cache
+from models import db, User
+
+from app import CURR_USER_KEY
+from testing import DatabaseTestCase, app
+
+
+class GateTestCase(TestCase):
+    """Test limits and wait queues."""
+
+    def test_limit(self):
+        gate = Gate('test', limit=2)
+        self.assertTrue(gate.acquire())
+        self.assertTrue(gate.acquire())
+        self.assertFalse(gate.acquire())
+
+        gate.release()
+        self.assertTrue(gate.acquire())
+        self.assertEqual(gate.stats()['shed'], 1)
+
+    def test_wait_for_slot(self):
+        """Is a queued request admitted when a slot frees up in time?"""
+
+        gate = Gate('test', limit=1, queue=1, wait=5)
+        gate.acquire()
+        admitted = []
+        waiter = Thread(target=lambda: admitted.append(gate.acquire()))
+        waiter.start()
+
+        while gate.stats()['waiting'] == 0:
+            time.sleep(0.001)
+        gate.release()
+        waiter.join()
+
+        self.assertEqual(admitted, [True])
+        self.assertEqual(gate.stats()['queued'], 1)
+
+    def test_wait_times_out(self):
+        gate = Gate('test', limit=1, queue=1, wait=0.01)
+        gate.acquire()
+        self.assertFalse(gate.acquire())
+        self.assertEqual(gate.stats()['waiting'], 0)
+
+    def test_queue_full(self):
+        """Is a request beyond the queue shed without waiting?"""
+
+        gate = Gate('test', limit=1, queue=1, wait=5)
+        gate.acquire()
+        waiting = Thread(target=gate.acquire)
+        waiting.start()
+        while gate.stats()['waiting'] == 0:
+            time.sleep(0.001)
+
+        started = time.monotonic()
+        self.assertFalse(gate.acquire())
+        self.assertLess(time.monotonic() - started, 1)
+
+        gate.release()
+        waiting.join()
+
+
+class AdmissionTestCase(DatabaseTestCase):
+    """Test shedding and degrading requests."""
+
+    def setUp(self):
+        super().setUp()
+        self._gates = dict(app.extensions['admission'])
+        self._config = dict(app.config)
+        self.user = User.signup("user", "user@test.com", "password", None)
+        db.session.commit()
+
+    def tearDown(self):
+        app.extensions['admission'].clear()
+        app.extensions['admission'].update(self._gates)
+        app.config.update(self._config)
+        super().tearDown()
+
+    def saturate(self, name):
+        app.extensions['admission'][name] = Gate(name, limit=0)
+
+    def login(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user.id
+
+    def test_shed(self):
+        """Does a full gate return a fast 503 with Retry-After?"""
+
+        self.saturate('listing')
+        resp = self.client.get("/users")
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers['Retry-After'], "2")
+
+    def test_cheap_routes_flow(self):
+        """Are routes outside the full class unaffected?"""
+
+        self.saturate('listing')
+        self.assertEqual(self.client.get("/users?q=us").status_code, 200)
+        self.assertEqual(
+            self.client.get(f"/users/{self.user.id}").status_code, 200)
+
+    def test_degraded_timeline(self):
+        """Is the last timeline served when the timeline gate is full?"""
+
+        self.login()
+        self.client.get("/")
+        self.saturate('timeline')
+
+        resp = self.client.get("/")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("from a few minutes ago", resp.get_data(as_text=True))
+
+        cache.clear()
+        self.assertEqual(self.client.get("/").status_code, 503)
+
+    def test_stale_copy_refresh(self):
+        """Is the fallback copy saved at most once per refresh interval?"""
+
+        self.login()
+        self.client.get("/")
+        sets = cache.stats()['sets']
+        self.client.get("/")
+        self.assertEqual(cache.stats()['sets'], sets)
+
+        refresh = app.config['ADMISSION_STALE_REFRESH']
+        app.config['ADMISSION_STALE_REFRESH'] = 0
+        try:
+            self.client.get("/")
+        finally:
+            app.config['ADMISSION_STALE_REFRESH'] = refresh
+        self.assertEqual(cache.stats()['sets'], sets + 1)
+
+    def test_metrics(self):
+        app.config['ADMIN_USERNAMES'] = ["user"]
+        self.login()
+        self.saturate('listing')
+        self.client.get("/users")
+
+        stats = self.client.get("/admin/admission").get_json()
+        self.assertEqual(stats['listing']['shed'], 1)
+        self.assertEqual(stats['timeline']['active'], 0)
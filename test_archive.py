@@ -0,0 +1,72 @@
+"""Message archive tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_archive.py
+
+
+from datetime import datetime
+
+from archive import archive_messages, find_message, is_hot
+from models import db, User, Message, ArchivedMessage, Likes
+
+from app import CURR_USER_KEY
+from testing import DatabaseTestCase
+
+
+class ArchiveTestCase(DatabaseTestCase):
+    """Test moving old messages to the archive and reading them back."""
+
+    def setUp(self):
+        super().setUp()
+        self.author = User.signup("author", "author@test.com", "password",
+                                  None)
+        self.reader = User.signup("reader", "reader@test.com", "password",
+                                  None)
+        db.session.flush()
+
+        # small ids are below any recent snowflake id
+        self.old = Message(id=1000, text="old", user_id=self.author.id,
+                           timestamp=datetime(2020, 1, 1))
+        self.old_liked = Message(id=1001, text="old liked",
+                                 user_id=self.author.id,
+                                 timestamp=datetime(2020, 1, 1))
+        self.new = Message(text="new", user_id=self.author.id)
+        db.session.add_all([self.old, self.old_liked, self.new])
+        db.session.flush()
+        db.session.add(Likes(user_id=self.reader.id, message_id=1001))
+        db.session.commit()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.reader.id
+
+    def test_archive(self):
+        """Are only old, unliked messages moved?"""
+
+        self.assertEqual(archive_messages(days=30, pause=0), 1)
+
+        self.assertEqual(ArchivedMessage.query.one().text, "old")
+        self.assertEqual(sorted(msg.text for msg in Message.query.all()),
+                         ["new", "old liked"])
+        self.assertIsInstance(find_message(1000), ArchivedMessage)
+        self.assertFalse(is_hot(1000))
+        self.assertTrue(is_hot(1001))
+
+    def test_cannot_like_archived(self):
+        archive_messages(days=30, pause=0)
+
+        resp = self.client.post("/users/add_like/1000", follow_redirects=True)
+
+        self.assertIn("Archived messages can", resp.get_data(as_text=True))
+        self.assertEqual(Likes.query.filter_by(message_id=1000).count(), 0)
+
+    def test_no_like_button_on_archived(self):
+        archive_messages(days=30, pause=0)
+
+        html = self.client.get("/messages/1000").get_data(as_text=True)
+        self.assertIn("old", html)
+        self.assertNotIn("/users/add_like/1000", html)
+
+        html = self.client.get(f"/messages/{self.new.id}").get_data(
+            as_text=True)
+        self.assertIn(f"/users/add_like/{self.new.id}", html)
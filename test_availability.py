@@ -0,0 +1,146 @@
+"""Username and email availability tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_availability.py
+
+
+from unittest import TestCase
+
+from sqlalchemy.exc import IntegrityError
+
+import app as app_module
+from availability import BloomFilter, is_available, taken_names
+from models import db, User
+
+from app import CURR_USER_KEY
+from testing import DatabaseTestCase, app
+
+
+class BloomFilterTestCase(TestCase):
+    """Test the Bloom filter on its own."""
+
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(capacity=1000)
+        names = [f"user{n}" for n in range(1000)]
+        for name in names:
+            bloom.add(name)
+        self.assertTrue(all(name in bloom for name in names))
+
+    def test_false_positive_rate(self):
+        """Are about `error_rate` of absent names reported present?"""
+
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        for n in range(1000):
+            bloom.add(f"user{n}")
+        false_positives = sum(f"other{n}" in bloom for n in range(10000))
+        self.assertLess(false_positives, 300)
+
+
+class AvailabilityTestCase(DatabaseTestCase):
+    """Test availability checks, the API and the forms that use them."""
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.signup("Alice", "alice@test.com", "password", None)
+        db.session.commit()
+
+    def test_case_insensitive(self):
+        self.assertFalse(is_available('username', "alice"))
+        self.assertFalse(is_available('email', "ALICE@test.com"))
+        self.assertTrue(is_available('username', "bob"))
+        self.assertTrue(is_available('username', "ALICE",
+                                     except_user_id=self.user.id))
+
+    def test_unique_index(self):
+        """Does the database reject a name differing only in case?"""
+
+        User.signup("ALICE", "other@test.com", "password", None)
+        with self.assertRaises(IntegrityError):
+            db.session.flush()
+
+    def test_sees_new_users(self):
+        """Is a user signed up after the filter was built found?"""
+
+        self.assertTrue(is_available('username', "carol"))
+        User.signup("carol", "carol@test.com", "password", None)
+        db.session.commit()
+        taken_names.add("carol", "carol@test.com")
+        self.assertFalse(is_available('username', "carol"))
+
+    def test_sees_renames(self):
+        """Is a name taken by a rename in another process picked up by the
+        next sync?
+        """
+
+        self.assertFalse(taken_names.might_be_taken('username', "carol"))
+        # renamed elsewhere: this process's filter isn't told
+        self.user.username = "carol"
+        db.session.commit()
+        self.assertFalse(taken_names.might_be_taken('username', "carol"))
+
+        sync_seconds = app.config['AVAILABILITY_SYNC_SECONDS']
+        app.config['AVAILABILITY_SYNC_SECONDS'] = 0
+        try:
+            self.assertTrue(taken_names.might_be_taken('username', "carol"))
+        finally:
+            app.config['AVAILABILITY_SYNC_SECONDS'] = sync_seconds
+
+    def test_api(self):
+        resp = self.client.get("/api/username-available",
+                               query_string={'username': "ALICE",
+                                             'email': "bob@test.com"})
+        self.assertEqual(resp.get_json(),
+                         {'available': {'username': False, 'email': True}})
+
+        resp = self.client.get("/api/username-available")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_signup_conflict(self):
+        """Is a taken name refused without creating a user?"""
+
+        resp = self.client.post("/signup", data={
+            'username': "alice", 'email': "new@test.com",
+            'password': "password"})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Username already taken", resp.get_data(as_text=True))
+        self.assertEqual(User.query.count(), 1)
+
+    def test_profile_conflict(self):
+        """Is a profile edit to someone else's email refused?"""
+
+        other = User.signup("bob", "bob@test.com", "password", None)
+        db.session.commit()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = other.id
+
+        resp = self.client.post("/users/profile", data={
+            'username': "bob", 'email': "Alice@test.com",
+            'password': "password"})
+
+        self.assertIn("Email already registered", resp.get_data(as_text=True))
+        self.assertEqual(User.query.get(other.id).email, "bob@test.com")
+
+    def test_profile_lost_race(self):
+        """Is a name taken between the check and the commit refused?"""
+
+        other = User.signup("bob", "bob@test.com", "password", None)
+        db.session.commit()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = other.id
+
+        # as if Alice took the name after the check ran
+        conflicts = app_module.conflicts
+        app_module.conflicts = lambda *args, **kwargs: []
+        try:
+            resp = self.client.post("/users/profile", data={
+                'username': "ALICE", 'email': "bob@test.com",
+                'password': "password"})
+        finally:
+            app_module.conflicts = conflicts
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Username or email already taken",
+                      resp.get_data(as_text=True))
+        self.assertEqual(User.query.get(other.id).username, "bob")
@@ -0,0 +1,169 @@
+"""Bulk message ingest tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_bulk_messages.py
+
+
+from datetime import datetime
+from unittest import TestCase
+
+from bulk_messages import validate, read_jsonl, ingest, InvalidLine
+from models import db, User, Message
+
+from app import CURR_USER_KEY
+from testing import DatabaseTestCase
+
+
+class BulkValidateTestCase(TestCase):
+    """Test validation of bulk message rows."""
+
+    def test_valid_rows(self):
+        """Are rows within the length limit accepted?"""
+        valid, errors = validate([{"text": "Hello"}, {"text": "x" * 140}])
+        self.assertEqual(len(valid), 2)
+        self.assertEqual(errors, [])
+
+    def test_invalid_rows(self):
+        """Are missing, empty and too-long texts rejected by index?"""
+        rows = [{"text": "ok"}, {}, {"text": "   "}, {"text": "x" * 141}, "nope"]
+        valid, errors = validate(rows)
+        self.assertEqual(valid, [{"text": "ok"}])
+        self.assertEqual([index for index, reason in errors], [1, 2, 3, 4])
+
+    def test_bad_timestamp(self):
+        """Are rows with unparseable timestamps rejected?"""
+        valid, errors = validate([{"text": "Hi", "timestamp": "yesterday"}])
+        self.assertEqual(valid, [])
+        self.assertEqual(errors, [(0, "timestamp is not ISO 8601")])
+
+        valid, errors = validate([{"text": "Hi",
+                                   "timestamp": "1999-12-31T23:59:59"}])
+        self.assertEqual(errors, [(0, "timestamp is before 2000")])
+
+    def test_future_timestamp(self):
+        """Are future dates rejected, including ones past the id range?"""
+        for timestamp in ("2060-01-01T00:00:00", "2070-01-01T00:00:00",
+                          "9999-12-31T23:59:59+00:00"):
+            valid, errors = validate([{"text": "Hi", "timestamp": timestamp}])
+            self.assertEqual(errors, [(0, "timestamp is in the future")])
+
+    def test_timestamp_with_offset(self):
+        """Are timestamps with a UTC offset accepted?"""
+        valid, errors = validate([{"text": "Hi",
+                                   "timestamp": "2021-01-01T00:00:00+00:00"}])
+        self.assertEqual((len(valid), errors), (1, []))
+
+    def test_require_user_id(self):
+        """Are rows without an author rejected when one is required?"""
+        valid, errors = validate([{"text": "Hi"}], require_user_id=True)
+        self.assertEqual(valid, [])
+        self.assertEqual(errors, [(0, "user_id is required")])
+
+    def test_read_jsonl(self):
+        """Are blank lines skipped when reading JSON Lines?"""
+        rows = list(read_jsonl(['{"text": "a"}\n', '\n', '{"text": "b"}']))
+        self.assertEqual(rows, [{"text": "a"}, {"text": "b"}])
+
+    def test_read_jsonl_bad_line(self):
+        """Is a malformed line passed on as an error instead of raising?"""
+        bad, good = read_jsonl(['{"text": ', '{"text": "b"}'])
+        self.assertIsInstance(bad, InvalidLine)
+        self.assertEqual(good, {"text": "b"})
+
+    def test_non_integer_user_id(self):
+        valid, errors = validate([{"text": "Hi", "user_id": "7"}],
+                                 require_user_id=True)
+        self.assertEqual(errors, [(0, "user_id is not an integer")])
+
+
+class BulkIngestTestCase(DatabaseTestCase):
+    """Test inserting messages in chunks and the bulk API."""
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.signup("user", "user@test.com", "password", None)
+        db.session.commit()
+
+    def test_ingest(self):
+        """Are valid rows inserted and bad ones reported by input index,
+        across chunks?
+        """
+        lines = [
+            f'{{"text": "one", "user_id": {self.user.id}}}',
+            '{"text": ',
+            f'{{"text": "two", "user_id": {self.user.id},'
+            f' "timestamp": "2021-03-04T05:06:07"}}',
+            '{"text": "nobody", "user_id": 999999}',
+            f'{{"text": "", "user_id": {self.user.id}}}',
+        ]
+
+        inserted, errors = ingest(read_jsonl(lines), chunk_size=2)
+
+        self.assertEqual(inserted, 2)
+        self.assertEqual([index for index, reason in errors], [1, 3, 4])
+        self.assertEqual(errors[1], (3, "unknown user_id"))
+        texts = sorted(msg.text for msg in Message.query.all())
+        self.assertEqual(texts, ["one", "two"])
+
+    def test_same_timestamp(self):
+        """Do many rows dated to the same millisecond get distinct ids?"""
+        rows = [{"text": f"msg {n}", "timestamp": "2017-05-06T07:08:09"}
+                for n in range(3000)]
+
+        inserted, errors = ingest(rows, user_id=self.user.id,
+                                  chunk_size=1000)
+
+        self.assertEqual((inserted, errors), (3000, []))
+        self.assertGreater(db.session.query(db.func.min(Message.id))
+                           .scalar(), 0)
+
+    def test_timestamp_offset_to_utc(self):
+        """Are timestamps with an offset stored as UTC?"""
+        rows = [{"text": "offset", "timestamp": "2021-01-01T02:00:00+02:00"}]
+
+        inserted, errors = ingest(rows, user_id=self.user.id)
+
+        self.assertEqual((inserted, errors), (1, []))
+        self.assertEqual(Message.query.one().timestamp,
+                         datetime(2021, 1, 1))
+
+    def test_ingest_streams(self):
+        """Is the input consumed a chunk at a time?"""
+        # messages already inserted when each row is read
+        inserted_before = []
+
+        def rows():
+            for n in range(5):
+                inserted_before.append(Message.query.count())
+                yield {"text": f"msg {n}"}
+
+        ingest(rows(), user_id=self.user.id, chunk_size=2)
+        self.assertEqual(inserted_before, [0, 0, 2, 2, 4])
+
+    def test_api(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user.id
+
+        resp = self.client.post("/api/messages/bulk", json={"messages": [
+            {"text": "hello"}, {"text": "x" * 141}]})
+
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.get_json()['inserted'], 1)
+        self.assertEqual(resp.get_json()['errors'][0]['index'], 1)
+        self.assertEqual(Message.query.one().user_id, self.user.id)
+
+        resp = self.client.post("/api/messages/bulk", json={"messages": [
+            {"text": "later", "timestamp": "2060-01-01T00:00:00"},
+            {"text": "utc", "timestamp": "2021-01-01T00:00:00+00:00"}]})
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.get_json()['inserted'], 1)
+        self.assertEqual(resp.get_json()['errors'][0]['index'], 0)
+
+        resp = self.client.post("/api/messages/bulk", json={"messages": "no"})
+        self.assertEqual(resp.status_code, 400)
+
+    def test_api_logged_out(self):
+        resp = self.client.post("/api/messages/bulk",
+                                json={"messages": [{"text": "hello"}]})
+        self.assertEqual(resp.status_code, 401)
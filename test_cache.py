@@ -0,0 +1,238 @@
+"""Cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+
+
+import tempfile
+from threading import Event, Thread
+import time
+from unittest import TestCase
+
+from flask import Flask
+
+from cache import (Cache, LocalBackend, FileBackend, RedisBackend,
+                   RespServer)
+from counts import user_counts
+from models import db, User
+
+from app import CURR_USER_KEY
+from testing import DatabaseTestCase, app
+
+
+class LocalBackendTestCase(TestCase):
+    """Test the in-process LRU backend."""
+
+    def test_evicts_least_recently_used(self):
+        """Is the entry read longest ago evicted first?"""
+
+        backend = LocalBackend(max_entries=2)
+        backend.set('a', b'1')
+        backend.set('b', b'2')
+        backend.get('a')
+        backend.set('c', b'3')
+
+        self.assertEqual(backend.get_many(['a', 'b', 'c']), [b'1', None, b'3'])
+
+    def test_ttl(self):
+        """Do entries expire?"""
+
+        backend = LocalBackend()
+        backend.set('a', b'1', ttl=0.01)
+        time.sleep(0.02)
+
+        self.assertIsNone(backend.get('a'))
+        self.assertTrue(backend.add('a', b'2'))
+        self.assertFalse(backend.add('a', b'3'))
+
+
+class FileBackendTestCase(TestCase):
+    """Test the shared filesystem backend."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.backend = FileBackend(self.tmp.name, max_bytes=100)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_round_trip(self):
+        """Can a value be stored, added only once and deleted?"""
+
+        self.backend.set('a', b'hello')
+        self.assertEqual(self.backend.get('a'), b'hello')
+        self.assertFalse(self.backend.add('a', b'other'))
+
+        self.backend.delete('a')
+        self.assertIsNone(self.backend.get('a'))
+        self.assertTrue(self.backend.add('a', b'other'))
+
+    def test_prune(self):
+        """Does pruning bring the directory back under its size limit?"""
+
+        for n in range(10):
+            self.backend.set(f"key{n}", b'x' * 20)
+
+        self.assertGreater(self.backend.prune(), 0)
+        self.assertLessEqual(
+            sum(size for path, size, mtime in self.backend._files()), 90)
+
+
+class RedisBackendTestCase(TestCase):
+    """Test the Redis protocol client against the stand-in server."""
+
+    def setUp(self):
+        self.server = RespServer(('127.0.0.1', 0))
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        host, port = self.server.server_address
+        self.backend = RedisBackend(f"redis://{host}:{port}/0")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_commands(self):
+        """Do GET, MGET, SET NX and DEL behave like Redis?"""
+
+        self.backend.set('a', b'1', ttl=10)
+        self.assertTrue(self.backend.add('b', b'2'))
+        self.assertFalse(self.backend.add('b', b'3'))
+        self.assertEqual(self.backend.get_many(['a', 'b', 'c']),
+                         [b'1', b'2', None])
+
+        self.backend.delete('a', 'b')
+        self.assertIsNone(self.backend.get('a'))
+
+
+class CacheTestCase(TestCase):
+    """Test tags, single-flight recompute and failure handling."""
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.cache = Cache(self.app)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+
+    def tearDown(self):
+        self.ctx.pop()
+
+    def test_invalidate_tag(self):
+        """Does invalidating a tag turn its entries into misses?"""
+
+        self.cache.set('a', {'n': 1}, tags=['t1'])
+        self.cache.set('b', 2, tags=['t2'])
+        self.assertEqual(self.cache.get('a'), {'n': 1})
+
+        self.cache.invalidate('t1')
+
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.get('b'), 2)
+        self.assertEqual(self.cache.stats()['stale'], 1)
+
+    def test_single_flight(self):
+        """Do concurrent misses compute the value only once?"""
+
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.1)
+            return 'value'
+
+        results = []
+
+        def read():
+            with self.app.app_context():
+                results.append(self.cache.get_or_set('slow', compute))
+
+        threads = [Thread(target=read) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, ['value'] * 5)
+        self.assertEqual(len(calls), 1)
+
+    def test_other_keys_dont_wait(self):
+        """Can other keys be computed while one key's compute is slow?"""
+
+        started, release = Event(), Event()
+
+        def slow():
+            started.set()
+            release.wait(5)
+            return 'slow'
+
+        def read():
+            with self.app.app_context():
+                self.cache.get_or_set('slow', slow)
+
+        thread = Thread(target=read)
+        thread.start()
+        started.wait(5)
+        try:
+            self.assertEqual(self.cache.get_or_set('fast', lambda: 1), 1)
+        finally:
+            release.set()
+            thread.join()
+
+        self.assertEqual(self.cache._locks, {})
+
+    def test_backend_down(self):
+        """Does an unreachable backend act as a miss instead of failing?"""
+
+        self.app.extensions['cache'] = RedisBackend('redis://127.0.0.1:1/0')
+
+        self.assertEqual(self.cache.get_or_set('a', lambda: 5), 5)
+        self.assertGreater(self.cache.stats()['errors'], 0)
+
+
+class CachedProfileTestCase(DatabaseTestCase):
+    """Test that cached profile pages and counts are invalidated."""
+
+    def test_new_message_shows_on_profile(self):
+        """Does posting invalidate the cached message list and count?"""
+
+        user = User.signup("alice", "alice@test.com", "password", None)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user.id
+
+            self.assertNotIn("Fresh", c.get(f"/users/{user.id}")
+                             .get_data(as_text=True))
+            self.assertEqual(user_counts(user.id)['messages'], 0)
+
+            c.post("/messages/new", data={"text": "Fresh"})
+
+            self.assertIn("Fresh", c.get(f"/users/{user.id}")
+                          .get_data(as_text=True))
+            self.assertEqual(user_counts(user.id)['messages'], 1)
+
+
+class CacheStatsViewTestCase(DatabaseTestCase):
+    """Test the admin page showing the cache counters."""
+
+    def setUp(self):
+        super().setUp()
+        self._admins = app.config['ADMIN_USERNAMES']
+        self.user = User.signup("admin", "admin@test.com", "password", None)
+        db.session.commit()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user.id
+
+    def tearDown(self):
+        app.config['ADMIN_USERNAMES'] = self._admins
+        super().tearDown()
+
+    def test_admin_only(self):
+        self.assertEqual(self.client.get("/admin/cache").status_code, 404)
+
+        app.config['ADMIN_USERNAMES'] = ["admin"]
+        stats = self.client.get("/admin/cache").get_json()
+        self.assertIn('hit_rate', stats)
+        self.assertIn('invalidations', stats)
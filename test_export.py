@@ -0,0 +1,141 @@
+"""User export tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_export.py
+
+
+from datetime import datetime
+import gzip
+from unittest import TestCase
+
+from archive import archive_messages
+from export import encode, chunked, gzipped, iter_records
+from models import db, User, Message, Likes, Follows
+
+from app import CURR_USER_KEY
+from testing import DatabaseTestCase
+
+RECORDS = [
+    {'type': 'message', 'id': 1, 'text': 'Hello, world', 'timestamp': 'x'},
+    {'type': 'follower', 'user_id': 7},
+]
+
+
+class ExportEncodingTestCase(TestCase):
+    """Test serializing and compressing export streams."""
+
+    def test_jsonl(self):
+        """Is each record written as one JSON line?"""
+        lines = list(encode(iter(RECORDS), 'jsonl'))
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[1], '{"type": "follower", "user_id": 7}\n')
+
+    def test_csv(self):
+        """Is CSV written with a header and quoted fields?"""
+        text = "".join(encode(iter(RECORDS), 'csv'))
+        rows = text.splitlines()
+        self.assertEqual(rows[0], 'type,id,text,timestamp,user_id,message_id')
+        self.assertEqual(rows[1], 'message,1,"Hello, world",x,,')
+        self.assertEqual(rows[2], 'follower,,,,7,')
+
+    def test_gzipped_round_trip(self):
+        """Does the streamed gzip output decompress to the original?"""
+        strings = [f"line {n}\n" for n in range(1000)]
+        data = b"".join(gzipped(chunked(strings, size=100)))
+        self.assertEqual(gzip.decompress(data).decode(), "".join(strings))
+
+
+class ExportTestCase(DatabaseTestCase):
+    """Test the export route and what it exports."""
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.signup("exporter", "exporter@test.com", "password",
+                                None)
+        self.other = User.signup("other", "other@test.com", "password", None)
+        db.session.flush()
+
+        # small ids are below any recent snowflake id, so this is archived
+        self.old = Message(id=1000, text="old", user_id=self.user.id,
+                           timestamp=datetime(2020, 1, 1))
+        self.new = Message(text="new", user_id=self.user.id)
+        self.liked = Message(text="liked", user_id=self.other.id)
+        db.session.add_all([self.old, self.new, self.liked])
+        db.session.flush()
+        db.session.add_all([
+            Likes(user_id=self.user.id, message_id=self.liked.id),
+            Follows(user_following_id=self.user.id,
+                    user_being_followed_id=self.other.id),
+            Follows(user_following_id=self.other.id,
+                    user_being_followed_id=self.user.id),
+        ])
+        db.session.commit()
+        archive_messages(days=30, pause=0)
+
+    def login(self, user):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user.id
+
+    def test_iter_records(self):
+        """Are hot and archived messages, likes and both follow directions
+        all exported?
+        """
+
+        records = list(iter_records(self.user.id))
+
+        self.assertEqual(
+            sorted(record['text'] for record in records
+                   if record['type'] == 'message'),
+            ["new", "old"])
+        self.assertEqual([record['message_id'] for record in records
+                          if record['type'] == 'like'], [self.liked.id])
+        self.assertEqual([(record['type'], record['user_id'])
+                          for record in records
+                          if record['type'] in ('following', 'follower')],
+                         [('following', self.other.id),
+                          ('follower', self.other.id)])
+
+    def test_owner(self):
+        """Does the owner get their export as an attachment?"""
+
+        self.login(self.user)
+        resp = self.client.get(f"/users/{self.user.id}/export")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        self.assertEqual(
+            resp.headers['Content-Disposition'],
+            f'attachment; filename="warbler-{self.user.id}.jsonl"')
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(len(resp.get_data(as_text=True).splitlines()), 5)
+
+    def test_other_user(self):
+        """Is anyone else sent away?"""
+
+        self.login(self.other)
+        resp = self.client.get(f"/users/{self.user.id}/export")
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertRegex(resp.location, r"^(http://localhost)?/$")
+
+    def test_unknown_format(self):
+        self.login(self.user)
+        resp = self.client.get(f"/users/{self.user.id}/export?format=xml")
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_gzip(self):
+        """Is the export gzipped when the client accepts it?"""
+
+        self.login(self.user)
+        resp = self.client.get(f"/users/{self.user.id}/export?format=csv",
+                               headers={'Accept-Encoding': 'gzip, deflate'})
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(
+            resp.headers['Content-Disposition'],
+            f'attachment; filename="warbler-{self.user.id}.csv"')
+        rows = gzip.decompress(resp.data).decode().splitlines()
+        self.assertEqual(rows[0], 'type,id,text,timestamp,user_id,message_id')
+        self.assertEqual(len(rows), 6)
@@ -0,0 +1,139 @@
+"""Follow graph index tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_follow_graph.py
+
+
+from unittest import TestCase
+
+from cache import cache, follows_tag
+from follow_graph import FollowGraph, follow_graph
+from models import db, User, Message, Follows
+
+from app import CURR_USER_KEY
+
+from testing import DatabaseTestCase, app
+
+
+class FollowGraphTestCase(TestCase):
+    """Test the in-memory follow graph index."""
+
+    def setUp(self):
+        """Build a small graph: 1 -> 2, 1 -> 3, 2 -> 1, 3 -> 2."""
+
+        self.graph = FollowGraph()
+        self.graph.load([(1, 2), (1, 3), (2, 1), (3, 2)])
+
+    def test_is_following(self):
+        """Does the index report existing edges in the right direction?"""
+        self.assertTrue(self.graph.is_following(1, 2))
+        self.assertFalse(self.graph.is_following(2, 3))
+        self.assertTrue(self.graph.is_followed_by(2, 1))
+
+    def test_counts(self):
+        """Are following and follower counts correct?"""
+        self.assertEqual(self.graph.following_count(1), 2)
+        self.assertEqual(self.graph.followers_count(2), 2)
+        self.assertEqual(self.graph.followers_count(99), 0)
+
+    def test_is_mutual(self):
+        """Are mutual follows detected?"""
+        self.assertTrue(self.graph.is_mutual(1, 2))
+        self.assertFalse(self.graph.is_mutual(1, 3))
+
+    def test_add_and_remove(self):
+        """Do incremental updates keep both directions in sync?"""
+        self.graph.add(2, 3)
+        self.graph.add(2, 3)
+        self.assertEqual(self.graph.following_ids(2), [1, 3])
+        self.assertEqual(self.graph.follower_ids(3), [1, 2])
+
+        self.graph.remove(2, 3)
+        self.assertFalse(self.graph.is_following(2, 3))
+        self.assertEqual(self.graph.follower_ids(3), [1])
+
+    def test_remove_user(self):
+        """Does removing a user drop every edge touching it?"""
+        self.graph.remove_user(2)
+        self.assertEqual(self.graph.following_ids(1), [3])
+        self.assertEqual(self.graph.follower_ids(2), [])
+        self.assertFalse(self.graph.is_following(3, 2))
+
+    def test_memory_footprint(self):
+        """Is the footprint reported per edge?"""
+        self.assertEqual(self.graph.edge_count(), 4)
+        self.assertGreater(self.graph.bytes_per_edge(), 0)
+
+
+class FollowGraphSyncTestCase(DatabaseTestCase):
+    """Test picking up changes made by other processes."""
+
+    def setUp(self):
+        super().setUp()
+        self._sync_seconds = app.config['FOLLOW_GRAPH_SYNC_SECONDS']
+        app.config['FOLLOW_GRAPH_SYNC_SECONDS'] = 0
+
+        self.alice = User.signup("alice", "alice@test.com", "password", None)
+        self.bob = User.signup("bob", "bob@test.com", "password", None)
+        db.session.commit()
+
+        # this process's copy
+        self.graph = FollowGraph().ensure_loaded()
+
+    def tearDown(self):
+        app.config['FOLLOW_GRAPH_SYNC_SECONDS'] = self._sync_seconds
+        super().tearDown()
+
+    def test_reload_on_publish(self):
+        """Is a follow committed elsewhere seen once it's published?"""
+
+        db.session.add(Follows(user_following_id=self.alice.id,
+                               user_being_followed_id=self.bob.id))
+        db.session.commit()
+
+        self.graph.ensure_loaded()
+        self.assertFalse(self.graph.is_following(self.alice.id, self.bob.id))
+
+        # what the other process's route does after its commit
+        cache.invalidate(follows_tag())
+        self.graph.ensure_loaded()
+        self.assertTrue(self.graph.is_following(self.alice.id, self.bob.id))
+
+    def test_sync_interval(self):
+        """Is the shared version checked at most every sync interval?"""
+
+        app.config['FOLLOW_GRAPH_SYNC_SECONDS'] = 60
+        db.session.add(Follows(user_following_id=self.alice.id,
+                               user_being_followed_id=self.bob.id))
+        db.session.commit()
+        cache.invalidate(follows_tag())
+
+        self.graph.ensure_loaded()
+        self.assertFalse(self.graph.is_following(self.alice.id, self.bob.id))
+
+    def test_reload_skips_deleted(self):
+        """Do a deleted account's follows stay gone after a reload, before
+        its rows are purged?
+        """
+
+        db.session.add_all([
+            Follows(user_following_id=self.alice.id,
+                    user_being_followed_id=self.bob.id),
+            Message(text="from bob", user_id=self.bob.id),
+        ])
+        db.session.commit()
+        alice_id = self.alice.id
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.bob.id
+        self.client.post("/users/delete")
+
+        follow_graph.reset()
+        follow_graph.ensure_loaded()
+        self.assertEqual(follow_graph.following_count(alice_id), 0)
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = alice_id
+        html = self.client.get("/").get_data(as_text=True)
+        self.assertNotIn("from bob", html)
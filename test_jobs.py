@@ -0,0 +1,118 @@
+"""Background job queue tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+
+from datetime import datetime, timedelta
+
+from models import db, Job
+
+# Each test runs in a transaction that is rolled back afterwards;
+# see testing.py for how the test database is chosen
+
+from testing import app, DatabaseTestCase
+from jobs import job, enqueue, claim, run_job, run_pending, requeue_expired
+
+calls = []
+
+
+@job('test_record')
+def record_job(value):
+    calls.append(value)
+
+
+@job('test_explode')
+def explode_job():
+    raise RuntimeError("boom")
+
+
+class JobQueueTestCase(DatabaseTestCase):
+    """Test enqueueing, claiming and running jobs."""
+
+    def setUp(self):
+        """Clear out jobs and recorded calls."""
+
+        super().setUp()
+        calls.clear()
+
+    def test_enqueue_unknown_job(self):
+        """Does enqueueing an unregistered job type fail fast?"""
+        with self.assertRaises(ValueError):
+            enqueue('no_such_job')
+
+    def test_run_pending(self):
+        """Do queued jobs run and get marked done with a duration?"""
+        enqueue('test_record', value=1)
+        enqueue('test_record', value=2)
+
+        self.assertEqual(run_pending(), 2)
+        self.assertEqual(calls, [1, 2])
+
+        for done in Job.query.all():
+            self.assertEqual(done.status, 'done')
+            self.assertIsNotNone(done.duration_ms)
+
+    def test_priority(self):
+        """Are higher priority jobs claimed first?"""
+        enqueue('test_record', value='low')
+        enqueue('test_record', priority=10, value='high')
+
+        self.assertEqual(claim('test-worker').kwargs, '{"value": "high"}')
+
+    def test_delayed_job_not_claimed(self):
+        """Are jobs scheduled for later left alone?"""
+        enqueue('test_record', delay=60, value=1)
+        self.assertIsNone(claim('test-worker'))
+
+    def test_retry_with_backoff(self):
+        """Is a failing job requeued for later, then failed at max attempts?"""
+        failing = enqueue('test_explode', max_attempts=2)
+
+        run_job(claim('test-worker'))
+        failing = Job.query.get(failing.id)
+        self.assertEqual(failing.status, 'queued')
+        self.assertIn('boom', failing.last_error)
+        self.assertIsNone(claim('test-worker'))
+
+        failing.run_at = failing.created_at
+        db.session.commit()
+
+        run_job(claim('test-worker'))
+        self.assertEqual(Job.query.get(failing.id).status, 'failed')
+
+    def test_enqueue_leaves_commit_to_caller(self):
+        """Does a rolled-back caller take its job with it?"""
+        enqueue('test_record', value=1)
+        db.session.rollback()
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_expired_lease_requeued(self):
+        """Is a job whose worker died claimed again once its lease ends?"""
+        enqueue('test_record', value=1)
+        stuck = claim('dead-worker')
+        self.assertEqual(stuck.status, 'running')
+        self.assertIsNone(claim('test-worker'))
+
+        stuck.locked_until = datetime.utcnow() - timedelta(seconds=1)
+        db.session.commit()
+
+        reclaimed = claim('test-worker')
+        self.assertEqual(reclaimed.id, stuck.id)
+        self.assertEqual(reclaimed.locked_by, 'test-worker')
+        self.assertEqual(reclaimed.attempts, 2)
+
+        run_job(reclaimed)
+        self.assertEqual(calls, [1])
+        self.assertIsNone(Job.query.get(stuck.id).locked_until)
+
+    def test_expired_lease_last_attempt(self):
+        """Is a job that dies on its last attempt failed, not requeued?"""
+        enqueue('test_record', max_attempts=1, value=1)
+        stuck = claim('dead-worker')
+        stuck.locked_until = datetime.utcnow() - timedelta(seconds=1)
+        db.session.commit()
+
+        self.assertEqual(requeue_expired(), 1)
+        self.assertEqual(Job.query.get(stuck.id).status, 'failed')
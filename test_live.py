@@ -0,0 +1,118 @@
+"""Live timeline update tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_live.py
+
+
+import tempfile
+import time
+from unittest import TestCase
+
+from live import Broker, SocketBus, broker, format_event
+from models import db, User
+
+from app import CURR_USER_KEY
+from testing import DatabaseTestCase
+
+
+class BrokerTestCase(TestCase):
+    """Test in-process fan-out by author."""
+
+    def test_dispatch_to_followers_only(self):
+        """Do subscriptions get only their authors' events?"""
+
+        broker = Broker()
+        follows_1 = broker.subscribe([1])
+        follows_2 = broker.subscribe([2, 3])
+
+        self.assertEqual(broker.dispatch({'author_id': 2, 'id': 9}), 1)
+        self.assertIsNone(follows_1.get(timeout=0))
+        self.assertEqual(follows_2.get(timeout=0)['id'], 9)
+
+    def test_full_queue_drops(self):
+        """Does a stalled subscription drop events instead of blocking?"""
+
+        broker = Broker()
+        sub = broker.subscribe([1], maxsize=1)
+        broker.dispatch({'author_id': 1, 'id': 1})
+        broker.dispatch({'author_id': 1, 'id': 2})
+
+        self.assertEqual(sub.dropped, 1)
+
+    def test_unsubscribe(self):
+        """Are closed subscriptions forgotten?"""
+
+        broker = Broker()
+        sub = broker.subscribe([1, 2])
+        broker.unsubscribe(sub)
+
+        self.assertEqual(broker.subscriber_count(), 0)
+        self.assertEqual(broker.dispatch({'author_id': 1, 'id': 1}), 0)
+
+    def test_format_event(self):
+        """Is each line of the fragment its own data: line?"""
+
+        frame = format_event({'id': 5, 'html': "<li>\n</li>"})
+        self.assertEqual(frame,
+                         "id: 5\nevent: message\ndata: <li>\ndata: </li>\n\n")
+
+
+class SocketBusTestCase(TestCase):
+    """Test sharing events between buses in one directory."""
+
+    def test_round_trip(self):
+        """Does an event sent on one bus arrive on the other?"""
+
+        received = []
+        with tempfile.TemporaryDirectory() as directory:
+            sender = SocketBus(directory, lambda event: None).start()
+            receiver = SocketBus(directory, received.append).start()
+            try:
+                sender.send({'author_id': 1, 'id': 7})
+                for _ in range(50):
+                    if received:
+                        break
+                    time.sleep(0.01)
+            finally:
+                sender.close()
+                receiver.close()
+
+        self.assertEqual(received, [{'author_id': 1, 'id': 7}])
+
+
+class StreamViewTestCase(DatabaseTestCase):
+    """Test the /stream/timeline endpoint."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.alice = User.signup("alice", "alice@test.com", "password", None)
+        self.bob = User.signup("bob", "bob@test.com", "password", None)
+        db.session.commit()
+
+    def test_logged_out(self):
+        """Are anonymous streams refused?"""
+
+        resp = self.client.get("/stream/timeline")
+        self.assertEqual(resp.status_code, 401)
+
+    def test_followed_author_message(self):
+        """Does a followed author's new message reach the stream?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.alice.id
+            c.post(f"/users/follow/{self.bob.id}")
+
+            resp = c.get("/stream/timeline")
+            frames = resp.iter_encoded()
+            self.assertEqual(resp.mimetype, 'text/event-stream')
+            self.assertTrue(next(frames).startswith(b"retry:"))
+
+            broker.dispatch({'author_id': self.bob.id, 'id': 1,
+                             'html': "<li>hi</li>"})
+            frame = next(frames)
+            resp.close()
+
+        self.assertIn(b"data: <li>hi</li>", frame)
@@ -1,32 +1,26 @@
 """Message model tests."""
 
 import os
-from unittest import TestCase
 
 from models import db, User, Message, Follows
 
 from sqlalchemy.exc import IntegrityError
 from datetime import datetime
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+# Each test runs in a transaction that is rolled back afterwards;
+# see testing.py for how the test database is chosen
 
-from app import app
+from testing import app, DatabaseTestCase
 
-db.create_all()
 
-
-class MessageModelTestCase(TestCase):
+class MessageModelTestCase(DatabaseTestCase):
     """Test views for messages."""
 
     def setUp(self):
         """Create test client, add sample data."""
 
-        User.query.delete()
-        Message.query.delete()
-        Follows.query.delete()
+        super().setUp()
 
-        self.client = app.test_client()
-        
         user = User.signup(
             "JaneDoe",
             "test@email.com",            
@@ -46,10 +40,6 @@ class MessageModelTestCase(TestCase):
         self.user = user
         self.user_2 = user_2
         
-    def tearDown(self):
-        """Rollback any failed transactions."""
-        db.session.rollback()
-
     def test_message_model(self):
         """Does basic model work?"""
 
@@ -6,43 +6,26 @@
 
 
 import os
-from unittest import TestCase
 
 from models import db, connect_db, Message, User
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
+# Each test runs in a transaction that is rolled back afterwards;
+# see testing.py for how the test database is chosen
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
-
-# Now we can import app
 from flask import session
-from app import app, CURR_USER_KEY
-
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-
-db.create_all()
-
-# Don't have WTForms use CSRF at all, since it's a pain to test
-
-app.config['WTF_CSRF_ENABLED'] = False
-app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+from account_deletion import tombstone_user, purge_user
+from cache import cache
+from app import CURR_USER_KEY
+from testing import app, DatabaseTestCase
 
 
-class MessageViewTestCase(TestCase):
+class MessageViewTestCase(DatabaseTestCase):
     """Test views for messages."""
 
     def setUp(self):
         """Create test client, add sample data."""
 
-        User.query.delete()
-        Message.query.delete()
-
-        self.client = app.test_client()
+        super().setUp()
 
         self.testuser = User.signup(username="testuser",
                                     email="test@test.com",
@@ -125,4 +108,91 @@ class MessageViewTestCase(TestCase):
             
             msg = Message.query.first()
             
-            self.assertEqual(msg.text, "Hello")
\ No newline at end of file
+            self.assertEqual(msg.text, "Hello")
+
+class MessagePageCacheTestCase(DatabaseTestCase):
+    """Test the cached single-message page."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.author = User.signup("author", "author@test.com", "password",
+                                  None)
+        self.viewer = User.signup("viewer", "viewer@test.com", "password",
+                                  None)
+        db.session.commit()
+        self.msg = Message(text="Going viral", user_id=self.author.id)
+        db.session.add(self.msg)
+        db.session.commit()
+
+    def login(self, user):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user.id
+
+    def show(self):
+        return self.client.get(f"/messages/{self.msg.id}")
+
+    def test_missing_message(self):
+        """Is an unknown id a 404, and left out of the cache?"""
+        sets = cache.stats()['sets']
+        self.assertEqual(self.client.get("/messages/12345").status_code, 404)
+        self.assertEqual(cache.stats()['sets'], sets)
+
+    def test_rendered_once(self):
+        """Is the shared part rendered only for the first view?"""
+
+        self.show()
+        Message.query.filter_by(id=self.msg.id).update({'text': "Changed"})
+        db.session.commit()
+
+        self.assertIn("Going viral", self.show().get_data(as_text=True))
+
+    def test_like_updates_count(self):
+        """Does liking refresh the count but keep per-viewer buttons?"""
+
+        self.login(self.viewer)
+        self.assertIn("0 likes", self.show().get_data(as_text=True))
+
+        self.client.post(f"/users/add_like/{self.msg.id}")
+        html = self.show().get_data(as_text=True)
+        self.assertIn("1 like", html)
+        self.assertIn(f"/users/remove_like/{self.msg.id}", html)
+
+        self.login(self.author)
+        html = self.show().get_data(as_text=True)
+        self.assertIn("1 like", html)
+        self.assertIn(f"/messages/{self.msg.id}/delete", html)
+        self.assertNotIn("remove_like", html)
+
+    def test_liker_purged(self):
+        """Does purging a user who liked the message refresh its count?"""
+
+        self.login(self.viewer)
+        self.client.post(f"/users/add_like/{self.msg.id}")
+        self.assertIn("1 like", self.show().get_data(as_text=True))
+
+        viewer_id = self.viewer.id
+        tombstone_user(self.viewer)
+        purge_user(viewer_id, pause=0)
+
+        self.assertIn("0 likes", self.show().get_data(as_text=True))
+
+    def test_profile_edit(self):
+        """Does the page pick up the author's new username?"""
+
+        self.show()
+        self.login(self.author)
+        self.client.post("/users/profile", data={
+            "username": "renamed", "email": "author@test.com",
+            "password": "password"})
+
+        self.assertIn("@renamed", self.show().get_data(as_text=True))
+
+    def test_destroy(self):
+        """Is a deleted message gone from its page?"""
+
+        self.show()
+        self.login(self.author)
+        self.client.post(f"/messages/{self.msg.id}/delete")
+
+        self.assertEqual(self.show().status_code, 404)
@@ -0,0 +1,102 @@
+"""Notification tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_notifications.py
+
+
+from models import db, Message, User, Notification, NotificationEvent
+from notifications import notify, deliver, mark_all_read
+
+from app import CURR_USER_KEY
+from testing import DatabaseTestCase
+
+
+class NotificationTestCase(DatabaseTestCase):
+    """Test delivering and coalescing notification events."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.users = [User.signup(f"user{n}", f"user{n}@test.com",
+                                  "password", None)
+                      for n in range(4)]
+        db.session.commit()
+
+        self.author = self.users[0]
+        self.msg = Message(text="Hello", user_id=self.author.id)
+        db.session.add(self.msg)
+        db.session.commit()
+
+    def test_likes_coalesce(self):
+        """Do several likes become one notification with a count?"""
+
+        for user in self.users:
+            notify('like', user.id, message_id=self.msg.id)
+        db.session.commit()
+
+        self.assertEqual(deliver(), 4)
+
+        note = Notification.query.one()
+        self.assertEqual(note.recipient_id, self.author.id)
+        self.assertEqual(note.actor_count, 3)
+        self.assertEqual(note.last_actor_id, self.users[3].id)
+        self.assertEqual(NotificationEvent.query.count(), 0)
+        self.assertEqual(User.query.get(self.author.id).unread_notifications, 1)
+
+    def test_later_batch_adds_to_unread(self):
+        """Does a later like add to the existing unread notification?"""
+
+        notify('like', self.users[1].id, message_id=self.msg.id)
+        db.session.commit()
+        deliver()
+        notify('like', self.users[2].id, message_id=self.msg.id)
+        db.session.commit()
+        deliver()
+
+        self.assertEqual(Notification.query.one().actor_count, 2)
+        self.assertEqual(User.query.get(self.author.id).unread_notifications, 1)
+
+    def test_mark_all_read_keeps_later_deliveries(self):
+        """Does marking read leave counts it didn't mark read?"""
+
+        notify('like', self.users[1].id, message_id=self.msg.id)
+        db.session.commit()
+        deliver()
+        author = User.query.get(self.author.id)
+        # as if another delivery committed its bump after our UPDATE ran
+        User.query.filter_by(id=self.author.id).update(
+            {'unread_notifications': User.unread_notifications + 1},
+            synchronize_session=False)
+
+        mark_all_read(author)
+
+        self.assertEqual(User.query.get(self.author.id).unread_notifications, 1)
+
+    def test_routes_notify(self):
+        """Do likes and follows made through the app show up in the navbar?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.users[1].id
+
+            c.post(f"/users/add_like/{self.msg.id}")
+            c.post(f"/users/follow/{self.author.id}")
+
+        deliver()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.author.id
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertRegex(html, r'badge-primary"\s*>2<')
+
+            html = c.get("/notifications").get_data(as_text=True)
+            self.assertIn("liked", html)
+            self.assertIn("followed you", html)
+
+        self.assertEqual(User.query.get(self.author.id).unread_notifications, 0)
+        self.assertEqual(
+            Notification.query.filter(Notification.read_at.is_(None)).count(),
+            0)
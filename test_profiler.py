@@ -0,0 +1,123 @@
+"""Sampling profiler tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_profiler.py
+
+
+import os
+import sys
+import tempfile
+from threading import get_ident
+from unittest import TestCase
+
+from profiler import (HEADER, Sampler, sign_token, verify_token, collapse,
+                      aggregate, top_frames)
+
+from testing import DatabaseTestCase, app
+
+
+class TokenTestCase(TestCase):
+    """Test signed profiling tokens."""
+
+    def test_valid_token(self):
+        token = sign_token("secret", 2000)
+        self.assertTrue(verify_token("secret", token, now=1000))
+
+    def test_expired_token(self):
+        token = sign_token("secret", 2000)
+        self.assertFalse(verify_token("secret", token, now=3000))
+
+    def test_wrong_secret(self):
+        token = sign_token("other", 2000)
+        self.assertFalse(verify_token("secret", token, now=1000))
+
+    def test_garbage(self):
+        self.assertFalse(verify_token("secret", "not-a-token", now=1000))
+
+
+class SamplerTestCase(TestCase):
+    """Test stack sampling and aggregation."""
+
+    def test_collapse(self):
+        """Are frames listed outermost first, ending at this function?"""
+
+        stack = collapse(sys._getframe())
+        self.assertTrue(stack.endswith(
+            ";test_profiler.py:test_collapse"), stack)
+
+    def test_sample_registered_thread(self):
+        """Does a sample record this thread's current stack?"""
+
+        sampler = Sampler(interval=60)
+        counts = sampler.start(get_ident())
+        sampler.sample()
+        self.assertEqual(sampler.stop(get_ident()), counts)
+
+        # the sampler's own thread may have taken a sample too
+        self.assertTrue(any(
+            "test_profiler.py:test_sample_registered_thread" in stack
+            for stack in counts))
+
+    def test_aggregate(self):
+        """Are files merged per endpoint, dotted names included?"""
+
+        with tempfile.TemporaryDirectory() as directory:
+            for name, body in [
+                    ("warbler.homepage.1.2.0.folded", "a;b 2\na;c 1\n"),
+                    ("warbler.homepage.1.2.1.folded", "a;b 3\n"),
+                    ("warbler.users_show.1.2.2.folded", "a;d 1\n")]:
+                with open(os.path.join(directory, name), 'w') as f:
+                    f.write(body)
+
+            merged = aggregate(directory)
+
+        requests, counts = merged['warbler.homepage']
+        self.assertEqual(requests, 2)
+        self.assertEqual(counts, {'a;b': 5, 'a;c': 1})
+        self.assertEqual(top_frames(counts, 1), [('b', 5)])
+        self.assertEqual(merged['warbler.users_show'][0], 1)
+
+
+class ProfiledRequestTestCase(DatabaseTestCase):
+    """Test choosing and recording profiled requests."""
+
+    def setUp(self):
+        super().setUp()
+        self._tmp = tempfile.TemporaryDirectory()
+        self._config = dict(app.config)
+        app.config['PROFILE_DIR'] = self._tmp.name
+        app.config['PROFILE_SAMPLE_RATE'] = 0
+
+    def tearDown(self):
+        app.config.update(self._config)
+        self._tmp.cleanup()
+        super().tearDown()
+
+    def profiles(self):
+        return os.listdir(self._tmp.name)
+
+    def test_signed_header(self):
+        """Is a request with a valid header profiled?"""
+
+        token = sign_token(app.config['SECRET_KEY'], 2 ** 40)
+        resp = self.client.get("/", headers={HEADER: token})
+
+        self.assertEqual(resp.status_code, 200)
+        profiles = self.profiles()
+        self.assertEqual(len(profiles), 1)
+        self.assertTrue(profiles[0].startswith("warbler.homepage."))
+
+    def test_bad_header(self):
+        """Is a request with a forged header left alone?"""
+
+        self.client.get("/", headers={HEADER: sign_token("guess", 2 ** 40)})
+        self.assertEqual(self.profiles(), [])
+
+    def test_sample_rate(self):
+        """Does a rate of 1 profile every request?"""
+
+        app.config['PROFILE_SAMPLE_RATE'] = 1
+        self.client.get("/")
+        self.client.get("/")
+        self.assertEqual(len(self.profiles()), 2)
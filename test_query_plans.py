@@ -0,0 +1,65 @@
+"""Query plan check tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_query_plans.py
+
+
+from commands import check_query_plans_command
+from models import db, User, Message
+from query_plans import HOT_QUERIES, check_query_plans
+
+from testing import DatabaseTestCase, app
+
+
+def text_query(user_id):
+    """A timeline filtered on a column no index covers."""
+
+    return (Message
+            .query
+            .filter(Message.text == "hello")
+            .order_by(Message.timestamp.desc())
+            .limit(100))
+
+
+class QueryPlanTestCase(DatabaseTestCase):
+    """Test EXPLAINing the hot queries against the test database."""
+
+    def setUp(self):
+        super().setUp()
+        User.signup("planner", "planner@test.com", "password", None)
+        db.session.commit()
+
+        self._hot_queries = dict(HOT_QUERIES)
+
+    def tearDown(self):
+        HOT_QUERIES.clear()
+        HOT_QUERIES.update(self._hot_queries)
+        super().tearDown()
+
+    def test_indexes_used(self):
+        """Does every hot query use the index it expects?"""
+
+        results = check_query_plans()
+
+        self.assertEqual([name for name, *rest in results],
+                         list(HOT_QUERIES))
+        for name, index_name, used, plan in results:
+            self.assertTrue(used, f"{name} doesn't use {index_name}:\n{plan}")
+
+    def test_missing_index_reported(self):
+        """Is a query that can't use its index reported, and does the
+        command fail?
+        """
+
+        HOT_QUERIES['by_text'] = (text_query, 'ix_messages_user_id_id')
+
+        results = {name: used for name, index_name, used, plan
+                   in check_query_plans()}
+        self.assertFalse(results['by_text'])
+        self.assertTrue(results['homepage'])
+
+        result = app.test_cli_runner().invoke(check_query_plans_command)
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("MISSING  by_text: ix_messages_user_id_id",
+                      result.output)
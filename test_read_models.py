@@ -0,0 +1,155 @@
+"""Read model tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_read_models.py
+
+
+from datetime import datetime
+
+from models import db, User, Message, ArchivedMessage, Follows, Likes
+from read_models import (UserCard, MessageRow, messages_by_ids,
+                         user_messages, liked_messages, following_cards,
+                         follower_cards, like_cursor, parse_like_cursor)
+
+from app import CURR_USER_KEY
+from testing import DatabaseTestCase
+
+
+class ReadModelTestCase(DatabaseTestCase):
+    """Test loading timelines and cards without ORM instances."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.alice = User.signup("alice", "alice@test.com", "password", None)
+        self.bob = User.signup("bob", "bob@test.com", "password", None)
+        self.carol = User.signup("carol", "carol@test.com", "password", None)
+        db.session.flush()
+
+        self.old = ArchivedMessage(id=1, text="old", user_id=self.alice.id,
+                                   timestamp=datetime(2020, 1, 1))
+        self.first = Message(text="first", user_id=self.alice.id)
+        self.second = Message(text="second", user_id=self.bob.id)
+        db.session.add_all([self.old, self.first, self.second])
+        db.session.flush()
+
+        db.session.add_all([
+            Likes(user_id=self.bob.id, message_id=self.first.id),
+            Follows(user_following_id=self.alice.id,
+                    user_being_followed_id=self.bob.id),
+            Follows(user_following_id=self.alice.id,
+                    user_being_followed_id=self.carol.id),
+        ])
+        db.session.commit()
+
+    def test_messages_by_ids(self):
+        """Are rows returned in order, from either table, with authors?"""
+
+        ids = [self.second.id, self.old.id, self.first.id, 12345]
+        rows = messages_by_ids(ids)
+
+        self.assertEqual([row.id for row in rows], ids[:3])
+        self.assertIsInstance(rows[0], MessageRow)
+        self.assertIsInstance(rows[0].user, UserCard)
+        self.assertEqual(rows[0].user.username, "bob")
+        self.assertEqual(rows[1].text, "old")
+
+    def test_not_orm(self):
+        """Are no ORM instances left in the session?"""
+
+        msg_id = self.first.id
+        db.session.expunge_all()
+        messages_by_ids([msg_id])
+        self.assertEqual(len(db.session.identity_map), 0)
+
+    def test_user_messages(self):
+        """Is the profile newest first, topped up from the archive?"""
+
+        rows = user_messages(self.alice.id)
+        self.assertEqual([row.text for row in rows], ["first", "old"])
+
+        rows = user_messages(self.alice.id, limit=1)
+        self.assertEqual([row.text for row in rows], ["first"])
+
+    def test_liked_messages(self):
+        rows, next_before = liked_messages(self.bob.id)
+        self.assertIsNone(next_before)
+        self.assertEqual([row.text for row in rows], ["first"])
+        self.assertEqual(rows[0].user.username, "alice")
+
+    def test_likes_by_many_users(self):
+        """Can more than one user like the same message?"""
+
+        db.session.add(Likes(user_id=self.carol.id, message_id=self.first.id))
+        db.session.commit()
+
+        self.assertEqual(Likes.query.filter_by(
+            message_id=self.first.id).count(), 2)
+
+    def test_liked_messages_pages(self):
+        """Are likes newest first, paged by a keyset cursor?"""
+
+        third = Message(text="third", user_id=self.carol.id)
+        db.session.add(third)
+        db.session.flush()
+        db.session.add_all([
+            Likes(user_id=self.alice.id, message_id=self.first.id,
+                  created_at=datetime(2026, 1, 1)),
+            Likes(user_id=self.alice.id, message_id=self.second.id,
+                  created_at=datetime(2026, 1, 2)),
+            Likes(user_id=self.alice.id, message_id=third.id,
+                  created_at=datetime(2026, 1, 2)),
+        ])
+        db.session.commit()
+
+        rows, next_before = liked_messages(self.alice.id, limit=2)
+        self.assertEqual([row.text for row in rows], ["third", "second"])
+
+        rows, next_before = liked_messages(self.alice.id, before=next_before,
+                                           limit=2)
+        self.assertEqual([row.text for row in rows], ["first"])
+        self.assertIsNone(next_before)
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.alice.id
+        resp = self.client.get(f"/users/{self.alice.id}/likes",
+                               query_string={'before': "junk"})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_like_cursor(self):
+        """Do cursors round-trip, negative message ids included?"""
+
+        when = datetime(2026, 1, 2, 3, 4, 5, 6)
+        for message_id in (42, -42):
+            self.assertEqual(parse_like_cursor(like_cursor(when, message_id)),
+                             (when, message_id))
+        for junk in (None, "", "junk", "1-x", "x-1", "9" * 30 + "-1"):
+            self.assertIsNone(parse_like_cursor(junk))
+
+    def test_follow_cards(self):
+        """Are follow lists cards of active users only?"""
+
+        self.carol.deleted_at = datetime.utcnow()
+        db.session.commit()
+
+        self.assertEqual([card.username
+                          for card in following_cards(self.alice.id)],
+                         ["bob"])
+        self.assertEqual([card.username
+                          for card in follower_cards(self.bob.id)],
+                         ["alice"])
+
+    def test_deleted_author(self):
+        """Are a deleted but unpurged author's messages left out of
+        timelines and likes pages?
+        """
+
+        self.alice.deleted_at = datetime.utcnow()
+        db.session.commit()
+
+        rows = messages_by_ids([self.second.id, self.first.id, self.old.id])
+        self.assertEqual([row.text for row in rows], ["second"])
+
+        rows, next_before = liked_messages(self.bob.id)
+        self.assertEqual((rows, next_before), ([], None))
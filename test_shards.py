@@ -0,0 +1,247 @@
+"""Message sharding tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_shards.py
+
+
+import os
+import tempfile
+from collections import Counter
+from unittest import TestCase
+
+from datetime import datetime
+
+from account_deletion import tombstone_user, purge_user
+from models import db, User, Message, Likes
+from shards import (NUM_BUCKETS, ShardSet, bucket_for, plan_moves,
+                    create_tables, move_bucket, shard_for_user)
+import archive
+
+from app import CURR_USER_KEY
+from testing import DatabaseTestCase, app
+from snowflake import backdated_id
+from timeline_cache import recent_messages, load_messages
+
+
+class BucketTestCase(TestCase):
+    """Test hashing users into buckets and planning moves."""
+
+    def test_spread(self):
+        """Do consecutive user ids fill every bucket about evenly?"""
+
+        counts = Counter(bucket_for(user_id)
+                         for user_id in range(1, NUM_BUCKETS * 10 + 1))
+        self.assertEqual(len(counts), NUM_BUCKETS)
+        self.assertLess(max(counts.values()) - min(counts.values()), 10)
+
+    def test_plan_new_shard(self):
+        """Does a new shard get its share, taken from the others?"""
+
+        buckets = {bucket: bucket % 2 for bucket in range(NUM_BUCKETS)}
+        moves = plan_moves(buckets, 3)
+
+        self.assertEqual(len(moves), 341)
+        self.assertTrue(all(to_shard == 2 for _, _, to_shard in moves))
+        self.assertEqual({from_shard for _, from_shard, _ in moves}, {0, 1})
+
+    def test_plan_removed_shard(self):
+        """Do all the buckets of a dropped shard move?"""
+
+        buckets = {bucket: bucket % 3 for bucket in range(NUM_BUCKETS)}
+        moves = plan_moves(buckets, 2)
+
+        moved = {bucket for bucket, _, _ in moves}
+        self.assertTrue({bucket for bucket, shard in buckets.items()
+                         if shard == 2} <= moved)
+        self.assertTrue(all(to_shard < 2 for _, _, to_shard in moves))
+
+    def test_plan_balanced(self):
+        buckets = {bucket: bucket % 2 for bucket in range(NUM_BUCKETS)}
+        self.assertEqual(plan_moves(buckets, 2), [])
+
+
+class ShardedTestCase(DatabaseTestCase):
+    """Test reads and writes spread over two SQLite shards."""
+
+    def setUp(self):
+        super().setUp()
+        self._tmp = tempfile.TemporaryDirectory()
+        self.shard_set = ShardSet(
+            [f"sqlite:///{os.path.join(self._tmp.name, name)}"
+             for name in ("shard0.db", "shard1.db")], pool_size=2)
+        self._original_shards = app.extensions['shards']
+        app.extensions['shards'] = self.shard_set
+        create_tables()
+
+        # one user on each shard
+        self.users = {}
+        for n in range(10):
+            user = User.signup(f"user{n}", f"user{n}@test.com", "password",
+                               None)
+            db.session.flush()
+            self.users.setdefault(shard_for_user(user.id), user)
+            if len(self.users) == 2:
+                break
+        db.session.commit()
+
+    def tearDown(self):
+        app.extensions['shards'] = self._original_shards
+        self.shard_set.dispose()
+        self._tmp.cleanup()
+        super().tearDown()
+
+    def login(self, user):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user.id
+
+    def rows(self, shard, model):
+        return self.shard_set.sessions[shard].query(model).all()
+
+    def post(self, user, text):
+        self.login(user)
+        self.client.post("/messages/new", data={"text": text})
+        return self.rows(shard_for_user(user.id), Message)[-1]
+
+    def test_message_on_authors_shard(self):
+        """Is a new message stored on its author's shard only?"""
+
+        msg = self.post(self.users[1], "Hello")
+
+        self.assertEqual(msg.text, "Hello")
+        self.assertEqual(self.rows(0, Message), [])
+        self.assertEqual(Message.query.all(), [])
+
+        resp = self.client.get(f"/users/{self.users[1].id}")
+        self.assertIn("Hello", resp.get_data(as_text=True))
+
+    def test_timeline_across_shards(self):
+        """Does a timeline merge authors from both shards, newest first?"""
+
+        first = self.post(self.users[0], "first")
+        second = self.post(self.users[1], "second")
+
+        ids = recent_messages.timeline_ids(
+            [self.users[0].id, self.users[1].id])
+        messages = load_messages(ids)
+
+        self.assertEqual([msg.id for msg in messages], [second.id, first.id])
+        self.assertEqual(messages[0].user.username, self.users[1].username)
+
+    def test_purge_across_shards(self):
+        """Are a purged user's messages, and likes of them on other
+        shards, all deleted and counted?
+        """
+
+        doomed, other = self.users[0], self.users[1]
+        msg = self.post(doomed, "doomed")
+        reply = self.post(other, "reply")
+        self.login(other)
+        self.client.post(f"/users/add_like/{msg.id}")
+        self.login(doomed)
+        self.client.post(f"/users/add_like/{reply.id}")
+
+        doomed_id = doomed.id
+        tombstone_user(doomed)
+        progress = purge_user(doomed_id, batch_size=1, pause=0)
+
+        self.assertEqual(progress.messages_deleted, 1)
+        self.assertEqual(progress.likes_deleted, 2)
+        self.assertEqual(self.rows(0, Message), [])
+        self.assertEqual(self.rows(0, Likes) + self.rows(1, Likes), [])
+        self.assertEqual([row.id for row in self.rows(1, Message)],
+                         [reply.id])
+
+    def test_like_on_likers_shard(self):
+        """Is a like stored with the liker and counted on the message?"""
+
+        msg = self.post(self.users[0], "likeable")
+        self.login(self.users[1])
+        self.client.post(f"/users/add_like/{msg.id}")
+
+        self.assertEqual(len(self.rows(1, Likes)), 1)
+        self.assertEqual(self.rows(0, Likes), [])
+
+        resp = self.client.get(f"/messages/{msg.id}")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("1 like", resp.get_data(as_text=True))
+
+        self.login(self.users[0])
+        self.client.post(f"/messages/{msg.id}/delete")
+        self.assertEqual(self.rows(0, Message), [])
+        self.assertEqual(self.rows(1, Likes), [])
+
+    def test_move_bucket(self):
+        """Does a moved bucket take its messages to the new shard?"""
+
+        user = self.users[0]
+        self.post(user, "moving")
+
+        move_bucket(bucket_for(user.id), 0, 1, settle=0)
+
+        self.assertEqual(shard_for_user(user.id), 1)
+        self.assertEqual(self.rows(0, Message), [])
+        self.assertEqual([msg.text for msg in archive.user_timeline(user.id)],
+                         ["moving"])
+
+    def test_move_bucket_all_rows(self):
+        """Are backdated messages, likes and rows written to the old shard
+        late all moved, once each, by running the move again?
+        """
+
+        user, other = self.users[0], self.users[1]
+        self.post(user, "live")
+        reply = self.post(other, "reply")
+        self.login(user)
+        self.client.post(f"/users/add_like/{reply.id}")
+        old = self.shard_set.sessions[0]
+        old.add(Message(id=backdated_id(datetime(2017, 5, 6), 1),
+                        text="imported", timestamp=datetime(2017, 5, 6),
+                        user_id=user.id))
+        old.commit()
+
+        bucket = bucket_for(user.id)
+        self.assertEqual(move_bucket(bucket, 0, 1, settle=0), 3)
+
+        # a process with a stale map writes to the old shard
+        old.add(Message(id=backdated_id(datetime(2017, 5, 7), 1),
+                        text="late", timestamp=datetime(2017, 5, 7),
+                        user_id=user.id))
+        old.commit()
+        self.assertEqual(move_bucket(bucket, 0, 1, settle=0), 1)
+
+        self.assertEqual(self.rows(0, Message) + self.rows(0, Likes), [])
+        self.assertEqual(
+            sorted(msg.text for msg in self.rows(1, Message)),
+            ["imported", "late", "live", "reply"])
+        self.assertEqual([(like.user_id, like.message_id)
+                          for like in self.rows(1, Likes)],
+                         [(user.id, reply.id)])
+
+    def test_upgrade_old_likes(self):
+        """Does init-shards copy a serial-id likes table to the new shape,
+        dropping duplicates and dating likes by their message id?
+        """
+
+        user = self.users[0]
+        msg_id = backdated_id(datetime(2017, 5, 6), 1)
+        engine = self.shard_set.engines[0]
+        with engine.begin() as conn:
+            conn.execute(db.text("DROP TABLE likes"))
+            conn.execute(db.text(
+                "CREATE TABLE likes (id INTEGER PRIMARY KEY, "
+                "user_id INTEGER, message_id BIGINT)"))
+            conn.execute(db.text(
+                "CREATE INDEX ix_likes_user_id_message_id "
+                "ON likes (user_id, message_id)"))
+            conn.execute(db.text(
+                "INSERT INTO likes (user_id, message_id) VALUES "
+                f"({user.id}, {msg_id}), ({user.id}, {msg_id}), "
+                f"({user.id}, NULL)"))
+
+        self.assertEqual(create_tables(), 1)
+        self.assertEqual(create_tables(), 0)
+
+        self.assertEqual([(like.user_id, like.message_id, like.created_at)
+                          for like in self.rows(0, Likes)],
+                         [(user.id, msg_id, datetime(2017, 5, 6))])
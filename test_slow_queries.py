@@ -0,0 +1,112 @@
+"""Slow-query log tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_slow_queries.py
+
+
+import json
+from unittest import TestCase
+
+from models import db, User, Message
+from slow_queries import slow_queries, seq_scans
+
+from app import CURR_USER_KEY
+from testing import DatabaseTestCase, app
+
+
+class SeqScanTestCase(TestCase):
+    """Test spotting full table scans in plans."""
+
+    def test_postgres(self):
+        plan = ("Limit\n  ->  Sort\n        ->  Seq Scan on messages\n"
+                "  ->  Index Scan using users_pkey on users")
+        self.assertEqual(seq_scans('postgresql', plan), ['messages'])
+
+    def test_sqlite(self):
+        plan = ("SCAN messages\nSEARCH users USING INTEGER PRIMARY KEY\n"
+                "SCAN likes USING COVERING INDEX ix_likes_user_id_message_id")
+        self.assertEqual(seq_scans('sqlite', plan), ['messages'])
+
+    def test_no_plan(self):
+        self.assertEqual(seq_scans('postgresql', None), [])
+
+
+class SlowQueryLogTestCase(DatabaseTestCase):
+    """Test recording slow queries and showing them to admins."""
+
+    def setUp(self):
+        super().setUp()
+        self._config = dict(app.config)
+        slow_queries.clear()
+
+        self.admin = User.signup("admin", "admin@test.com", "password", None)
+        self.user = User.signup("user", "user@test.com", "password", None)
+        db.session.commit()
+        app.config['ADMIN_USERNAMES'] = ["admin"]
+
+    def tearDown(self):
+        app.config.update(self._config)
+        slow_queries.clear()
+        super().tearDown()
+
+    def login(self, user):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user.id
+
+    def test_records_with_plan(self):
+        """Is a slow SELECT recorded with its plan and route?"""
+
+        app.config['SLOW_QUERY_MS'] = 0
+        self.client.get(f"/users/{self.user.id}")
+
+        entries = [entry for entry in slow_queries.entries()
+                   if 'FROM messages' in entry['sql']]
+        self.assertTrue(entries)
+        self.assertEqual(entries[0]['endpoint'], 'warbler.users_show')
+        self.assertIsNotNone(entries[0]['plan'])
+
+    def test_explains_each_statement_once(self):
+        """Is a repeated statement explained only the first time?"""
+
+        app.config['SLOW_QUERY_MS'] = 0
+        Message.query.filter_by(user_id=1).all()
+        Message.query.filter_by(user_id=2).all()
+
+        plans = [entry['plan'] for entry in slow_queries.entries()
+                 if 'FROM messages' in entry['sql']]
+        self.assertEqual(len(plans), 2)
+        self.assertIsNone(plans[0])
+        self.assertIsNotNone(plans[1])
+
+    def test_threshold(self):
+        """Are fast queries left out?"""
+
+        app.config['SLOW_QUERY_MS'] = 60 * 1000
+        self.client.get(f"/users/{self.user.id}")
+        self.assertEqual(slow_queries.entries(), [])
+
+    def test_admin_only(self):
+        """Is the page hidden from everyone but admins?"""
+
+        self.assertEqual(self.client.get("/admin/slow-queries").status_code,
+                         404)
+        self.login(self.user)
+        self.assertEqual(self.client.get("/admin/slow-queries").status_code,
+                         404)
+
+        self.login(self.admin)
+        resp = self.client.get("/admin/slow-queries")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Slow queries", resp.get_data(as_text=True))
+
+    def test_jsonl(self):
+        """Is the buffer downloadable as JSON Lines?"""
+
+        app.config['SLOW_QUERY_MS'] = 0
+        self.login(self.admin)
+        resp = self.client.get("/admin/slow-queries.jsonl")
+        lines = resp.get_data(as_text=True).splitlines()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(all('sql' in json.loads(line) for line in lines))
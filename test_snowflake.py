@@ -0,0 +1,194 @@
+"""Snowflake message id tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_snowflake.py
+
+
+from datetime import datetime, timedelta
+from threading import Thread
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+
+from models import db, Message, User, Likes, MessageTag, IdWorkerLease
+from snowflake import (SnowflakeGenerator, BackdatedIds, EPOCH,
+                       LEGACY_ID_LIMIT, MAX_SEQUENCE, MAX_TIME, backdated_id,
+                       id_time, id_floor, claim_lease, renew_lease,
+                       migrate_legacy_ids)
+
+from testing import DatabaseTestCase
+
+
+class GeneratorTestCase(TestCase):
+    """Test generating ids."""
+
+    def test_increasing_across_threads(self):
+        """Are ids from many threads unique and increasing per thread?"""
+
+        generator = SnowflakeGenerator(3)
+        results = [[] for _ in range(4)]
+
+        def generate(out):
+            out.extend(generator.next_id() for _ in range(5000))
+
+        threads = [Thread(target=generate, args=(out,)) for out in results]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for ids in results:
+            self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(set().union(*results)), 20000)
+        self.assertGreater(min(results[0]), LEGACY_ID_LIMIT)
+
+    def test_sequence_overflow(self):
+        """Does a full millisecond spill into the next one?"""
+
+        generator = SnowflakeGenerator(1, clock=lambda: 1700000000.0)
+        ids = [generator.next_id() for _ in range(MAX_SEQUENCE + 2)]
+
+        self.assertEqual(len(set(ids)), len(ids))
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(id_time(ids[-1]) - id_time(ids[0]),
+                         timedelta(milliseconds=1))
+
+    def test_clock_going_back(self):
+        """Do ids keep increasing if the clock steps backwards?"""
+
+        times = iter([1700000000.5, 1700000000.0])
+        generator = SnowflakeGenerator(1, clock=lambda: next(times))
+
+        first, second = generator.next_id(), generator.next_id()
+        self.assertGreater(second, first)
+
+    def test_worker_id_range(self):
+        """Are worker ids in the backdated range refused?"""
+
+        with self.assertRaises(ValueError):
+            SnowflakeGenerator(512)
+
+    def test_backdated_ids_sort_by_time(self):
+        """Do backdated ids sort by their date, below ids generated now?"""
+
+        day = datetime(2021, 6, 1)
+        early = backdated_id(day, 999)
+        late = backdated_id(day + timedelta(milliseconds=1), 1)
+
+        self.assertLess(early, late)
+        self.assertLess(late, SnowflakeGenerator(0).next_id())
+        self.assertEqual(id_time(early), day)
+        self.assertLess(id_floor(day), early)
+        self.assertEqual(id_floor(EPOCH), 0)
+
+    def test_backdated_ids_before_2020(self):
+        """Are old dates given positive ids above the legacy ids, and dates
+        before EPOCH refused?
+        """
+
+        self.assertGreater(backdated_id(datetime(2017, 1, 1), 0),
+                           LEGACY_ID_LIMIT)
+        with self.assertRaises(ValueError):
+            backdated_id(EPOCH - timedelta(days=1), 0)
+
+    def test_backdated_ids_in_future(self):
+        """Are future dates, and dates past the id's time field, refused?"""
+
+        self.assertLess(backdated_id(datetime.utcnow(), 0), 2 ** 63)
+        for when in (datetime.utcnow() + timedelta(days=1),
+                     datetime(2060, 1, 1),
+                     MAX_TIME + timedelta(milliseconds=1)):
+            with self.assertRaises(ValueError):
+                backdated_id(when, 0)
+
+    def test_import_counter(self):
+        """Does one import give rows in the same millisecond distinct ids?"""
+
+        when = datetime(2017, 1, 1)
+        ids = BackdatedIds(start=(1 << 21) - 5)
+        self.assertEqual(len({ids(when) for _ in range(5000)}), 5000)
+
+
+class LeaseTestCase(TestCase):
+    """Test leasing worker ids."""
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        IdWorkerLease.__table__.create(self.engine)
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test_claim_lowest_free(self):
+        """Does each owner get its own worker id?"""
+
+        self.assertEqual(claim_lease(self.engine, 'a'), 0)
+        self.assertEqual(claim_lease(self.engine, 'b'), 1)
+
+    def test_expired_lease_is_taken_over(self):
+        """Can an expired lease be claimed, and does its old owner notice?"""
+
+        now = datetime.utcnow()
+        claim_lease(self.engine, 'a', now=now - timedelta(hours=1))
+
+        self.assertEqual(claim_lease(self.engine, 'b', now=now), 0)
+        self.assertFalse(renew_lease(self.engine, 0, 'a', now=now))
+        self.assertTrue(renew_lease(self.engine, 0, 'b', now=now))
+
+
+class LegacyIdTestCase(DatabaseTestCase):
+    """Test renumbering messages that have serial ids."""
+
+    def test_migrate_legacy_ids(self):
+        """Are old rows and their references moved to backdated ids?"""
+
+        user = User.signup("legacy", "legacy@test.com", "password", None)
+        db.session.commit()
+
+        when = datetime(2021, 3, 4, 5, 6, 7)
+        db.session.add_all([
+            Message(id=7, text="#old", timestamp=when, user_id=user.id),
+            Message(id=8, text="older", timestamp=when - timedelta(days=1),
+                    user_id=user.id),
+            Message(text="new", user_id=user.id),
+        ])
+        db.session.commit()
+        db.session.add_all([Likes(user_id=user.id, message_id=7),
+                            MessageTag(tag='old', message_id=7)])
+        db.session.commit()
+
+        self.assertEqual(migrate_legacy_ids(batch_size=1, pause=0), 2)
+
+        texts = [msg.text for msg in
+                 Message.query.order_by(Message.id.desc())]
+        self.assertEqual(texts, ["new", "#old", "older"])
+
+        new_id = Message.query.filter_by(text="#old").one().id
+        self.assertEqual(new_id, backdated_id(when, 7))
+        self.assertEqual(Likes.query.one().message_id, new_id)
+        self.assertEqual(MessageTag.query.one().message_id, new_id)
+        self.assertEqual(migrate_legacy_ids(pause=0), 0)
+
+    def test_migrate_pre_2020(self):
+        """Are rows from before 2020 renumbered once, and stray negative
+        ids left alone?
+        """
+
+        user = User.signup("legacy", "legacy@test.com", "password", None)
+        db.session.commit()
+
+        when = datetime(2017, 5, 6, 7, 8, 9)
+        db.session.add_all([
+            Message(id=3, text="2017", timestamp=when, user_id=user.id),
+            Message(id=-5, text="negative", timestamp=when, user_id=user.id),
+        ])
+        db.session.commit()
+
+        self.assertEqual(migrate_legacy_ids(batch_size=1, pause=0), 1)
+        self.assertEqual(migrate_legacy_ids(batch_size=1, pause=0), 0)
+
+        self.assertEqual(Message.query.filter_by(text="2017").one().id,
+                         backdated_id(when, 3))
+        self.assertEqual(Message.query.filter_by(text="negative").one().id,
+                         -5)
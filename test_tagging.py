@@ -0,0 +1,120 @@
+"""Tag and mention index tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_tagging.py
+
+
+from unittest import TestCase
+
+from models import db, Message, User, MessageTag, Mention
+from tagging import (extract_tags, extract_mentions, index_range,
+                     tag_timeline, mentions_timeline)
+
+from app import CURR_USER_KEY
+from testing import DatabaseTestCase
+
+
+class ExtractTestCase(TestCase):
+    """Test parsing tags and mentions out of message text."""
+
+    def test_extract_tags(self):
+        """Are tags lowercased and de-duplicated?"""
+        self.assertEqual(extract_tags("#Python and #flask, #python!"),
+                         ['flask', 'python'])
+
+    def test_extract_tags_ignores_fragments(self):
+        """Are '#' inside words, '##' and bare '#' ignored?"""
+        self.assertEqual(extract_tags("a#b ##c # d"), [])
+
+    def test_extract_mentions(self):
+        """Are @mentions found but email addresses skipped?"""
+        self.assertEqual(extract_mentions("hi @bob and @amy_2, bob@x.com"),
+                         ['amy_2', 'bob'])
+        self.assertEqual(extract_mentions("@Bob @bob"), ['bob'])
+
+
+class TagTimelineTestCase(DatabaseTestCase):
+    """Test indexing messages and paging through tag timelines."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.alice = User.signup("alice", "alice@test.com", "password", None)
+        self.bob = User.signup("Bob", "bob@test.com", "password", None)
+        db.session.commit()
+
+    def test_posting_indexes_message(self):
+        """Does posting a message index its tags and mentions?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.alice.id
+
+            c.post("/messages/new", data={"text": "#Hello @bob @nobody"})
+
+        msg = Message.query.one()
+        self.assertEqual([(t.tag, t.message_id) for t in MessageTag.query],
+                         [('hello', msg.id)])
+        self.assertEqual([(m.user_id, m.message_id) for m in Mention.query],
+                         [(self.bob.id, msg.id)])
+
+    def test_keyset_pages(self):
+        """Do pages follow on from the cursor without overlap?"""
+
+        for n in range(5):
+            db.session.add(Message(text=f"#news {n} @bob",
+                                   user_id=self.alice.id))
+        db.session.commit()
+        index_range(0, 2 ** 63 - 1)
+
+        first, cursor = tag_timeline('NEWS', limit=3)
+        second, last = tag_timeline('news', before=cursor, limit=3)
+
+        self.assertEqual([m.text for m in first + second],
+                         [f"#news {n} @bob" for n in range(4, -1, -1)])
+        self.assertIsNone(last)
+
+        mentions, cursor = mentions_timeline(self.bob.id, limit=10)
+        self.assertEqual(len(mentions), 5)
+        self.assertIsNone(cursor)
+
+    def test_reindex_is_idempotent(self):
+        """Can an id range be indexed twice?"""
+
+        db.session.add(Message(text="#again", user_id=self.alice.id))
+        db.session.commit()
+
+        index_range(0, 2 ** 63 - 1)
+        index_range(0, 2 ** 63 - 1)
+
+        self.assertEqual(MessageTag.query.count(), 1)
+
+    def test_tag_page(self):
+        """Does the tag page show tagged messages?"""
+
+        db.session.add(Message(text="Look #here", user_id=self.alice.id))
+        db.session.commit()
+        index_range(0, 2 ** 63 - 1)
+
+        resp = self.client.get("/tags/here")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Look #here", resp.get_data(as_text=True))
+
+    def test_out_of_range_cursor(self):
+        """Are cursors beyond a 64-bit id clamped rather than a 500?"""
+
+        db.session.add(Message(text="#python @bob", user_id=self.alice.id))
+        db.session.commit()
+        index_range(0, 2 ** 63 - 1)
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.bob.id
+
+        for url in ("/tags/python", "/mentions"):
+            resp = self.client.get(f"{url}?before={'9' * 30}")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("#python @bob", resp.get_data(as_text=True))
+
+            resp = self.client.get(f"{url}?before=-{'9' * 30}")
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn("#python @bob", resp.get_data(as_text=True))
@@ -0,0 +1,122 @@
+"""Template bytecode cache and render timing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_template_cache.py
+
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from jinja2 import Environment, FileSystemLoader
+
+from models import db, User
+from template_cache import (TemplateBytecodeCache, TimedLoader, TimedTemplate,
+                            compile_templates, template_stats)
+
+from app import CURR_USER_KEY
+from testing import DatabaseTestCase, app
+
+
+class BytecodeCacheTestCase(TestCase):
+    """Test compiling templates ahead of time."""
+
+    def setUp(self):
+        self.templates = tempfile.mkdtemp()
+        self.bytecode = tempfile.mkdtemp()
+        self.write('base.html', "<p>{% block body %}{% endblock %}</p>")
+        self.write('page.html', "{% extends 'base.html' %}"
+                                "{% block body %}hi {{ name }}{% endblock %}")
+        template_stats.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.templates)
+        shutil.rmtree(self.bytecode)
+        template_stats.clear()
+
+    def write(self, name, source):
+        with open(os.path.join(self.templates, name), 'w') as f:
+            f.write(source)
+
+    def environment(self):
+        """A fresh environment, like a newly started worker's."""
+
+        env = Environment(
+            loader=TimedLoader(FileSystemLoader(self.templates)),
+            bytecode_cache=TemplateBytecodeCache(self.bytecode))
+        env.template_class = TimedTemplate
+        return env
+
+    def test_compile(self):
+        self.assertEqual(compile_templates(self.environment()), (2, 0))
+        self.assertEqual(compile_templates(self.environment()), (0, 2))
+
+    def test_new_worker_skips_compiling(self):
+        """Does a worker load compiled templates without compiling?"""
+
+        compile_templates(self.environment())
+        template_stats.clear()
+
+        html = self.environment().get_template('page.html').render(name="x")
+
+        self.assertEqual(html, "<p>hi x</p>")
+        stats = template_stats.stats()
+        self.assertEqual(stats['page.html']['compiles'], 0)
+        self.assertEqual(stats['base.html']['compiles'], 0)
+        self.assertEqual(stats['page.html']['loads'], 1)
+
+    def test_changed_source(self):
+        """Is a template recompiled when its source changes?"""
+
+        compile_templates(self.environment())
+        self.write('page.html', "{% extends 'base.html' %}"
+                                "{% block body %}bye{% endblock %}")
+
+        self.assertEqual(compile_templates(self.environment()), (1, 1))
+        self.assertEqual(
+            self.environment().get_template('page.html').render(),
+            "<p>bye</p>")
+
+    def test_render_times(self):
+        template = self.environment().get_template('page.html')
+        template.render(name="a")
+        template.render(name="b")
+
+        stats = template_stats.stats()['page.html']
+        self.assertEqual(stats['renders'], 2)
+        self.assertGreaterEqual(stats['max_render_ms'],
+                                stats['avg_render_ms'])
+
+
+class TemplateStatsViewTestCase(DatabaseTestCase):
+    """Test the app's render timing and its admin page."""
+
+    def setUp(self):
+        super().setUp()
+        self._admins = app.config['ADMIN_USERNAMES']
+        template_stats.clear()
+        self.user = User.signup("admin", "admin@test.com", "password", None)
+        db.session.commit()
+
+    def tearDown(self):
+        app.config['ADMIN_USERNAMES'] = self._admins
+        template_stats.clear()
+        super().tearDown()
+
+    def test_pages_timed(self):
+        self.client.get("/")
+        self.assertEqual(template_stats.stats()['home-anon.html']['renders'],
+                         1)
+
+    def test_admin_only(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user.id
+
+        self.assertEqual(self.client.get("/admin/templates").status_code, 404)
+
+        app.config['ADMIN_USERNAMES'] = ["admin"]
+        self.client.get("/")
+        stats = self.client.get("/admin/templates").get_json()
+        self.assertEqual(stats['home.html']['renders'], 1)
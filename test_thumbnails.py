@@ -0,0 +1,92 @@
+"""Thumbnail pipeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_thumbnails.py
+
+
+import io
+import shutil
+import tempfile
+from unittest import TestCase
+
+from PIL import Image
+
+import thumbnails
+from thumbnails import make_thumbnail, _local_path, thumbnail_url, VARIANTS
+
+from testing import DatabaseTestCase, app
+
+
+class ThumbnailTestCase(TestCase):
+    """Test thumbnail generation and source path handling."""
+
+    def test_make_thumbnail_size(self):
+        """Is a large image cropped and scaled to the variant's size?"""
+        source = io.BytesIO()
+        Image.new('RGBA', (1200, 800), (255, 0, 0, 255)).save(source, 'PNG')
+
+        thumbnail = make_thumbnail(source.getvalue(), 'header')
+        image = Image.open(io.BytesIO(thumbnail))
+
+        self.assertEqual(image.format, 'JPEG')
+        self.assertEqual(image.size, VARIANTS['header'])
+
+    def test_local_path_stays_in_base(self):
+        """Are paths escaping the base directory refused?"""
+        self.assertEqual(_local_path('/srv/img', 'a/b.jpg'), '/srv/img/a/b.jpg')
+        self.assertEqual(_local_path('/srv/img', '/a.jpg'), '/srv/img/a.jpg')
+        self.assertIsNone(_local_path('/srv/img', '../secret.txt'))
+
+
+class ThumbnailRouteTestCase(DatabaseTestCase):
+    """Test generating thumbnails on request."""
+
+    def setUp(self):
+        super().setUp()
+        self._dir = app.config['THUMBNAIL_DIR']
+        app.config['THUMBNAIL_DIR'] = tempfile.mkdtemp()
+        thumbnails._digests.clear()
+
+    def tearDown(self):
+        shutil.rmtree(app.config['THUMBNAIL_DIR'])
+        app.config['THUMBNAIL_DIR'] = self._dir
+        thumbnails._digests.clear()
+        super().tearDown()
+
+    def test_signed_source(self):
+        with app.test_request_context():
+            url = thumbnail_url('/static/images/default-pic.png')
+
+        resp = self.client.get(url)
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertRegex(resp.location, r'/thumbs/[0-9a-f]{64}\.jpg$')
+
+    def test_unsigned_source(self):
+        """Are sources the app didn't link to refused?"""
+
+        with app.test_request_context():
+            url = thumbnail_url('/static/images/default-pic.png')
+
+        for bad in (url.split('&sig=')[0],
+                    url.replace('/thumbs/avatar', '/thumbs/header'),
+                    url.replace('default-pic.png', 'warbler-hero.jpg')):
+            self.assertEqual(self.client.get(bad).status_code, 404)
+
+    def test_digest_memo_bounded(self):
+        """Is the digest memo trimmed, with evicted thumbnails still found
+        on disk?
+        """
+
+        thumbnails._digests.max_entries = 1
+        try:
+            src = '/static/images/default-pic.png'
+            avatar = thumbnails.ensure_thumbnail(src, 'avatar')
+            thumbnails.ensure_thumbnail(src, 'header')
+
+            self.assertEqual(len(thumbnails._digests._entries), 1)
+            self.assertIsNone(thumbnails._digests.get((src, 'avatar')))
+            self.assertEqual(thumbnails.known_digest(src, 'avatar'), avatar)
+        finally:
+            thumbnails._digests.max_entries = thumbnails.MAX_DIGESTS
@@ -0,0 +1,86 @@
+"""Timeline cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timeline_cache.py
+
+
+from datetime import datetime
+from unittest import TestCase
+
+from archive import archive_messages
+from cache import cache, messages_tag
+from models import db, User, Message
+from timeline_cache import RecentMessagesCache, recent_messages
+
+from testing import DatabaseTestCase
+
+
+class RecentMessagesCacheTestCase(TestCase):
+    """Test merging per-author recent message caches."""
+
+    def setUp(self):
+        """Seed two authors' caches without touching the database."""
+
+        self.cache = RecentMessagesCache(per_author=3)
+        self.cache._recent = {
+            1: [50, 30, 10],
+            2: [40, 20],
+        }
+
+    def test_timeline_ids(self):
+        """Are messages from all authors merged newest first?"""
+        self.assertEqual(self.cache.timeline_ids([1, 2]), [50, 40, 30, 20, 10])
+
+    def test_timeline_limit(self):
+        """Does the merge stop at the limit?"""
+        self.assertEqual(self.cache.timeline_ids([1, 2], limit=2), [50, 40])
+
+    def test_push_is_bounded(self):
+        """Does pushing keep only the newest entries per author?"""
+        self.cache.push(1, 60)
+        self.assertEqual(self.cache.recent(1), [60, 50, 30])
+
+    def test_remove(self):
+        """Does removing a message from a partial cache drop just that one?"""
+        self.cache.remove(2, 40)
+        self.assertEqual(self.cache.recent(2), [20])
+
+
+class SharedTimelineTestCase(DatabaseTestCase):
+    """Test noticing changes made by other processes."""
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.signup("user", "user@test.com", "password", None)
+        db.session.flush()
+        self.old = Message(id=1000, text="old", user_id=self.user.id,
+                           timestamp=datetime(2020, 1, 1))
+        self.new = Message(text="new", user_id=self.user.id)
+        db.session.add_all([self.old, self.new])
+        db.session.commit()
+
+    def test_posted_elsewhere(self):
+        """Is a message posted by another process merged once its author's
+        tag is invalidated?
+        """
+
+        self.assertEqual(recent_messages.timeline_ids([self.user.id]),
+                         [self.new.id, self.old.id])
+
+        other = Message(text="other", user_id=self.user.id)
+        db.session.add(other)
+        db.session.commit()
+        cache.invalidate(messages_tag(self.user.id))
+
+        self.assertEqual(recent_messages.timeline_ids([self.user.id]),
+                         [other.id, self.new.id, self.old.id])
+
+    def test_archived(self):
+        """Are archived messages dropped from cached timelines?"""
+
+        recent_messages.timeline_ids([self.user.id])
+        self.assertEqual(archive_messages(days=30, pause=0), 1)
+
+        self.assertEqual(recent_messages.timeline_ids([self.user.id]),
+                         [self.new.id])
@@ -6,43 +6,25 @@
 
 
 import os
-from unittest import TestCase
 
 from models import db, User, Message, Follows
 
 from sqlalchemy.exc import IntegrityError, InvalidRequestError
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
+# Each test runs in a transaction that is rolled back afterwards;
+# see testing.py for how the test database is chosen
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+from testing import app, DatabaseTestCase
 
 
-# Now we can import app
-
-from app import app
-
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-
-db.create_all()
-
-
-class UserModelTestCase(TestCase):
+class UserModelTestCase(DatabaseTestCase):
     """Test views for messages."""
 
     def setUp(self):
         """Create test client, add sample data."""
 
-        User.query.delete()
-        Message.query.delete()
-        Follows.query.delete()
+        super().setUp()
 
-        self.client = app.test_client()
-        
         user = User.signup(
             "JaneDoe",
             "test@email.com",            
@@ -62,10 +44,6 @@ class UserModelTestCase(TestCase):
         self.user = user
         self.user_2 = user_2
         
-    def tearDown(self):
-        """Rollback any failed transactions."""
-        db.session.rollback()
-
     def test_user_model(self):
         """Does basic model work?"""
 
@@ -7,43 +7,24 @@
 
 from cgi import test
 import os
-from unittest import TestCase
 
 from models import db, connect_db, Message, User
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
+# Each test runs in a transaction that is rolled back afterwards;
+# see testing.py for how the test database is chosen
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
-
-# Now we can import app
 from flask import session
-from app import app, CURR_USER_KEY
-
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-
-db.create_all()
-
-# Don't have WTForms use CSRF at all, since it's a pain to test
+from app import CURR_USER_KEY
+from testing import app, DatabaseTestCase
 
-app.config['WTF_CSRF_ENABLED'] = False
-app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 
-
-class UserViewTestCase(TestCase):
+class UserViewTestCase(DatabaseTestCase):
     """Test views for messages."""
 
     def setUp(self):
         """Create test client, add sample data."""
 
-        User.query.delete()
-        Message.query.delete()
-
-        self.client = app.test_client()
+        super().setUp()
 
         test_user = User.signup(
             username="testuser",
@@ -66,10 +47,6 @@ class UserViewTestCase(TestCase):
         self.test_user_2 = test_user_2
         self.test_user_id_2 = test_user_2.id
         
-    def tearDown(self):
-        """Rollback any failed transactions."""
-        db.session.rollback()
-        
     def test_view_following(self):
         """When you’re logged in, can you see the following pages for any user?"""
         with self.client as c:            
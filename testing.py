@@ -0,0 +1,159 @@
+"""Shared fixtures for the test suite.
+
+`DatabaseTestCase` runs every test inside a transaction that is rolled back
+afterwards, so tests never have to delete rows and leave nothing behind.
+Code under test (and the routes it calls through the test client) can
+still `db.session.commit()`: each commit just releases a SAVEPOINT, and a
+new one is started straight away.
+
+The database comes from TEST_DATABASE_URL (default
+postgresql:///warbler-test). For fast local runs use in-memory SQLite:
+
+    TEST_DATABASE_URL=sqlite:// python -m pytest
+
+Under pytest-xdist (`python -m pytest -n auto`) each worker process gets its
+own database: `warbler-test-gw0`, `warbler-test-gw1`, ... on Postgres
+(created if missing), a separate file for file-based SQLite, and a separate
+in-memory database for free with `sqlite://`.
+"""
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+
+from admission import stale_copies
+from availability import taken_names
+from cache import cache
+from config import TestingConfig
+from follow_graph import follow_graph
+from models import db
+from timeline_cache import recent_messages
+
+
+def worker_database_url(url, worker=None):
+    """`url` with a per-worker suffix on the database name, if running
+    under pytest-xdist.
+    """
+
+    worker = worker or os.environ.get('PYTEST_XDIST_WORKER')
+    parsed = make_url(url)
+
+    if not worker or not parsed.database or parsed.database == ':memory:':
+        return url
+
+    base, sep, query = url.partition('?')
+    head, slash, name = base.rpartition('/')
+    if parsed.drivername.startswith('sqlite'):
+        root, ext = os.path.splitext(name)
+        name = f"{root}-{worker}{ext}"
+    else:
+        name = f"{name}-{worker}"
+
+    return f"{head}{slash}{name}{sep}{query}"
+
+
+def create_database_if_missing(url):
+    """Create the Postgres database named in `url` if it doesn't exist."""
+
+    parsed = make_url(url)
+    if not parsed.drivername.startswith('postgresql'):
+        return
+
+    maintenance_url = url.rpartition('/')[0] + '/postgres'
+    engine = create_engine(maintenance_url, isolation_level='AUTOCOMMIT')
+    with engine.connect() as conn:
+        exists = conn.execute(
+            db.text("SELECT 1 FROM pg_database WHERE datname = :name"),
+            name=parsed.database).scalar()
+        if not exists:
+            conn.execute(db.text(f'CREATE DATABASE "{parsed.database}"'))
+    engine.dispose()
+
+
+class WorkerTestingConfig(TestingConfig):
+    SQLALCHEMY_DATABASE_URI = worker_database_url(
+        TestingConfig.SQLALCHEMY_DATABASE_URI)
+
+
+def _enable_sqlite_savepoints(engine):
+    """pysqlite manages transactions itself and breaks SAVEPOINT; take
+    over BEGIN so nested transactions work.
+    """
+
+    @event.listens_for(engine, 'connect')
+    def do_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def do_begin(conn):
+        conn.execute('BEGIN')
+
+
+def _setup_app():
+    from app import create_app
+
+    create_database_if_missing(WorkerTestingConfig.SQLALCHEMY_DATABASE_URI)
+    app = create_app(WorkerTestingConfig)
+    app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+    with app.app_context():
+        if db.engine.dialect.name == 'sqlite':
+            _enable_sqlite_savepoints(db.engine)
+        # create our tables once per process; each test rolls back its data
+        db.create_all()
+
+    return app
+
+
+app = _setup_app()
+
+
+def _restart_savepoint(session, transaction):
+    """Begin a new SAVEPOINT whenever the test's current one ends."""
+
+    if transaction.nested and not transaction._parent.nested:
+        session.expire_all()
+        session.begin_nested()
+
+
+class DatabaseTestCase(TestCase):
+    """TestCase whose database changes are rolled back after each test."""
+
+    def setUp(self):
+        """Start the outer transaction and point db.session at it."""
+
+        self._app_context = app.app_context()
+        self._app_context.push()
+
+        self._connection = db.engine.connect()
+        self._transaction = self._connection.begin()
+
+        self._original_session = db.session
+        session = db.create_scoped_session(
+            options={'bind': self._connection, 'binds': {}})
+        # Flask-SQLAlchemy removes the session after every request; keep
+        # the test's objects attached instead and just reload them
+        session.remove = session.expire_all
+        event.listen(session, 'after_transaction_end', _restart_savepoint)
+        session.begin_nested()
+        db.session = session
+
+        # in-memory indexes would otherwise remember rolled-back rows
+        follow_graph.reset()
+        recent_messages.clear()
+        cache.clear()
+        taken_names.reset()
+        stale_copies.clear()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        """Roll back everything the test did."""
+
+        db.session.close()
+        db.session = self._original_session
+        self._transaction.rollback()
+        self._connection.close()
+        self._app_context.pop()
@@ -0,0 +1,258 @@
+"""Fixed-size thumbnails for avatars and header images.
+
+`User.image_url` and `User.header_image_url` point at full-size images, and
+every card and timeline row used to make the browser fetch them at full
+resolution. Templates now call `thumbnail_url(url, variant)`, which points
+at a small, fixed-size copy instead.
+
+Thumbnails are generated on first request (or ahead of time by the
+`generate_thumbnails` job queued from signup and profile edits), stored on
+disk under the SHA-256 of their contents, and served with immutable
+caching headers, since a given content-addressed URL never changes.
+
+Source images are read from:
+
+- the app's static folder, for `/static/...` urls
+- `IMAGE_ORIGIN_DIR`, a local stand-in for the image origin, where the
+  url's path (e.g. `portraits/men/12.jpg`) is looked up as a file
+- the network, for http(s) urls, only if `IMAGE_FETCH_REMOTE` is set
+
+The generating route only accepts a `src` signed with SECRET_KEY by
+`thumbnail_url`, so clients can't make us fetch, decode and store images
+the app never linked to.
+"""
+
+import hashlib
+import hmac
+import io
+import os
+from urllib.parse import urlparse, quote
+from urllib.request import urlopen
+
+from flask import current_app
+
+from cache import LocalBackend
+from jobs import job
+
+VARIANTS = {
+    # timeline rows and cards show avatars at 48-70px; 96 covers 2x screens
+    'avatar': (96, 96),
+    # the big avatar on profile pages is 200px
+    'profile': (400, 400),
+    # card headers
+    'header': (480, 240),
+}
+
+MAX_SOURCE_BYTES = 10 * 1024 * 1024
+FETCH_TIMEOUT = 5
+JPEG_QUALITY = 80
+MAX_DIGESTS = 10000
+
+# (source url, variant) -> content digest, for thumbnails this process has
+# made or looked up; the least recently used are dropped past MAX_DIGESTS
+_digests = LocalBackend(max_entries=MAX_DIGESTS)
+
+
+def _config(key, default=None):
+    return current_app.config.get(key, default)
+
+
+def thumbnail_dir():
+    return _config('THUMBNAIL_DIR',
+                   os.path.join(current_app.instance_path, 'thumbnails'))
+
+
+def _ref_path(url, variant):
+    key = hashlib.sha256(f"{variant}:{url}".encode('utf-8')).hexdigest()
+    return os.path.join(thumbnail_dir(), 'refs', key[:2], key)
+
+
+def _blob_path(digest):
+    return os.path.join(thumbnail_dir(), 'blobs', digest[:2], f"{digest}.jpg")
+
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as tmp:
+        tmp.write(data)
+    os.replace(tmp_path, path)
+
+
+def fetch_source(url):
+    """Return the bytes of the original image at `url`, or None."""
+
+    parsed = urlparse(url)
+
+    if not parsed.scheme and parsed.path.startswith('/static/'):
+        return _read_file(current_app.static_folder,
+                          parsed.path[len('/static/'):])
+
+    origin_dir = _config('IMAGE_ORIGIN_DIR')
+    if origin_dir:
+        data = _read_file(origin_dir, parsed.path)
+        if data is not None:
+            return data
+
+    if parsed.scheme in ('http', 'https') and _config('IMAGE_FETCH_REMOTE'):
+        try:
+            with urlopen(url, timeout=FETCH_TIMEOUT) as resp:
+                return resp.read(MAX_SOURCE_BYTES)
+        except (OSError, ValueError):
+            return None
+
+    return None
+
+
+def _local_path(base, path):
+    """`path` resolved under `base`, or None if it escapes `base`."""
+
+    base = os.path.abspath(base)
+    full = os.path.abspath(os.path.join(base, path.lstrip('/')))
+    return full if full.startswith(base + os.sep) else None
+
+
+def _read_file(base, path):
+    path = _local_path(base, path)
+    if path is None or not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as source:
+        return source.read(MAX_SOURCE_BYTES)
+
+
+def make_thumbnail(data, variant):
+    """Crop and scale image bytes to `variant`'s size, as JPEG bytes."""
+
+    # Pillow is only needed by whichever process generates thumbnails, so
+    # web workers that just serve them don't pay for importing it
+    from PIL import Image, ImageOps
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except Image.DecompressionBombError as exc:
+        raise ValueError(str(exc))
+
+    image = ImageOps.fit(image.convert('RGB'), VARIANTS[variant],
+                         Image.LANCZOS)
+
+    out = io.BytesIO()
+    image.save(out, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+    return out.getvalue()
+
+
+def known_digest(url, variant):
+    """Digest of an already-generated thumbnail, or None."""
+
+    digest = _digests.get((url, variant))
+    if digest:
+        return digest
+
+    try:
+        with open(_ref_path(url, variant)) as ref:
+            digest = ref.read().strip()
+    except OSError:
+        return None
+
+    _digests.set((url, variant), digest)
+    return digest
+
+
+def ensure_thumbnail(url, variant):
+    """Generate (if needed) and store the thumbnail. Returns its digest,
+    or None if the source can't be fetched or decoded.
+    """
+
+    digest = known_digest(url, variant)
+    if digest and os.path.exists(_blob_path(digest)):
+        return digest
+
+    data = fetch_source(url)
+    if data is None:
+        return None
+
+    try:
+        thumbnail = make_thumbnail(data, variant)
+    except (OSError, ValueError):
+        return None
+
+    digest = hashlib.sha256(thumbnail).hexdigest()
+    if not os.path.exists(_blob_path(digest)):
+        _write_atomic(_blob_path(digest), thumbnail)
+    _write_atomic(_ref_path(url, variant), digest.encode('ascii'))
+    _digests.set((url, variant), digest)
+
+    return digest
+
+
+def blob_path(digest):
+    """Path on disk of a stored thumbnail, or None if there isn't one."""
+
+    if len(digest) != 64 or not all(c in '0123456789abcdef' for c in digest):
+        return None
+    path = _blob_path(digest)
+    return path if os.path.exists(path) else None
+
+
+def can_fetch(url):
+    """Cheap check for whether `fetch_source(url)` has anywhere to look."""
+
+    parsed = urlparse(url)
+
+    if not parsed.scheme and parsed.path.startswith('/static/'):
+        return True
+    if parsed.scheme in ('http', 'https') and _config('IMAGE_FETCH_REMOTE'):
+        return True
+
+    origin_dir = _config('IMAGE_ORIGIN_DIR')
+    if not origin_dir:
+        return False
+    path = _local_path(origin_dir, parsed.path)
+    return path is not None and os.path.isfile(path)
+
+
+def sign_source(url, variant):
+    """Signature for `url` in the generating route's `sig` parameter."""
+
+    secret = current_app.config['SECRET_KEY']
+    return hmac.new(secret.encode('utf-8'),
+                    f"thumbnail:{variant}:{url}".encode('utf-8'),
+                    hashlib.sha256).hexdigest()
+
+
+def verify_source(url, variant, sig):
+    """Was `url` signed for `variant` by `thumbnail_url`?"""
+
+    return bool(url and sig) and hmac.compare_digest(
+        sign_source(url, variant), sig)
+
+
+def thumbnail_url(url, variant='avatar'):
+    """URL to use in templates in place of `url`.
+
+    Points straight at the stored thumbnail when this process already knows
+    it, otherwise at the route that generates it on first request. Images
+    we have no way to fetch are left as they are.
+    """
+
+    if not url:
+        return url
+
+    digest = _digests.get((url, variant))
+    if digest:
+        return f"/thumbs/{digest}.jpg"
+    if not can_fetch(url):
+        return url
+    return (f"/thumbs/{variant}?src={quote(url, safe='')}"
+            f"&sig={sign_source(url, variant)}")
+
+
+@job('generate_thumbnails')
+def generate_thumbnails_job(image_url=None, header_image_url=None):
+    """Job handler: build a user's thumbnails ahead of time."""
+
+    if image_url:
+        for variant in ('avatar', 'profile'):
+            ensure_thumbnail(image_url, variant)
+    if header_image_url:
+        ensure_thumbnail(header_image_url, 'header')
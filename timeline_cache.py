@@ -0,0 +1,169 @@
+"""Per-author recent-message cache for fan-out-on-read timelines.
+
+Each author gets a small bounded list of their newest message ids (which
+are time-ordered; see snowflake.py). The home timeline is then a k-way
+merge over the caches of the authors a user follows, so building it never
+needs the big `user_id IN (...) ORDER BY id` query, and posting a message only
+touches the author's own cache no matter how many followers they have.
+
+Authors are loaded from the database the first time they are needed and
+kept current in this process by calling `push()` / `remove()` after a
+message is added or deleted. Other processes (and the archive job) change
+messages too: each author's list remembers the version of their shared
+`messages_tag()` it was loaded at, and is reloaded once that tag has been
+invalidated.
+"""
+
+from heapq import merge
+from itertools import islice
+from threading import Lock
+
+from flask import has_app_context
+
+from cache import cache, messages_tag
+from models import db, Message
+import shards
+
+RECENT_PER_AUTHOR = 100
+
+
+class RecentMessagesCache:
+    """Bounded newest-first message id lists per author."""
+
+    def __init__(self, per_author=RECENT_PER_AUTHOR):
+        self.per_author = per_author
+        self._recent = {}
+        self._versions = {}
+        self._lock = Lock()
+
+    def _query_authors(self, session, author_ids):
+        row_number = (db.func.row_number()
+                      .over(partition_by=Message.user_id,
+                            order_by=Message.id.desc())
+                      .label('row_number'))
+        ranked = (session.query(Message.user_id, Message.id, row_number)
+                  .filter(Message.user_id.in_(author_ids))
+                  .subquery())
+        return (session.query(ranked.c.user_id, ranked.c.id)
+                .filter(ranked.c.row_number <= self.per_author)
+                .order_by(ranked.c.user_id, ranked.c.id.desc())
+                .all())
+
+    def _load_authors(self, author_ids):
+        """Fill the cache for `author_ids` with one windowed query per
+        shard.
+        """
+
+        # versions first, so a change made during the load shows as stale
+        versions = self._shared_versions(author_ids)
+        loaded = {author_id: [] for author_id in author_ids}
+        for rows in shards.scatter_by_user(author_ids, self._query_authors):
+            for author_id, msg_id in rows:
+                loaded[author_id].append(msg_id)
+
+        with self._lock:
+            for author_id, entries in loaded.items():
+                self._recent[author_id] = entries
+                self._versions[author_id] = versions.get(author_id)
+
+    def _shared_versions(self, author_ids):
+        """{author_id: messages_tag version}; empty outside an app or if
+        the cache is down, and then nothing is ever seen as stale.
+        """
+
+        if not author_ids or not has_app_context():
+            return {}
+        versions = cache.tag_versions(
+            messages_tag(author_id) for author_id in author_ids)
+        if versions is None:
+            return {}
+        return {author_id: versions[messages_tag(author_id)]
+                for author_id in author_ids}
+
+    def _to_load(self, author_ids):
+        """Those of `author_ids` not cached, or changed since loaded."""
+
+        missing = [author_id for author_id in author_ids
+                   if author_id not in self._recent]
+        cached = [author_id for author_id in author_ids
+                  if author_id in self._recent]
+        versions = self._shared_versions(cached)
+        return missing + [author_id for author_id, version in versions.items()
+                          if version != self._versions.get(author_id)]
+
+    def recent(self, author_id):
+        """Newest-first message ids for one author."""
+
+        if self._to_load([author_id]):
+            self._load_authors([author_id])
+        return self._recent[author_id]
+
+    def push(self, author_id, msg_id):
+        """Record a new message by `author_id`."""
+
+        with self._lock:
+            entries = self._recent.get(author_id)
+            if entries is None:
+                # not cached yet; the next load will read it from the db
+                return
+            # build a new list so concurrent merges never see it mid-update
+            entries = sorted(entries + [msg_id], reverse=True)
+            self._recent[author_id] = entries[:self.per_author]
+
+    def remove(self, author_id, msg_id):
+        """Forget a deleted message.
+
+        If that drops the author below a full cache, reload them on next
+        use so older messages can slide back in.
+        """
+
+        with self._lock:
+            entries = self._recent.get(author_id)
+            if entries is None:
+                return
+            remaining = [entry for entry in entries if entry != msg_id]
+            if len(remaining) != len(entries) and \
+                    len(entries) == self.per_author:
+                del self._recent[author_id]
+            else:
+                self._recent[author_id] = remaining
+
+    def forget(self, author_id):
+        """Drop an author entirely (e.g. when their account is deleted)."""
+
+        with self._lock:
+            self._recent.pop(author_id, None)
+            self._versions.pop(author_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._recent.clear()
+            self._versions.clear()
+
+    def timeline_ids(self, author_ids, limit=100):
+        """Ids of the `limit` newest messages across `author_ids`."""
+
+        to_load = self._to_load(author_ids)
+        if to_load:
+            self._load_authors(to_load)
+
+        streams = [self._recent.get(author_id, ()) for author_id in author_ids]
+        return list(islice(merge(*streams, reverse=True), limit))
+
+
+def load_messages(msg_ids):
+    """Fetch messages by primary key, keeping the order of `msg_ids`."""
+
+    if not msg_ids:
+        return []
+
+    by_id = {}
+    for found in shards.scatter(
+            lambda session: session.query(Message)
+            .filter(Message.id.in_(msg_ids)).all()):
+        by_id.update((msg.id, msg) for msg in found)
+    return shards.attach_users(
+        [by_id[msg_id] for msg_id in msg_ids if msg_id in by_id])
+
+
+recent_messages = RecentMessagesCache()